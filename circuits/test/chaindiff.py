@@ -0,0 +1,161 @@
+import sys
+import os
+import re
+import json
+import struct
+import hashlib
+from dnschain import chain_domains, replace_file
+
+# compare a freshly fetched chain against the previous data/ snapshot
+#
+# every (owner, rrtype) of the chain gets one of these statuses,
+# from least to most severe:
+#   unchanged       KEY/KSK, SIG and REC are byte for byte the same
+#   resigned        same records and key, only the RRSIG (validity, signature) is new
+#   record_changed  the signed records changed (e.g. a TXT record was edited)
+#   key_changed     a signing key, DNSKEY or DS rrset changed
+#   new             nothing to compare against
+# and the chain as a whole gets the most severe status of its records
+#
+# the proof only depends on the signed records and keys, so a chain that is
+# unchanged or only resigned can reuse the previous proof, see reusable()
+# which compares the data folder with the digest of the chain the proof was made from
+
+STATUSES = ["unchanged", "resigned", "record_changed", "key_changed", "new"]
+
+DATA_FILE = re.compile(r"^(.*)-(DNSKEY|DS|TXT)-(KEY|KSK|SIG|REC)\.dat$")
+
+# group the chain files of a domain, given as a dict of file name -> bytes
+# return a dict of (owner, rrtype) -> {KEY/KSK/SIG/REC: bytes}
+def group_files(files, domain):
+  owners = chain_domains(domain)
+  records = {}
+  for name, data in files.items():
+    match = DATA_FILE.match(name)
+    # only the leaf's TXT records are part of the chain, a parent zone's
+    # TXT files are there if the parent's chain was fetched into the same folder
+    if match and match.group(1) in owners and (match.group(2) != "TXT" or match.group(1) == owners[0]):
+      records.setdefault((match.group(1), match.group(2)), {})[match.group(3)] = bytes(data)
+  return records
+
+# read the chain files of a domain in a data folder, grouped as above
+def snapshot(data_path, domain):
+  files = {}
+  if os.path.isdir(data_path):
+    for name in os.listdir(data_path):
+      if DATA_FILE.match(name):
+        with open(os.path.join(data_path, name), "rb") as f:
+          files[name] = f.read()
+  return group_files(files, domain)
+
+# split a REC file (RRSIG rdata without the signature + canonical rrset)
+# into the RRSIG fields and the signed records
+def split_rec(rec):
+  # type covered, algorithm, labels, original ttl, expiration, inception, key tag
+  pos = 18
+  # then the uncompressed signer name
+  while rec[pos] != 0:
+    pos += rec[pos] + 1
+  return rec[:pos + 1], rec[pos + 1:]
+
+# the expiration, inception and key tag of the RRSIG a REC file was made from
+def rrsig_fields(rec):
+  _, _, _, _, expiration, inception, key_tag = struct.unpack("!HBBIIIH", rec[:18])
+  return expiration, inception, key_tag
+
+# earliest RRSIG expiration (unix time) of a snapshot, None if it has no REC files
+def expiration(records):
+  times = [rrsig_fields(files["REC"])[0] for files in records.values() if "REC" in files]
+  return min(times) if times else None
+
+def compare_record(rrtype, old, new):
+  if old is None:
+    return "new"
+  if new is None:
+    return "key_changed"
+  for key in ("KEY", "KSK"):
+    if old.get(key) != new.get(key):
+      return "key_changed"
+  if old == new:
+    return "unchanged"
+  if "REC" not in old or "REC" not in new:
+    return "key_changed"
+  if split_rec(old["REC"])[1] != split_rec(new["REC"])[1]:
+    return "record_changed" if rrtype == "TXT" else "key_changed"
+  return "resigned"
+
+# compare two snapshots and build the change report
+def compare(domain, old, new):
+  records = {}
+  for owner, rrtype in sorted(set(old) | set(new)):
+    records[owner + " " + rrtype] = compare_record(rrtype, old.get((owner, rrtype)), new.get((owner, rrtype)))
+  status = max(records.values(), key=STATUSES.index) if records else "new"
+  return {"domain": domain, "status": status, "records": records}
+
+def report_path(data_path, domain):
+  return os.path.join(data_path, domain + "-changes.json")
+
+def write_report(data_path, report):
+  replace_file(report_path(data_path, report["domain"]), json.dumps(report, indent=1).encode())
+
+# digest of what a proof depends on in a snapshot: the keys and the signed
+# records, not the RRSIG validity or signature, so resigning keeps it
+def chain_digest(records):
+  h = hashlib.sha256()
+  for owner, rrtype in sorted(records):
+    files = records[(owner, rrtype)]
+    h.update((owner + " " + rrtype + "\n").encode())
+    for key in ("KEY", "KSK"):
+      if key in files:
+        h.update(key.encode() + len(files[key]).to_bytes(4, "big") + files[key])
+    if "REC" in files:
+      rec = split_rec(files["REC"])[1]
+      h.update(b"REC" + len(rec).to_bytes(4, "big") + rec)
+  return h.hexdigest()
+
+# the chain digest kept next to a proof's input, e.g. bin/<domain>-<mode>_chain.sha256
+def digest_path(input_path):
+  return re.sub(r"_input\.json$", "", input_path) + "_chain.sha256"
+
+# write the digest of the chain in data_path, for the proof made from it
+def write_digest(data_path, domain, path):
+  if domain[-1] != ".":
+    domain += "."
+  replace_file(path, (chain_digest(snapshot(data_path, domain)) + "\n").encode())
+
+# a previous proof can be reused if the chain in data_path is the one it was made
+# from, up to new signatures, and the new prover input has the same public inputs
+def reusable(data_path, domain, new_input, prev_input):
+  if domain[-1] != ".":
+    domain += "."
+  path = digest_path(prev_input)
+  if not os.path.exists(path) or not os.path.exists(prev_input):
+    return False
+  with open(path, "r") as f:
+    if f.read().strip() != chain_digest(snapshot(data_path, domain)):
+      return False
+  with open(new_input, "r") as f:
+    new = json.load(f)
+  with open(prev_input, "r") as f:
+    prev = json.load(f)
+  return new["packed_pub_inputs"] == prev["packed_pub_inputs"]
+
+def usage():
+  print("Usage:", sys.argv[0], "status <data folder> <domain>")
+  print("      ", sys.argv[0], "digest <data folder> <domain> <input.json>")
+  print("      ", sys.argv[0], "reusable <data folder> <domain> <new input.json> <previous input.json>")
+  print("status prints the status from the last fetch, digest writes the chain digest next to a prover input,")
+  print("reusable exits 0 if the previous proof can be reused")
+  sys.exit(2)
+
+if __name__ == '__main__':
+  if len(sys.argv) == 4 and sys.argv[1] == "status":
+    domain = sys.argv[3] if sys.argv[3][-1] == "." else sys.argv[3] + "."
+    with open(report_path(sys.argv[2], domain), "r") as f:
+      print(json.load(f)["status"])
+  elif len(sys.argv) == 5 and sys.argv[1] == "digest":
+    write_digest(sys.argv[2], sys.argv[3], digest_path(sys.argv[4]))
+  elif len(sys.argv) == 6 and sys.argv[1] == "reusable":
+    sys.exit(0 if reusable(*sys.argv[2:]) else 1)
+  else:
+    usage()
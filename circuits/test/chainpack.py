@@ -0,0 +1,145 @@
+import sys
+import os
+import mmap
+import struct
+from dnschain import ChainError, chain_domains
+
+# single-file container for the DNSSEC chain data of a domain
+#
+# instead of one file per (domain, rrtype, KEY/SIG/REC) in data/, a chain is
+# stored as a header, an index, and then every file's bytes back to back:
+#
+#   magic "NOPECHN" | version (u8) | entry count (u32)
+#   per entry: name length (u16) | name (utf-8) | offset (u64) | length (u32)
+#   blobs, each at its offset from the start of the file
+#
+# entry names are the file names used in data/ (e.g. com.-DS-KEY.dat),
+# integers are big endian
+
+MAGIC = b"NOPECHN"
+VERSION = 1
+HEADER = struct.Struct(">7sBI")
+ENTRY = struct.Struct(">QI")
+
+# entry names become file names in data/ on unpack, so they must stay in it
+def check_name(name):
+  if os.path.isabs(name) or os.sep in name or (os.altsep and os.altsep in name) or ".." in name:
+    raise ChainError("Unsafe entry name " + repr(name))
+
+class ChainFile:
+  # memory map a container and read its index
+  def __init__(self, path):
+    self.path = path
+    with open(path, "rb") as f:
+      self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self.view = memoryview(self.map)
+    magic, version, count = HEADER.unpack_from(self.map, 0)
+    if magic != MAGIC:
+      self.close()
+      raise ValueError(path + " is not a chain container")
+    if version != VERSION:
+      self.close()
+      raise ValueError(path + " has unsupported container version " + str(version))
+    self.index = {}
+    pos = HEADER.size
+    for _ in range(count):
+      name_len = struct.unpack_from(">H", self.map, pos)[0]
+      name = bytes(self.map[pos + 2:pos + 2 + name_len]).decode("utf-8")
+      try:
+        check_name(name)
+      except ChainError:
+        self.close()
+        raise
+      pos += 2 + name_len
+      self.index[name] = ENTRY.unpack_from(self.map, pos)
+      pos += ENTRY.size
+
+  def names(self):
+    return list(self.index)
+
+  def __contains__(self, name):
+    return name in self.index
+
+  # zero-copy view of the bytes stored under name
+  def get(self, name):
+    offset, length = self.index[name]
+    return self.view[offset:offset + length]
+
+  # total bytes of chain data, same as the size of the equivalent data/ folder
+  def payload_size(self):
+    return sum(length for _, length in self.index.values())
+
+  def close(self):
+    self.view.release()
+    self.map.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+# write a container holding files, a dict of name -> bytes
+def write_chain(path, files):
+  names = sorted(files)
+  encoded = [name.encode("utf-8") for name in names]
+  offset = HEADER.size + sum(2 + len(name) + ENTRY.size for name in encoded)
+  with open(path, "wb") as f:
+    f.write(HEADER.pack(MAGIC, VERSION, len(names)))
+    for name, raw in zip(names, encoded):
+      f.write(struct.pack(">H", len(raw)) + raw + ENTRY.pack(offset, len(files[name])))
+      offset += len(files[name])
+    for name in names:
+      f.write(files[name])
+
+# pack the data/ files of a domain's chain (or all of them) into a container
+def pack(data_path, out_path, domain = None):
+  files = {}
+  owners = chain_domains(domain) if domain else None
+  for name in sorted(os.listdir(data_path)):
+    if owners is not None and not any(name.startswith(owner + "-") for owner in owners):
+      continue
+    with open(os.path.join(data_path, name), "rb") as f:
+      files[name] = f.read()
+  write_chain(out_path, files)
+  return len(files)
+
+# write every file of a container back out in the data/ layout
+def unpack(chain_path, data_path):
+  if not os.path.exists(data_path):
+    os.makedirs(data_path)
+  with ChainFile(chain_path) as chain:
+    for name in chain.names():
+      check_name(name)
+      with open(os.path.join(data_path, name), "wb") as f:
+        f.write(chain.get(name))
+    return len(chain.names())
+
+def usage():
+  print("Usage:", sys.argv[0], "pack <data folder> <out.chain> [domain]")
+  print("      ", sys.argv[0], "unpack <in.chain> <data folder>")
+  print("      ", sys.argv[0], "ls <in.chain>")
+  print("Ex:", sys.argv[0], "pack data nope-tools.org.chain nope-tools.org")
+  sys.exit(1)
+
+if __name__ == '__main__':
+  if len(sys.argv) < 3:
+    usage()
+  cmd = sys.argv[1]
+  if cmd == "pack" and len(sys.argv) in (4, 5):
+    count = pack(sys.argv[2], sys.argv[3], sys.argv[4] if len(sys.argv) == 5 else None)
+    print("Packed", count, "files into", sys.argv[3])
+  elif cmd == "unpack" and len(sys.argv) == 4:
+    try:
+      count = unpack(sys.argv[2], sys.argv[3])
+    except (ChainError, ValueError) as e:
+      print("Error:", e)
+      sys.exit(1)
+    print("Unpacked", count, "files into", sys.argv[3])
+  elif cmd == "ls" and len(sys.argv) == 3:
+    with ChainFile(sys.argv[2]) as chain:
+      for name in chain.names():
+        print(chain.index[name][1], name)
+      print(chain.payload_size(), "bytes total")
+  else:
+    usage()
@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import tempfile
+import base64
+import dns.message
+import dns.rdatatype
+
+# persistent cache of DNSSEC responses keyed by (owner name, rrtype)
+# most chains share the root and TLD records, so when fetching for many
+# domains the bulk of the queries can be answered from here
+#
+# an entry stays valid until the smallest TTL in the answer runs out
+# or until the earliest RRSIG in the answer expires, whichever is first
+#
+# only the root and TLD records are cached unless leaves is set: the DNSKEY and
+# TXT records of a leaf domain are the ones its owner changes (e.g. a fresh TXT
+# record in managed mode), and a cached copy would hide the change until it expires
+
+# default location of the cache file
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "nope", "dnscache.json")
+
+class RecordCache:
+  def __init__(self, path = DEFAULT_PATH, leaves = False):
+    self.path = path
+    self.leaves = leaves
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.entries = {}
+    # a cache that can't be read (cut short, edited by hand) only costs its entries
+    try:
+      with open(path, "r") as f:
+        entries = json.load(f)
+      if isinstance(entries, dict):
+        self.entries = entries
+    except (OSError, ValueError):
+      pass
+
+  @staticmethod
+  def key(domain, rrtype):
+    return domain.lower() + "|" + rrtype
+
+  # the root, a TLD, or any name if leaves are cached too
+  def caches(self, domain):
+    return self.leaves or domain.strip(".").count(".") == 0
+
+  # return the cached response for (domain, rrtype) or None
+  # entries past their TTL or RRSIG expiration are dropped
+  def get(self, domain, rrtype, now = None):
+    if now is None:
+      now = time.time()
+    if not self.caches(domain):
+      return None
+    key = self.key(domain, rrtype)
+    entry = self.entries.get(key)
+    if entry is None:
+      self.misses += 1
+      return None
+    if now >= entry["expires"]:
+      del self.entries[key]
+      self.evictions += 1
+      self.misses += 1
+      return None
+    self.hits += 1
+    return dns.message.from_wire(base64.b64decode(entry["wire"]))
+
+  # store a response, only if it has an answer we can put an expiry on
+  def put(self, domain, rrtype, response, now = None):
+    if now is None:
+      now = time.time()
+    if len(response.answer) == 0 or not self.caches(domain):
+      return
+    expires = now + min(rrset.ttl for rrset in response.answer)
+    for rrset in response.answer:
+      if rrset.rdtype == dns.rdatatype.RRSIG:
+        expires = min([expires] + [rrsig.expiration for rrsig in rrset])
+    if expires <= now:
+      return
+    self.entries[self.key(domain, rrtype)] = {
+      "expires": expires,
+      "wire": base64.b64encode(response.to_wire()).decode("ascii"),
+    }
+
+  # drop every expired entry, return how many were dropped
+  def prune(self, now = None):
+    if now is None:
+      now = time.time()
+    stale = [key for key, entry in self.entries.items() if now >= entry["expires"]]
+    for key in stale:
+      del self.entries[key]
+    self.evictions += len(stale)
+    return len(stale)
+
+  # write the cache back to disk
+  def save(self):
+    self.prune()
+    folder = os.path.dirname(self.path)
+    if folder and not os.path.exists(folder):
+      os.makedirs(folder)
+    # write to a temporary file of its own first, so a crash can't leave
+    # half a cache and concurrent fetches don't write over each other's
+    fd, tmp = tempfile.mkstemp(dir=folder or ".", prefix=os.path.basename(self.path) + ".", suffix=".tmp")
+    try:
+      with open(fd, "w") as f:
+        json.dump(self.entries, f)
+      os.replace(tmp, self.path)
+    except BaseException:
+      os.unlink(tmp)
+      raise
+
+  def stats(self):
+    return "cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses, " + \
+           str(self.evictions) + " evictions, " + str(len(self.entries)) + " entries"
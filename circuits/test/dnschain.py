@@ -0,0 +1,274 @@
+import os
+import json
+import asyncio
+
+# fetch DNSSEC chains in-process
+#
+# this is what fetchmin.py, fetch_tlsa.py and analyze.py are built on, and
+# what a long running process should use to fetch many chains without
+# starting a script per domain: nothing here prints or exits, a bad chain
+# raises ChainError, and a fetched chain comes back as a Chain holding the
+# data/ files in memory
+#
+# dnspython is only imported once a query is made or a chain is built
+
+class ChainError(Exception):
+  pass
+
+# format a domain name from a string to a wire format
+def wire_fmt(domain):
+  if domain.endswith('.'):
+    domain = domain[:-1]
+  labels = domain.split('.')
+  return b''.join(bytes([len(label)]) + label.encode('ascii') for label in labels) + b'\x00'
+
+# bit of a hack, works for us with a linear domain sig structure
+def get_par_domain(domain):
+  count = domain.count(".")
+  if count == 1:
+    return "."
+  elif count > 1:
+    return domain[domain.find(".") + 1:]
+  raise ChainError("Invalid domain name " + domain)
+
+# names of the zones from a domain up to the root
+def chain_domains(domain):
+  if domain[-1] != ".":
+    domain += "."
+  domains = [domain]
+  while domain != ".":
+    domain = domain[domain.find(".") + 1:] or "."
+    domains.append(domain)
+  return domains
+
+# list every (domain, rrtype) query build_chain needs for the chain
+# of a leaf domain, from the leaf up to the root
+def chain_queries(domain):
+  queries = [(domain, "DNSKEY"), (domain, "TXT")]
+  while domain != ".":
+    queries.append((domain, "DS"))
+    domain = get_par_domain(domain)
+    queries.append((domain, "DNSKEY"))
+  return queries
+
+# get the key with the given tag from the rrset
+def get_keyrr(rrset, tag):
+  import dns.dnssec
+  for rr in rrset:
+    if tag == dns.dnssec.key_id(rr):
+      return rr
+  raise ChainError("Could not find key with tag " + str(tag))
+
+# format a key signing key for verification
+def fmt_ksk(rr, domain):
+  return wire_fmt(domain) + \
+         rr.flags.to_bytes(2, byteorder="big") + \
+         rr.protocol.to_bytes(1, byteorder="big") + \
+         rr.algorithm.to_bytes(1, byteorder="big") + \
+         rr.key
+
+# the data an RRSIG signs: its rdata without the signature + the canonical rrset
+def signature_data(record):
+  import dns.dnssec
+  return dns.dnssec._make_rrsig_signature_data(record["rrset"], record["rrsig"])
+
+# check that a response holds exactly one rrset + rrsig and return them
+# with allow_empty, a response without any answer gives None
+def check_response(domain, record_type, response, allow_empty = False):
+  import dns.rdatatype
+  if allow_empty and len(response.answer) == 0:
+    return None
+  # ensure correct number/format of answers
+  if len(response.answer) < 2 or (response.answer[1].rdtype != dns.rdatatype.RRSIG):
+    raise ChainError(domain + " " + record_type + " does not have an RRSIG record")
+  elif len(response.answer[1]) > 2:
+    raise ChainError(domain + " " + record_type + " has too many RRSIG records")
+  # return the rrset + rrsig
+  return {"rrset": response.answer[0], "rrsig": response.answer[1][0]}
+
+# replace a file at once, so a proof reading the data folder at the same time
+# (scripts/watch.py proves in the background) sees the old or the new file, never half of one
+def replace_file(path, data):
+  tmp = path + "." + str(os.getpid()) + ".tmp"
+  with open(tmp, "wb") as f:
+    f.write(data)
+  os.replace(tmp, path)
+
+# the files of one chain, by their name in data/
+class Chain:
+  def __init__(self, domain):
+    self.domain = domain
+    self.files = {}
+    # DNSSEC algorithm of the leaf ("sld") and its parents ("tld")
+    self.algs = {}
+
+  def add(self, domain, rrtype, modifier, data):
+    self.files[domain + "-" + rrtype + "-" + modifier + ".dat"] = data
+
+  # write the files and the algorithms to a data folder
+  # return the paths written
+  def write(self, data_path, algs = True):
+    if not os.path.exists(data_path):
+      os.makedirs(data_path)
+    paths = []
+    for name in sorted(self.files):
+      paths.append(os.path.join(data_path, name))
+      replace_file(paths[-1], self.files[name])
+    if algs:
+      paths.append(os.path.join(data_path, self.domain + "-algs.json"))
+      replace_file(paths[-1], json.dumps(self.algs).encode())
+    return paths
+
+# add the DNSKEY (and, if it has a parent, DS) files of a zone to a chain,
+# the TXT files too if it is the leaf, then recurse up to the root
+# lookup(domain, rrtype) returns the checked rrset + rrsig
+# with root_ksk the root key is written like any other KSK (fetch_tlsa.py layout)
+# return the DNSKEY rrset for DS verification one level down
+def add_zone(chain, domain, lookup, is_leaf = False, root_ksk = False):
+  dnskey = lookup(domain, "DNSKEY")
+  rr = get_keyrr(dnskey["rrset"], dnskey["rrsig"].key_tag)
+  if domain == "." and not root_ksk:
+    chain.add(domain, "DNSKEY", "KEY", rr.key)
+  else:
+    if domain != ".":
+      chain.algs["sld" if is_leaf else "tld"] = int(rr.algorithm)
+    chain.add(domain, "DNSKEY", "KSK", fmt_ksk(rr, domain))
+    chain.add(domain, "DNSKEY", "SIG", dnskey["rrsig"].signature)
+    chain.add(domain, "DNSKEY", "REC", signature_data(dnskey))
+  if is_leaf and not root_ksk:
+    txt = lookup(domain, "TXT")
+    chain.add(domain, "TXT", "KEY", get_keyrr(dnskey["rrset"], txt["rrsig"].key_tag).key)
+    chain.add(domain, "TXT", "SIG", txt["rrsig"].signature)
+    chain.add(domain, "TXT", "REC", signature_data(txt))
+  if domain != ".":
+    ds = lookup(domain, "DS")
+    par_dnskey = add_zone(chain, get_par_domain(domain), lookup, root_ksk=root_ksk)
+    chain.add(domain, "DS", "KEY", get_keyrr(par_dnskey["rrset"], ds["rrsig"].key_tag).key)
+    chain.add(domain, "DS", "SIG", ds["rrsig"].signature)
+    chain.add(domain, "DS", "REC", signature_data(ds))
+  return dnskey
+
+# the TXT chain of a leaf domain, as proven by the circuits
+def build_chain(domain, lookup):
+  chain = Chain(domain)
+  add_zone(chain, domain, lookup, True)
+  return chain
+
+# the TLSA chain of a name such as _443._tcp.example.com., which starts
+# at the zone that signed the TLSA rrset
+def build_tlsa_chain(domain, lookup):
+  chain = Chain(domain)
+  tlsa = lookup(domain, "TLSA")
+  signer = tlsa["rrsig"].signer.to_text()
+  dnskey = add_zone(chain, signer, lookup, True, root_ksk=True)
+  chain.add(domain, "TLSA", "KEY", get_keyrr(dnskey["rrset"], tlsa["rrsig"].key_tag).key)
+  chain.add(domain, "TLSA", "SIG", tlsa["rrsig"].signature)
+  chain.add(domain, "TLSA", "REC", signature_data(tlsa))
+  return chain
+
+# lookup over responses fetched ahead of time, by (domain, rrtype)
+def prefetched(responses):
+  def lookup(domain, record_type):
+    response = responses.get((domain, record_type))
+    if response is None:
+      raise ChainError(domain + " " + record_type + " was not fetched")
+    if isinstance(response, Exception):
+      raise response
+    return check_response(domain, record_type, response)
+  return lookup
+
+# makes the queries for chains, through a dnstransport.Transport and
+# optionally a dnscache.RecordCache
+class Fetcher:
+  def __init__(self, transport = None, cache = None):
+    if transport is None:
+      import dnstransport
+      transport = dnstransport.Transport()
+    self.transport = transport
+    self.cache = cache
+
+  @staticmethod
+  def make_query(domain, record_type):
+    import dns.message
+    import dns.name
+    return dns.message.make_query(dns.name.from_text(domain), record_type, want_dnssec=True)
+
+  # return the raw response for (domain, rrtype), from the cache if possible
+  def query(self, domain, record_type):
+    import dns.exception
+    response = self.cache.get(domain, record_type) if self.cache else None
+    if response is None:
+      try:
+        response = self.transport.query(self.make_query(domain, record_type))
+      except (OSError, EOFError, dns.exception.DNSException) as e:
+        raise ChainError(domain + " " + record_type + " query failed: " + str(e)) from e
+      if self.cache:
+        self.cache.put(domain, record_type, response)
+    return response
+
+  # same as query, but without blocking the event loop
+  async def query_async(self, domain, record_type):
+    import dns.exception
+    response = self.cache.get(domain, record_type) if self.cache else None
+    if response is None:
+      try:
+        response = await self.transport.query_async(self.make_query(domain, record_type))
+      except (OSError, EOFError, dns.exception.DNSException) as e:
+        raise ChainError(domain + " " + record_type + " query failed: " + str(e)) from e
+      if self.cache:
+        self.cache.put(domain, record_type, response)
+    return response
+
+  # query and return the checked rrset + rrsig
+  def lookup(self, domain, record_type, allow_empty = False):
+    return check_response(domain, record_type, self.query(domain, record_type), allow_empty)
+
+  # issue queries concurrently, at most jobs at a time if given
+  # return a dict of (domain, rrtype) -> raw response, or the ChainError it failed with
+  async def prefetch(self, queries, jobs = None):
+    queries = list(dict.fromkeys(queries))
+    sem = asyncio.Semaphore(jobs) if jobs else None
+    async def query(domain, record_type):
+      if sem is None:
+        return await self.query_async(domain, record_type)
+      async with sem:
+        return await self.query_async(domain, record_type)
+    try:
+      responses = await asyncio.gather(*(query(d, t) for d, t in queries), return_exceptions=True)
+    finally:
+      # the pipelined connection belongs to this event loop
+      self.transport.close()
+    for response in responses:
+      if isinstance(response, Exception) and not isinstance(response, ChainError):
+        raise response
+    return dict(zip(queries, responses))
+
+  # fetch the chain of a leaf domain one query at a time
+  def fetch(self, domain):
+    return build_chain(domain, self.lookup)
+
+  # fetch the chain of a leaf domain with every query in flight at once
+  async def fetch_async(self, domain):
+    return build_chain(domain, prefetched(await self.prefetch(chain_queries(domain))))
+
+  # fetch the chains of many domains with at most jobs queries in flight
+  # records shared between chains (root, TLDs) are only queried once
+  # return a dict of domain -> Chain and one of domain -> ChainError for the rest
+  async def fetch_many(self, domains, jobs = 32):
+    lookup = prefetched(await self.prefetch([q for domain in domains for q in chain_queries(domain)], jobs))
+    chains = {}
+    errors = {}
+    for domain in domains:
+      try:
+        chains[domain] = build_chain(domain, lookup)
+      except ChainError as e:
+        errors[domain] = e
+    return chains, errors
+
+  # fetch the TLSA chain of a name, one query at a time
+  # (the zones to query are only known once the TLSA rrset is back)
+  def fetch_tlsa(self, domain):
+    return build_tlsa_chain(domain, self.lookup)
+
+  def close(self):
+    self.transport.close()
@@ -0,0 +1,164 @@
+import os
+import json
+import base64
+import random
+import struct
+import argparse
+import asyncio
+import dns.exception
+import dns.message
+import dns.flags
+import dns.rcode
+import dns.rdatatype
+import dnstransport
+
+# local DNS responder for reproducible fetch benchmarks
+#
+# in record mode every query is forwarded to a real resolver and the answer
+# is saved, in replay mode the saved answers are served back with a configurable
+# latency, jitter and UDP packet loss, so the fetchers can be measured offline:
+#
+#   python3 dnsreplay.py record answers.json --upstream 8.8.8.8
+#   python3 fetchmin.py nope-tools.org --resolver 127.0.0.1:5300 --no-cache
+#   python3 dnsreplay.py replay answers.json --latency 20 --jitter 5 --loss 0.01
+#
+# UDP answers larger than the client's EDNS buffer come back truncated,
+# as they would from a real resolver, so the TCP fallback gets exercised too
+
+class Responder:
+  def __init__(self, path, upstream = None, latency = 0, jitter = 0, loss = 0):
+    self.path = path
+    self.upstream = upstream
+    self.latency = latency / 1000
+    self.jitter = jitter / 1000
+    self.loss = loss
+    self.answers = {}
+    self.served = 0
+    self.dropped = 0
+    self.unknown = 0
+    self.failed = 0
+    if os.path.exists(path):
+      with open(path, "r") as f:
+        self.answers = json.load(f)
+
+  @staticmethod
+  def key(request):
+    question = request.question[0]
+    dnssec = "DO" if request.ednsflags & dns.flags.DO else "-"
+    return question.name.to_text().lower() + " " + dns.rdatatype.to_text(question.rdtype) + " " + dnssec
+
+  # answer a query, return None to drop it
+  async def answer(self, request, udp):
+    if udp and random.random() < self.loss:
+      self.dropped += 1
+      return None
+    key = self.key(request)
+    if self.upstream is not None:
+      upstream = dns.message.make_query(request.question[0].name, request.question[0].rdtype, want_dnssec=bool(request.ednsflags & dns.flags.DO))
+      try:
+        response = await self.upstream.query_async(upstream)
+      except (dns.exception.Timeout, OSError):
+        # answered like a resolver would, but not recorded, so the query is tried again next time
+        self.failed += 1
+        response = dns.message.make_response(request)
+        response.set_rcode(dns.rcode.SERVFAIL)
+        return response.to_wire()
+      self.answers[key] = base64.b64encode(response.to_wire()).decode("ascii")
+    elif key in self.answers:
+      response = dns.message.from_wire(base64.b64decode(self.answers[key]))
+      delay = self.latency + random.uniform(-self.jitter, self.jitter)
+      if delay > 0:
+        await asyncio.sleep(delay)
+    else:
+      self.unknown += 1
+      response = dns.message.make_response(request)
+      response.set_rcode(dns.rcode.SERVFAIL)
+      return response.to_wire()
+    self.served += 1
+    response.id = request.id
+    wire = response.to_wire()
+    limit = max(512, request.payload) if request.edns >= 0 else 512
+    if udp and len(wire) > limit:
+      truncated = dns.message.make_response(request)
+      truncated.flags |= dns.flags.TC
+      wire = truncated.to_wire()
+    return wire
+
+  def save(self):
+    with open(self.path, "w") as f:
+      json.dump(self.answers, f, indent=1)
+
+  def stats(self):
+    return "responder: " + str(self.served) + " answered, " + str(self.dropped) + " dropped, " + \
+           str(self.unknown) + " unknown, " + str(self.failed) + " upstream failures, " + str(len(self.answers)) + " recorded"
+
+class UDPServer(asyncio.DatagramProtocol):
+  def __init__(self, responder):
+    self.responder = responder
+
+  def connection_made(self, transport):
+    self.transport = transport
+
+  def datagram_received(self, data, addr):
+    asyncio.ensure_future(self.reply(data, addr))
+
+  async def reply(self, data, addr):
+    wire = await self.responder.answer(dns.message.from_wire(data), True)
+    if wire is not None:
+      self.transport.sendto(wire, addr)
+
+# queries on a TCP connection are answered as soon as each is ready,
+# possibly out of order, like a resolver that supports pipelining
+def tcp_handler(responder):
+  async def handle(reader, writer):
+    async def reply(request):
+      wire = await responder.answer(request, False)
+      writer.write(struct.pack("!H", len(wire)) + wire)
+    try:
+      while True:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+        asyncio.ensure_future(reply(dns.message.from_wire(await reader.readexactly(length))))
+    except (asyncio.IncompleteReadError, ConnectionError):
+      writer.close()
+  return handle
+
+async def serve(responder, host, port, duration):
+  loop = asyncio.get_running_loop()
+  udp, _ = await loop.create_datagram_endpoint(lambda: UDPServer(responder), local_addr=(host, port))
+  tcp = await asyncio.start_server(tcp_handler(responder), host, port)
+  print("Serving", len(responder.answers), "answers on", host + ":" + str(port), flush=True)
+  try:
+    if duration:
+      await asyncio.sleep(duration)
+    else:
+      await asyncio.Event().wait()
+  finally:
+    udp.close()
+    tcp.close()
+    if responder.upstream is not None:
+      responder.upstream.close()
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Record DNS answers once, then replay them locally")
+  parser.add_argument("mode", choices=["record", "replay"])
+  parser.add_argument("answers", help="JSON file of recorded answers")
+  parser.add_argument("--listen", default="127.0.0.1:5300", help="address to serve on (default: %(default)s)")
+  parser.add_argument("--upstream", default="8.8.8.8", help="resolver to record from (default: %(default)s)")
+  parser.add_argument("--latency", type=float, default=0, help="added latency per answer in ms")
+  parser.add_argument("--jitter", type=float, default=0, help="latency varies uniformly by up to this many ms")
+  parser.add_argument("--loss", type=float, default=0, help="fraction of UDP queries to drop")
+  parser.add_argument("--duration", type=float, default=0, help="stop after this many seconds (default: run until interrupted)")
+  args = parser.parse_args()
+  upstream = None
+  if args.mode == "record":
+    upstream = dnstransport.Transport(*dnstransport.parse_resolver(args.upstream))
+  responder = Responder(args.answers, upstream, args.latency, args.jitter, args.loss)
+  host, port = dnstransport.parse_resolver(args.listen)
+  try:
+    asyncio.run(serve(responder, host, port, args.duration))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    if args.mode == "record":
+      responder.save()
+    print(responder.stats())
@@ -0,0 +1,205 @@
+import time
+import struct
+import socket
+import asyncio
+import dns.query
+import dns.asyncquery
+import dns.message
+import dns.flags
+import dns.entropy
+import dns.exception
+import dns.rdatatype
+
+# transport used by make_request to talk to a resolver
+#
+# queries go over UDP and are retried over TCP when the answer comes back
+# truncated (large RSA DNSKEY rrsets with signatures don't always fit),
+# or go straight over TCP when use_tcp is set
+# one TCP connection per resolver is kept open and reused, and in async code
+# many queries are pipelined over it at once instead of waiting on each answer
+#
+# every query's latency is recorded in latencies as (name, rrtype, proto, seconds)
+
+class Transport:
+  def __init__(self, resolver = "8.8.8.8", port = 53, use_tcp = False, timeout = 5, retries = 2):
+    self.resolver = resolver
+    self.port = port
+    self.use_tcp = use_tcp
+    self.timeout = timeout
+    # lost UDP queries are sent again this many times
+    self.retries = retries
+    self.latencies = []
+    self.truncated = 0
+    self.timeouts = 0
+    # blocking TCP socket, reused across queries
+    self.sock = None
+    # pipelined asyncio TCP connection, bound to the loop that opened it
+    self.pipeline = None
+
+  def record(self, request, proto, start):
+    question = request.question[0]
+    self.latencies.append((question.name.to_text(), dns.rdatatype.to_text(question.rdtype), proto, time.perf_counter() - start))
+
+  # send a query and wait for the answer
+  def query(self, request):
+    start = time.perf_counter()
+    if not self.use_tcp:
+      response = self.query_udp(request)
+      if not response.flags & dns.flags.TC:
+        self.record(request, "udp", start)
+        return response
+      self.truncated += 1
+    response = self.query_tcp(request)
+    self.record(request, "tcp", start)
+    return response
+
+  def query_udp(self, request):
+    for attempt in range(self.retries + 1):
+      try:
+        return dns.query.udp(request, self.resolver, timeout=self.timeout, port=self.port)
+      except dns.exception.Timeout:
+        self.timeouts += 1
+        if attempt == self.retries:
+          raise
+
+  async def query_udp_async(self, request):
+    for attempt in range(self.retries + 1):
+      try:
+        return await dns.asyncquery.udp(request, self.resolver, timeout=self.timeout, port=self.port)
+      except dns.exception.Timeout:
+        self.timeouts += 1
+        if attempt == self.retries:
+          raise
+
+  def query_tcp(self, request):
+    # the resolver may have closed an idle connection, so reconnect once
+    for attempt in range(2):
+      if self.sock is None:
+        self.sock = socket.create_connection((self.resolver, self.port), timeout=self.timeout)
+      try:
+        return dns.query.tcp(request, self.resolver, timeout=self.timeout, port=self.port, sock=self.sock)
+      except (OSError, EOFError):
+        self.sock.close()
+        self.sock = None
+        if attempt == 1:
+          raise
+
+  # same as query, but without blocking the event loop
+  async def query_async(self, request):
+    start = time.perf_counter()
+    if not self.use_tcp:
+      response = await self.query_udp_async(request)
+      if not response.flags & dns.flags.TC:
+        self.record(request, "udp", start)
+        return response
+      self.truncated += 1
+    pipeline = await self.get_pipeline()
+    try:
+      response = await asyncio.wait_for(pipeline.query(request), self.timeout)
+    except asyncio.TimeoutError:
+      # not an OSError before python 3.11, callers only expect DNS and socket errors
+      self.timeouts += 1
+      raise dns.exception.Timeout(timeout=self.timeout) from None
+    self.record(request, "tcp", start)
+    return response
+
+  async def get_pipeline(self):
+    loop = asyncio.get_running_loop()
+    if self.pipeline is None or self.pipeline.closed or self.pipeline.loop is not loop:
+      try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.resolver, self.port), self.timeout)
+      except asyncio.TimeoutError:
+        self.timeouts += 1
+        raise dns.exception.Timeout(timeout=self.timeout) from None
+      # another query may have connected while this one waited
+      if self.pipeline is not None and not self.pipeline.closed and self.pipeline.loop is loop:
+        writer.close()
+      else:
+        self.pipeline = Pipeline(reader, writer)
+    return self.pipeline
+
+  # close the open connections
+  def close(self):
+    if self.sock is not None:
+      self.sock.close()
+      self.sock = None
+    if self.pipeline is not None:
+      self.pipeline.close()
+      self.pipeline = None
+
+  def stats(self):
+    if not self.latencies:
+      return "transport: no queries"
+    times = sorted(t for _, _, _, t in self.latencies)
+    tcp = sum(1 for _, _, proto, _ in self.latencies if proto == "tcp")
+    return "transport: " + str(len(times)) + " queries (" + str(tcp) + " over tcp, " + \
+           str(self.truncated) + " truncated, " + str(self.timeouts) + " timeouts), latency p50 " + '{0:.1f}'.format(1000 * percentile(times, 50)) + \
+           " ms, p95 " + '{0:.1f}'.format(1000 * percentile(times, 95)) + " ms, max " + \
+           '{0:.1f}'.format(1000 * times[-1]) + " ms"
+
+# several queries in flight on one TCP connection (RFC 7766)
+# answers can come back in any order and are matched to queries by message id
+class Pipeline:
+  def __init__(self, reader, writer):
+    self.reader = reader
+    self.writer = writer
+    self.loop = asyncio.get_running_loop()
+    self.pending = {}
+    self.closed = False
+    self.task = self.loop.create_task(self.read())
+
+  async def read(self):
+    try:
+      while True:
+        length = struct.unpack("!H", await self.reader.readexactly(2))[0]
+        response = dns.message.from_wire(await self.reader.readexactly(length))
+        future = self.pending.pop(response.id, None)
+        if future is not None and not future.done():
+          future.set_result(response)
+    except (OSError, EOFError, asyncio.IncompleteReadError, dns.exception.DNSException) as e:
+      self.fail(ConnectionError("connection to resolver lost: " + str(e)))
+    except asyncio.CancelledError:
+      self.fail(ConnectionError("connection to resolver closed"))
+
+  def fail(self, error):
+    self.closed = True
+    for future in self.pending.values():
+      if not future.done():
+        future.set_exception(error)
+    self.pending.clear()
+
+  async def query(self, request):
+    if self.closed:
+      raise ConnectionError("connection to resolver lost")
+    # ids have to be unique among the queries in flight
+    while request.id in self.pending:
+      request.id = dns.entropy.random_16()
+    future = self.loop.create_future()
+    self.pending[request.id] = future
+    try:
+      wire = request.to_wire()
+      self.writer.write(struct.pack("!H", len(wire)) + wire)
+      await self.writer.drain()
+      return await future
+    finally:
+      # a query given up on (timed out, cancelled) must not hold on to its id
+      if self.pending.get(request.id) is future:
+        del self.pending[request.id]
+
+  def close(self):
+    self.task.cancel()
+    self.writer.close()
+
+# split "host", "host:port" or "[ipv6]:port" into (host, port)
+def parse_resolver(text, port = 53):
+  if text.startswith("["):
+    host, _, rest = text[1:].partition("]")
+    return host, int(rest[1:]) if rest else port
+  if text.count(":") == 1:
+    host, rest = text.split(":")
+    return host, int(rest)
+  return text, port
+
+# nearest-rank percentile of a sorted list
+def percentile(values, p):
+  return values[min(len(values) - 1, max(0, -(-len(values) * p // 100) - 1))]
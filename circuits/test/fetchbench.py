@@ -0,0 +1,59 @@
+import time
+import argparse
+import asyncio
+import dnstransport
+import dnschain
+
+# benchmark the chain fetch against a resolver, usually a local dnsreplay.py
+# responder so that runs are reproducible:
+#
+#   python3 dnsreplay.py replay answers.json --latency 20 --jitter 5 &
+#   python3 fetchbench.py --resolver 127.0.0.1:5300 -n 50 nope-tools.org nope-tools.com
+#
+# every iteration fetches the whole chain of every domain (no record cache)
+# and the fetch times are reported per chain depth, that is per number of
+# zones between the domain and the root
+
+def depth(domain):
+  return domain.rstrip(".").count(".") + 1
+
+# fetch one chain, return the wall time in seconds
+def time_fetch(fetcher, domain, sequential):
+  start = time.perf_counter()
+  if sequential:
+    fetcher.fetch(domain)
+  else:
+    asyncio.run(fetcher.fetch_async(domain))
+  return time.perf_counter() - start
+
+def print_row(label, times):
+  times = sorted(times)
+  row = [label, str(len(times))]
+  for p in (50, 90, 99):
+    row.append('{0:.1f}'.format(1000 * dnstransport.percentile(times, p)))
+  row.append('{0:.1f}'.format(1000 * times[-1]))
+  print('\t'.join(row))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Chain fetch latency per chain depth")
+  parser.add_argument("domains", nargs="+", help="domains to fetch")
+  parser.add_argument("--resolver", default="127.0.0.1:5300", help="resolver to query (default: %(default)s)")
+  parser.add_argument("-n", "--iterations", type=int, default=20, help="fetches per domain (default: %(default)s)")
+  parser.add_argument("--sequential", action="store_true", help="query one record at a time")
+  parser.add_argument("--tcp", action="store_true", help="send every query over one pipelined TCP connection")
+  parser.add_argument("--timeout", type=float, default=1, help="seconds before a lost UDP query is sent again (default: %(default)s)")
+  args = parser.parse_args()
+  transport = dnstransport.Transport(*dnstransport.parse_resolver(args.resolver), use_tcp=args.tcp, timeout=args.timeout)
+  fetcher = dnschain.Fetcher(transport)
+  domains = [d if d[-1] == "." else d + "." for d in args.domains]
+  by_depth = {}
+  for _ in range(args.iterations):
+    for domain in domains:
+      by_depth.setdefault(depth(domain), []).append(time_fetch(fetcher, domain, args.sequential))
+  print('\t'.join(['depth', 'fetches', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms']))
+  print('-' * 50)
+  for d in sorted(by_depth):
+    print_row(str(d), by_depth[d])
+  print_row("all", [t for times in by_depth.values() for t in times])
+  fetcher.close()
+  print(transport.stats())
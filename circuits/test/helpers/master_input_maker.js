@@ -27,6 +27,39 @@ const {
 
 const {buildSigWitness, proofOfECCKey, wordsToBytes} = require('./eccutil.js');
 
+// parsed chain containers (see fetchmin's chainpack.py), by path
+const chainFiles = {};
+
+// read one of the data files of a chain
+// data_path is either a data folder or a single chain container,
+// which is read once and then sliced without copying
+const readChainFile = function(data_path, name) {
+  if (!fs.statSync(data_path).isFile()) {
+    return fs.readFileSync(path.join(data_path, name));
+  }
+  if (!(data_path in chainFiles)) {
+    const buf = fs.readFileSync(data_path);
+    if (buf.toString('latin1', 0, 7) !== 'NOPECHN' || buf[7] !== 1) {
+      throw new Error(data_path + ' is not a version 1 chain container');
+    }
+    const index = {};
+    let pos = 12;
+    for (let i = 0; i < buf.readUInt32BE(8); i++) {
+      const len = buf.readUInt16BE(pos);
+      const entry = buf.toString('utf8', pos + 2, pos + 2 + len);
+      pos += 2 + len;
+      const offset = Number(buf.readBigUInt64BE(pos));
+      index[entry] = buf.subarray(offset, offset + buf.readUInt32BE(pos + 8));
+      pos += 12;
+    }
+    chainFiles[data_path] = index;
+  }
+  if (!(name in chainFiles[data_path])) {
+    throw new Error(name + ' not found in ' + data_path);
+  }
+  return chainFiles[data_path][name];
+};
+
 exports.makeDigest = function(key, ca) {
   // get top bytes of current timestamp
   const timestamp = [...Buffer.from(Date.now().toString(16).padStart(16, '0'), 'hex')].slice(0, 5);
@@ -54,9 +87,7 @@ exports.makeInput = function(
   }
 
   ret['sld_name'] = rightPadArrayTo(strToWire(names[0]), MAX_SLD_NAME_LEN);
-  const raw_root_zsk = fs.readFileSync(
-    path.join(data_path, names[1] + '-DS-KEY.dat'),
-  );
+  const raw_root_zsk = readChainFile(data_path, names[1] + '-DS-KEY.dat');
   ret['root_zsk'] = rightPadArrayTo(raw_root_zsk, MAX_RSA_KEY_LEN);
   ret['root_zsk_len_bytes'] = [
     raw_root_zsk.length % 256,
@@ -67,12 +98,8 @@ exports.makeInput = function(
     ret['pub_digest'] = pub_digest;
   }
 
-  const raw_tld_ds_rec = fs.readFileSync(
-    path.join(data_path, names[1] + '-DS-REC.dat'),
-  );
-  const raw_tld_ds_sig = fs.readFileSync(
-    path.join(data_path, names[1] + '-DS-SIG.dat'),
-  );
+  const raw_tld_ds_rec = readChainFile(data_path, names[1] + '-DS-REC.dat');
+  const raw_tld_ds_sig = readChainFile(data_path, names[1] + '-DS-SIG.dat');
   ret['tld_ds_sig'] = leftPadArrayTo(raw_tld_ds_sig, MAX_RSA_SIG_LEN);
   ret['tld_ds_sig_len'] = raw_tld_ds_sig.length;
   const tld_ds_recwpad = sha256pad(raw_tld_ds_rec);
@@ -82,8 +109,9 @@ exports.makeInput = function(
   ret['tld_ds_rec_suffix'] = rightPadArrayTo(tld_ds_recwpad.slice(-128), 128);
   ret['tld_ds_hash_offset'] = parseDSForOffset(tld_ds_recwpad);
 
-  const raw_tld_dnskey_rec = fs.readFileSync(
-    path.join(data_path, names[1] + '-DNSKEY-REC.dat'),
+  const raw_tld_dnskey_rec = readChainFile(
+    data_path,
+    names[1] + '-DNSKEY-REC.dat',
   );
   if (tld_alg == 8) {
     ret['tld_dnskey_rec'] = rightPadArrayTo(
@@ -97,11 +125,10 @@ exports.makeInput = function(
     );
   }
   ret['tld_dnskey_rec_len'] = raw_tld_dnskey_rec.length;
-  const raw_tld_ksk = fs.readFileSync(
-    path.join(data_path, names[1] + '-DNSKEY-KSK.dat'),
-  );
-  const raw_tld_dnskey_sig = fs.readFileSync(
-    path.join(data_path, names[1] + '-DNSKEY-SIG.dat'),
+  const raw_tld_ksk = readChainFile(data_path, names[1] + '-DNSKEY-KSK.dat');
+  const raw_tld_dnskey_sig = readChainFile(
+    data_path,
+    names[1] + '-DNSKEY-SIG.dat',
   );
   ret['tld_ksk_len'] = raw_tld_ksk.length;
   if (tld_alg == 8) {
@@ -122,21 +149,15 @@ exports.makeInput = function(
     );
   }
 
-  const raw_sld_ds_rec = fs.readFileSync(
-    path.join(data_path, names[0] + '-DS-REC.dat'),
-  );
-  const raw_sld_ds_key = fs.readFileSync(
-    path.join(data_path, names[0] + '-DS-KEY.dat'),
-  );
+  const raw_sld_ds_rec = readChainFile(data_path, names[0] + '-DS-REC.dat');
+  const raw_sld_ds_key = readChainFile(data_path, names[0] + '-DS-KEY.dat');
   const sld_ds_recwpad = sha256pad(raw_sld_ds_rec);
   ret['sld_ds_prev_hash_bits'] = tobitsarr(
     sha256withoutpad(sld_ds_recwpad.slice(0, -128)),
   );
   ret['sld_ds_rec_suffix'] = rightPadArrayTo(sld_ds_recwpad.slice(-128), 128);
   ret['sld_ds_hash_offset'] = parseDSForOffset(sld_ds_recwpad);
-  const raw_sld_ds_sig = fs.readFileSync(
-    path.join(data_path, names[0] + '-DS-SIG.dat'),
-  );
+  const raw_sld_ds_sig = readChainFile(data_path, names[0] + '-DS-SIG.dat');
   if (tld_alg == 8) {
     ret['sld_ds_key'] = rightPadArrayTo(raw_sld_ds_key, MAX_RSA_KEY_LEN);
     ret['sld_ds_key_len'] = raw_sld_ds_key.length;
@@ -153,9 +174,7 @@ exports.makeInput = function(
     );
   }
 
-  const raw_sld_ksk = fs.readFileSync(
-    path.join(data_path, names[0] + '-DNSKEY-KSK.dat'),
-  );
+  const raw_sld_ksk = readChainFile(data_path, names[0] + '-DNSKEY-KSK.dat');
   if (sld_alg == 8) {
     ret['sld_ksk'] = rightPadArrayTo(
       raw_sld_ksk,
@@ -168,8 +187,9 @@ exports.makeInput = function(
   }
   if (managed) {
     // add managed inputs (SLD DNSKEY and SLD TXT suffix, like DS)
-    const raw_sld_dnskey_rec = fs.readFileSync(
-      path.join(data_path, names[0] + '-DNSKEY-REC.dat'),
+    const raw_sld_dnskey_rec = readChainFile(
+      data_path,
+      names[0] + '-DNSKEY-REC.dat',
     );
     if (sld_alg == 8) {
       ret['sld_dnskey_rec'] = rightPadArrayTo(
@@ -183,8 +203,9 @@ exports.makeInput = function(
       );
     }
     ret['sld_dnskey_rec_len'] = raw_sld_dnskey_rec.length;
-    const raw_sld_dnskey_sig = fs.readFileSync(
-      path.join(data_path, names[0] + '-DNSKEY-SIG.dat'),
+    const raw_sld_dnskey_sig = readChainFile(
+      data_path,
+      names[0] + '-DNSKEY-SIG.dat',
     );
     if (sld_alg == 8) {
       ret['sld_dnskey_sig'] = leftPadArrayTo(
@@ -202,12 +223,8 @@ exports.makeInput = function(
       );
     }
 
-    const raw_sld_txt_rec = fs.readFileSync(
-      path.join(data_path, names[0] + '-TXT-REC.dat'),
-    );
-    const raw_sld_txt_key = fs.readFileSync(
-      path.join(data_path, names[0] + '-TXT-KEY.dat'),
-    );
+    const raw_sld_txt_rec = readChainFile(data_path, names[0] + '-TXT-REC.dat');
+    const raw_sld_txt_key = readChainFile(data_path, names[0] + '-TXT-KEY.dat');
     const sld_txt_recwpad = sha256pad(raw_sld_txt_rec);
     ret['sld_txt_prev_hash_bits'] = tobitsarr(
       sha256withoutpad(sld_txt_recwpad.slice(0, -64)),
@@ -218,9 +235,7 @@ exports.makeInput = function(
       ret['sld_txt_rec_suffix'].slice(5, 48),
       43,
     );
-    const raw_sld_txt_sig = fs.readFileSync(
-      path.join(data_path, names[0] + '-TXT-SIG.dat'),
-    );
+    const raw_sld_txt_sig = readChainFile(data_path, names[0] + '-TXT-SIG.dat');
     if (sld_alg == 8) {
       ret['sld_txt_key'] = rightPadArrayTo(raw_sld_txt_key, MAX_RSA_KEY_LEN);
       ret['sld_txt_key_len'] = raw_sld_txt_key.length;
@@ -234,16 +249,18 @@ exports.makeInput = function(
     }
   } else {
     if (sld_alg == 8) {
-      const raw_sld_factors = fs.readFileSync(
-        path.join(data_path, names[0] + '-DNSKEY-KSK-factors.dat'),
+      const raw_sld_factors = readChainFile(
+        data_path,
+        names[0] + '-DNSKEY-KSK-factors.dat',
       );
       ret['sld_ksk_factors'] = [
         raw_sld_factors.toJSON().data.slice(0, 128),
         raw_sld_factors.toJSON().data.slice(128, 256),
       ];
     } else if (sld_alg == 13) {
-      const raw_cst = fs.readFileSync(
-        path.join(data_path, names[0] + '-DNSKEY-KSK-dlog.dat'),
+      const raw_cst = readChainFile(
+        data_path,
+        names[0] + '-DNSKEY-KSK-dlog.dat',
       );
       const raw_pinfo = proofOfECCKey(raw_cst);
       ret["sld_ksk_priv_k"] = raw_pinfo.k;
@@ -0,0 +1,133 @@
+import base64
+import asyncio
+import dns.exception
+import dns.message
+import dns.rcode
+import dns.rrset
+import pytest
+
+import dnschain
+import dnsreplay
+import dnstransport
+
+# dnstransport.Transport against a local dnsreplay.py responder
+#
+#   python3 -m pytest test_dnstransport.py
+#
+# (run from circuits/test/)
+
+# answers slower than the transport timeout
+SLOW = 10
+
+class DelayedResponder(dnsreplay.Responder):
+  def __init__(self, path, delays):
+    super().__init__(path)
+    # seconds to wait before answering, by query name
+    self.delays = delays
+
+  async def answer(self, request, udp):
+    await asyncio.sleep(self.delays.get(request.question[0].name.to_text(), 0))
+    return await super().answer(request, udp)
+
+def record(responder, name, rrtype, *rdatas):
+  request = dns.message.make_query(name, rrtype, want_dnssec=True)
+  response = dns.message.make_response(request)
+  response.answer.append(dns.rrset.from_text(name, 300, "IN", rrtype, *rdatas))
+  responder.answers[responder.key(request)] = base64.b64encode(response.to_wire(max_size=65535)).decode("ascii")
+
+def make_responder(tmp_path):
+  responder = DelayedResponder(str(tmp_path / "answers.json"), {"slow.example.": SLOW, "first.example.": 0.3})
+  record(responder, "small.example.", "A", "192.0.2.1")
+  record(responder, "first.example.", "A", "192.0.2.2")
+  record(responder, "second.example.", "A", "192.0.2.3")
+  record(responder, "slow.example.", "A", "192.0.2.4")
+  # well over the 1232 byte EDNS buffer of the queries, truncated over UDP
+  record(responder, "large.example.", "TXT", *('"' + str(i) * 250 + '"' for i in range(8)))
+  return responder
+
+# start the responder on a free port, run test(port) and stop it
+def serve(tmp_path, test):
+  async def main():
+    responder = make_responder(tmp_path)
+    loop = asyncio.get_running_loop()
+    tcp = await asyncio.start_server(dnsreplay.tcp_handler(responder), "127.0.0.1", 0)
+    port = tcp.sockets[0].getsockname()[1]
+    udp, _ = await loop.create_datagram_endpoint(lambda: dnsreplay.UDPServer(responder), local_addr=("127.0.0.1", port))
+    try:
+      return await test(port)
+    finally:
+      udp.close()
+      tcp.close()
+  return asyncio.run(main())
+
+def query(name, rrtype = "A"):
+  return dns.message.make_query(name, rrtype, want_dnssec=True)
+
+def answer(response):
+  return [rdata.to_text() for rdata in response.answer[0]]
+
+def test_udp(tmp_path):
+  async def test(port):
+    transport = dnstransport.Transport("127.0.0.1", port)
+    response = await transport.query_async(query("small.example."))
+    transport.close()
+    assert answer(response) == ["192.0.2.1"]
+    assert [proto for _, _, proto, _ in transport.latencies] == ["udp"]
+  serve(tmp_path, test)
+
+def test_truncated_falls_back_to_tcp(tmp_path):
+  async def test(port):
+    transport = dnstransport.Transport("127.0.0.1", port)
+    response = await transport.query_async(query("large.example.", "TXT"))
+    transport.close()
+    assert len(answer(response)) == 8
+    assert transport.truncated == 1
+    assert [proto for _, _, proto, _ in transport.latencies] == ["tcp"]
+  serve(tmp_path, test)
+
+def test_pipelined_answers_out_of_order(tmp_path):
+  async def test(port):
+    transport = dnstransport.Transport("127.0.0.1", port, use_tcp=True)
+    first = asyncio.ensure_future(transport.query_async(query("first.example.")))
+    second = asyncio.ensure_future(transport.query_async(query("second.example.")))
+    done, _ = await asyncio.wait([first, second], return_when=asyncio.FIRST_COMPLETED)
+    # the second answer is back while the first query is still waiting for its own
+    assert done == {second}
+    assert answer(await first) == ["192.0.2.2"]
+    assert answer(await second) == ["192.0.2.3"]
+    assert transport.pipeline.pending == {}
+    transport.close()
+  serve(tmp_path, test)
+
+def test_tcp_timeout(tmp_path):
+  async def test(port):
+    transport = dnstransport.Transport("127.0.0.1", port, use_tcp=True, timeout=0.5)
+    with pytest.raises(dns.exception.Timeout):
+      await transport.query_async(query("slow.example."))
+    # the abandoned query does not hold on to its id
+    assert transport.pipeline.pending == {}
+    assert transport.timeouts == 1
+    transport.close()
+  serve(tmp_path, test)
+
+def test_prefetch_drops_only_the_timed_out_query(tmp_path):
+  async def test(port):
+    fetcher = dnschain.Fetcher(dnstransport.Transport("127.0.0.1", port, use_tcp=True, timeout=0.5))
+    return await fetcher.prefetch([("small.example.", "A"), ("slow.example.", "A")])
+  responses = serve(tmp_path, test)
+  assert answer(responses[("small.example.", "A")]) == ["192.0.2.1"]
+  assert isinstance(responses[("slow.example.", "A")], dnschain.ChainError)
+
+class FailingUpstream:
+  async def query_async(self, request):
+    raise dns.exception.Timeout()
+
+def test_record_upstream_failure(tmp_path):
+  responder = dnsreplay.Responder(str(tmp_path / "answers.json"), upstream=FailingUpstream())
+  request = query("small.example.")
+  response = dns.message.from_wire(asyncio.run(responder.answer(request, False)))
+  assert response.id == request.id
+  assert response.rcode() == dns.rcode.SERVFAIL
+  # a failure is not replayed later
+  assert responder.answers == {}
+  assert responder.failed == 1
@@ -8,6 +8,9 @@ import re
 import subprocess
 import os
 
+# chain containers are read with sscripts/chainpack.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "sscripts"))
+
 # convert asn1parse line to tuple
 # e.g. '  0:d=0  hl=4 l= 290 cons: SEQUENCE' -> (0, 0, 4, 290, 'SEQUENCE')
 def parseline(line):
@@ -20,11 +23,25 @@ def parseline(line):
           "length": int(vals[3]),
           "tl": int(vals[2]) + int(vals[3])}
 
+# subject public key and signature algorithms, RSA or ECDSA
+KEY_ALGORITHMS = ("rsaEncryption", "id-ecPublicKey")
+SIGNATURE_ALGORITHMS = ("sha256WithRSAEncryption", "sha384WithRSAEncryption", "ecdsa-with-SHA256", "ecdsa-with-SHA384")
+
 def scanFor(arr, name, i):
   while i < len(arr) and arr[i]["name"] != name:
     i += 1
   return i
 
+def scanForDepth(arr, depth, i):
+  while i < len(arr) and arr[i]["depth"] != depth:
+    i += 1
+  return i
+
+def scanForAny(arr, names, i):
+  while i < len(arr) and arr[i]["name"] not in names:
+    i += 1
+  return i
+
 # get parsed certificate
 def callasn1parse(filename):
   # check if file exists
@@ -92,12 +109,17 @@ def get_folder_size(folder):
 if __name__ == '__main__':
   # check args
   if len(sys.argv) < 4:
-    print('Usage: python cert.py <nope.pem> <dv.pem> <intermediate.pem> [dnssec chain data folder path (optional)]')
+    print('Usage: python cert.py <nope.pem> <dv.pem> <intermediate.pem> [dnssec chain data folder or container path (optional)]')
     sys.exit(1)
   # list of results for benchmark
   results = {}
   # if dnssec chain data folder path is provided, get size
-  if len(sys.argv) == 5:
+  if len(sys.argv) == 5 and os.path.isfile(sys.argv[4]):
+    # a single chain container, its index already has every size
+    from chainpack import ChainFile
+    with ChainFile(sys.argv[4]) as chain:
+      results["DNSSEC"] = chain.payload_size()
+  elif len(sys.argv) == 5:
     results["DNSSEC"] = get_folder_size(sys.argv[4])
   else:
     # else call dns-fetch.sh to get DNSSEC-chain size
@@ -115,7 +137,7 @@ if __name__ == '__main__':
   # scan for...
   i = scanFor(client, "commonName", 0)
   results["SubjectName"] = client[i - 2]["tl"]
-  i = scanFor(client, "rsaEncryption", i)
+  i = scanForAny(client, KEY_ALGORITHMS, i)
   results["SubjectKey"] = client[i - 2]["tl"]
   i = scanFor(client, "cont [ 3 ]", i)
   results["Extensions"] = client[i]["tl"]
@@ -128,8 +150,9 @@ if __name__ == '__main__':
   results["NOPERAW"] = 128
   i = scanFor(client, "CT Precertificate SCTs", i)
   results["SCTs"] = client[i - 1]["tl"]
-  i = scanFor(client, "sha256WithRSAEncryption", i)
-  results["Signature"] = client[i - 2]["tl"]
+  i = scanForAny(client, SIGNATURE_ALGORITHMS, i)
+  # the signature algorithm after the TBS certificate, then the signature itself
+  results["Signature"] = client[i - 1]["tl"] + client[scanForDepth(client, 1, i)]["tl"]
   # get other fields
   results["Other"] = results["Extensions"] - results["AuthorityInfoAccess"] - results["SCTs"]
   results["Metadata"] = results["SubscriberCert"] - results["SubjectName"] - results["SubjectKey"] - results["Extensions"] - results["Signature"]
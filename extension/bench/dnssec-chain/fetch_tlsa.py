@@ -1,123 +1,41 @@
 import sys
 import os
-import dns.query
-import dns.dnssec
+import argparse
 
-# format a domain name from a string to a wire format
-def wire_fmt(domain):
-  if domain.endswith('.'):
-    domain = domain[:-1]
-  labels = domain.split('.')
-  return b''.join(bytes([len(label)]) + label.encode('ascii') for label in labels) + b'\x00'
+# the chain fetch, record cache and transport are shared with sscripts/fetchmin.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "sscripts"))
+import dnscache
+import dnstransport
+import dnschain
 
-# get the key with the given tag from the rrset
-def get_keyrr(rrset, tag):
-  # find key with tag and print
-  for rr in rrset:
-    if tag == dns.dnssec.key_id(rr):
-      return rr
-  # otherwise error out
-  print("Could not find key with tag", tag)
-  exit(1)
-
-# get the key signing key and format it for verification
-def get_ksk_and_fmt(rrset, tag, domain):
-  rr = get_keyrr(rrset, tag)
-  print(domain, rr.flags, rr.protocol, rr.algorithm)
-  print(len(wire_fmt(domain)))
-  return wire_fmt(domain) + \
-         rr.flags.to_bytes(2, byteorder="big") + \
-         rr.protocol.to_bytes(1, byteorder="big") + \
-         rr.algorithm.to_bytes(1, byteorder="big") + \
-         rr.key
-
-# make a DNS query for a domain and record type
-# return the rrset + rrsig
-def make_request(domain, record_type):
-  # get properly formatted domain name and make DNS query
-  name = dns.name.from_text(domain)
-  request = dns.message.make_query(name, record_type, want_dnssec=True)
-  response = dns.query.udp(request, "8.8.8.8")
-  # ensure correct number/format of answers
-  if len(response.answer) < 2 or (response.answer[1].rdtype != dns.rdatatype.RRSIG):
-    print(domain, "does not have an RRSIG record", response.answer)
-    exit(1)
-  elif len(response.answer[1]) > 2:
-    print(domain, "has too many RRSIG records")
-    exit(1)
-  # return the rrset + rrsig
-  return {"rrset": response.answer[0], "rrsig": response.answer[1][0]}
-
-# bit of a hack, works for us with a linear domain sig structure
-def get_par_domain(domain):
-  count = domain.count(".");
-  if count == 1:
-    return "."
-  elif count > 1:
-    return domain[domain.find(".") + 1:]
-  else:
-    print("Invalid domain name", domain)
-    exit(1)
-
-# write binary data to file in data/
-# based on domain, rrtype, and modifier
-def to_file(domain, rrtype, modifier, data):
-  filename = "data/" + domain + "-" + rrtype + "-" + modifier + ".dat"
-  print("Writing", filename)
-  with open(filename, "wb") as f:
-    f.write(data)
-
-def gather_info(domain, is_leaf = False):
-  print("Gathering info for", domain)
-  # if leaf, request TLSA rrset and rrsig
-  if is_leaf:
-    tlsa = make_request(domain, "TLSA")
-    sdomain = tlsa["rrsig"].signer.to_text()
-    print("leaf", sdomain)
-    
-    # always request DNSKEY rrset and rrsig
-    dnskey = make_request(sdomain, "DNSKEY")
-    to_file(sdomain, "DNSKEY", "KSK", get_ksk_and_fmt(dnskey["rrset"], dnskey["rrsig"].key_tag, sdomain))
-    to_file(sdomain, "DNSKEY", "SIG", dnskey["rrsig"].signature)
-    to_file(sdomain, "DNSKEY", "REC", dns.dnssec._make_rrsig_signature_data(dnskey["rrset"], dnskey["rrsig"]))
-
-    to_file(domain, "TLSA", "KEY", get_keyrr(dnskey["rrset"], tlsa["rrsig"].key_tag).key)
-    to_file(domain, "TLSA", "SIG", tlsa["rrsig"].signature)
-    to_file(domain, "TLSA", "REC", dns.dnssec._make_rrsig_signature_data(tlsa["rrset"], tlsa["rrsig"]))
-    domain = sdomain
-  else:
-    dnskey = make_request(domain, "DNSKEY")
-    to_file(domain, "DNSKEY", "KSK", get_ksk_and_fmt(dnskey["rrset"], dnskey["rrsig"].key_tag, domain))
-    to_file(domain, "DNSKEY", "SIG", dnskey["rrsig"].signature)
-    to_file(domain, "DNSKEY", "REC", dns.dnssec._make_rrsig_signature_data(dnskey["rrset"], dnskey["rrsig"]))
-
-
-  # if not root, request DS rrset and rrsig and recurse
-  if domain != ".":
-    ds = make_request(domain, "DS")
-    par_domain = get_par_domain(domain)
-    par_dnskey = gather_info(par_domain)
-    to_file(domain, "DS", "KEY", get_keyrr(par_dnskey["rrset"], ds["rrsig"].key_tag).key)
-    to_file(domain, "DS", "SIG", ds["rrsig"].signature)
-    to_file(domain, "DS", "REC", dns.dnssec._make_rrsig_signature_data(ds["rrset"], ds["rrsig"]))
-  # return the DNSKEY rrset for DS verification one level down
-  return dnskey
+# command line front end of dnschain.Fetcher.fetch_tlsa
 
 if __name__ == '__main__':
-  # if no arg provided print usage
-  if len(sys.argv) != 2:
-    print("Usage:", sys.argv[0] ,"<domain>")
-    print("Ex:", sys.argv[0] ,"proton.me")
-    sys.exit(1)
-  # otherwise get domain and record type from args
-  domain = sys.argv[1]
+  parser = argparse.ArgumentParser(description="Fetch the TLSA DNSSEC chain of a domain into data/", epilog="Ex: " + sys.argv[0] + " _443._tcp.proton.me")
+  parser.add_argument("domain", help="TLSA owner name to fetch the chain for")
+  parser.add_argument("--resolver", default="8.8.8.8", help="resolver to query, host or host:port (default: %(default)s)")
+  parser.add_argument("--cache", default=dnscache.DEFAULT_PATH, help="record cache file (default: %(default)s)")
+  parser.add_argument("--no-cache", action="store_true", help="always query, don't read or write the cache")
+  parser.add_argument("--cache-leaves", action="store_true", help="cache the records of the leaf domains too, not only the root and TLDs")
+  args = parser.parse_args()
+  transport = dnstransport.Transport(*dnstransport.parse_resolver(args.resolver))
+  cache = None if args.no_cache else dnscache.RecordCache(args.cache, args.cache_leaves)
+  fetcher = dnschain.Fetcher(transport, cache)
+  # get domain from args
+  domain = args.domain
   # if domain doesn't end in a period, add it
   if domain[-1] != ".":
     domain += "."
-  # if data folder doesn't exist, create it
-  if not os.path.exists("data"):
-    os.makedirs("data")
   # and iteratively fetch DNS info for proving domain ownership
-  gather_info(domain, True)
-
-
+  try:
+    chain = fetcher.fetch_tlsa(domain)
+  except dnschain.ChainError as e:
+    print(e)
+    sys.exit(1)
+  for path in chain.write("data", algs=False):
+    print("Writing", path)
+  fetcher.close()
+  print(transport.stats())
+  if cache:
+    cache.save()
+    print(cache.stats())
@@ -11,6 +11,13 @@ FILEEXTS=(".r1cs" ".params" "-vk.json")
 SRC_PATH="../bin"
 SCRIPT_PATH="../scripts"
 
+# TLS key of the benchmark, KEY_TYPE=p256 for ECDSA P-256 instead of RSA 2048
+KEY_TYPE=${KEY_TYPE:-rsa2048}
+DOMAIN_KEY="$SRC_PATH/domain$([ "$KEY_TYPE" == "p256" ] && echo "-p256" || true).key"
+
+source $SCRIPT_PATH/workspace.sh
+source $SCRIPT_PATH/trace.sh
+
 # create dat directory if it doesn't exist
 mkdir -p dat
 
@@ -34,7 +41,7 @@ check_files () {
 }
 
 # One iteration
-# with test data
+# with test data, intermediate files go to the workspace WORK
 prove () {
     MODE=$1
     DOMAIN=$2
@@ -57,26 +64,32 @@ prove () {
     SUBFOLDER="${FIRST_PART}-${SECOND_PART}"
     
     # {time ls;} > >(tee -a tlog) 2> >(tee -a tlog)
-    openssl rsa -in $SRC_PATH/domain.key -pubout -out $SRC_PATH/${DOMAIN}.pub 2>/dev/null
+    span pubkey openssl pkey -in $DOMAIN_KEY -pubout -out $WORK/${DOMAIN}.pub 2>/dev/null
     # TODO: update hash
-    PUB_DIGEST=$(python3 $SCRIPT_PATH/hash_pub.py $SRC_PATH/${DOMAIN}.pub)
-    node $SCRIPT_PATH/make_input.js -d $DOMAIN -t $TLDALG -s $SLDALG -m $MAN -g $PUB_DIGEST -p sdata/$SUBFOLDER
-    $SRC_PATH/${MODE}_cpp/$MODE $SRC_PATH/${MODE}_input.json $SRC_PATH/$MODE.wtns
-    zkutil prove -c $SRC_PATH/$MODE.r1cs -p $SRC_PATH/$MODE.params -r $SRC_PATH/${MODE}_proof.json -o $SRC_PATH/${MODE}_public.json -w $SRC_PATH/$MODE.wtns 
+    PUB_DIGEST=$(span hash python3 $SCRIPT_PATH/hash_pub.py $WORK/${DOMAIN}.pub)
+    span input node $SCRIPT_PATH/make_input.js -d $DOMAIN -t $TLDALG -s $SLDALG -m $MAN -g $PUB_DIGEST -p sdata/$SUBFOLDER -o $WORK
+    # make_input.js names the input after the domain when given a folder
+    INPUT="$WORK/${DOMAIN}$([ "$MAN" == "1" ] && echo "-man" || true)_input.json"
+    span witness $SRC_PATH/${MODE}_cpp/$MODE $INPUT $WORK/$MODE.wtns
+    span prove zkutil prove -c $SRC_PATH/$MODE.r1cs -p $SRC_PATH/$MODE.params -r $WORK/proof.json -o $WORK/public.json -w $WORK/$MODE.wtns
     # calcualte circuite type
     TYPE=$(( ($TLDALG == 13 ? 1 : 0) * 4 + ($SLDALG == 13 ? 1 : 0) * 2 + ($MAN == 1 ? 1 : 0) ))
     # we know there is only one SAN for test data
-    SAN=$(python3 $SCRIPT_PATH/compress.py $SRC_PATH/${MODE}_proof.json $TYPE $DOMAIN)
-    openssl req -new -nodes -out "$SRC_PATH/$DOMAIN.csr" -key "$SRC_PATH/domain.key" -subj "/CN=$DOMAIN" -addext "subjectAltName = DNS:$DOMAIN, DNS:$SAN" 
+    SAN=$(span compress python3 $SCRIPT_PATH/compress.py $WORK/proof.json $TYPE $DOMAIN)
+    span csr openssl req -new -nodes -out "$WORK/$DOMAIN.csr" -key "$DOMAIN_KEY" -subj "/CN=$DOMAIN" -addext "subjectAltName = DNS:$DOMAIN, DNS:$SAN"
 }
 
 # Assumes the prover has already fetched inputs
 # **and** compiled the witness generator
 # Running on test data
 benchmark () {
-  if [ ! -f "$SRC_PATH/domain.key" ]; then
+  if [ ! -f "$DOMAIN_KEY" ]; then
     echo "Key Generation"
-    openssl genrsa -out $SRC_PATH/domain.key 2048 
+    if [ "$KEY_TYPE" == "p256" ]; then
+      openssl ecparam -name prime256v1 -genkey -noout -out $DOMAIN_KEY
+    else
+      openssl genrsa -out $DOMAIN_KEY 2048
+    fi
   fi
   if [ $? -ne 0 ]; then
     echo "Error generating domain key"
@@ -116,13 +129,26 @@ benchmark () {
 
   LOGFILE="dat/$MODE.log"
   > $LOGFILE
+  # per-stage spans, aggregated by parse.py
+  TRACE="dat/$MODE.trace.jsonl"
+  > $TRACE
 
+  # one workspace per mode, so benches of different modes can run at once
+  WORK=$(make_workspace)
   for k in $(seq 1 $ITER); do
     echo "iteration $k out of $ITER"
+    TRACE_RUN=$k
     { time prove $MODE $DOMAIN $TLDALG $SLDALG $MAN; } 2> >(tee -a $LOGFILE)
   done
+  # keep the last proof and CSR of the mode
+  if [ -f "$WORK/$DOMAIN.csr" ]; then
+    promote $WORK/proof.json dat/${MODE}_proof.json $WORK/$DOMAIN.csr dat/${MODE}.csr
+  fi
+  remove_workspace $WORK
 
   echo "Log saved to $MODE.log"
+  # tagged with this host and commit, compare with python3 results.py check
+  python3 results.py ingest $LOGFILE $TRACE
 }
 
 check_files
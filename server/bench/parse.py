@@ -1,5 +1,7 @@
 import os
 import re
+import sys
+import json
 
 # Function to convert 'real' time from the format 'XmYs' to seconds
 def convert_to_seconds(real_time):
@@ -34,7 +36,62 @@ def process_logs(dat_folder):
                 name = filename.split('.')[0]
                 print(f"{k} iterations of {name}: {average_time:.2f} seconds")
 
+# Nearest-rank percentile of a sorted list
+def percentile(values, p):
+    return values[min(len(values) - 1, max(0, -(-len(values) * p // 100) - 1))]
+
+# Function to read the spans of a trace file written by bench.sh (see scripts/trace.py)
+def parse_trace_file(filepath):
+    spans = []
+    with open(filepath, 'r') as file:
+        for line in file:
+            if line.strip():
+                spans.append(json.loads(line))
+    return spans
+
+# Function to print per-stage percentiles of the spans of one trace
+# the total of a run is the sum of its stages
+def summarize_spans(name, spans):
+    stages = {}
+    totals = {}
+    failed = 0
+    for span in spans:
+        if span.get('code', 0) != 0:
+            failed += 1
+            continue
+        stages.setdefault(span['stage'], []).append(span)
+        total = totals.setdefault(span.get('run', ''), {'wall': 0, 'cpu': 0, 'peak_rss': 0})
+        total['wall'] += span['wall']
+        total['cpu'] += span.get('cpu', 0)
+        total['peak_rss'] = max(total['peak_rss'], span.get('peak_rss', 0))
+    stages['total'] = list(totals.values())
+    print(f"{len(totals)} runs of {name}" + (f" ({failed} failed stages left out)" if failed else "") + ":")
+    print(f"  {'stage':<10} {'n':>4} {'p50 s':>9} {'p90 s':>9} {'p99 s':>9} {'max s':>9} {'cpu s':>9} {'peak RSS MB':>12}")
+    for stage, stage_spans in stages.items():
+        walls = sorted(span['wall'] for span in stage_spans)
+        if not walls:
+            continue
+        cpu = sum(span.get('cpu', 0) for span in stage_spans) / len(stage_spans)
+        rss = max(span.get('peak_rss', 0) for span in stage_spans) / (1 << 20)
+        print(f"  {stage:<10} {len(walls):>4} {percentile(walls, 50):>9.3f} {percentile(walls, 90):>9.3f} "
+              f"{percentile(walls, 99):>9.3f} {walls[-1]:>9.3f} {cpu:>9.3f} {rss:>12.1f}")
+
+# Function to process all trace files in the dat folder
+def process_traces(dat_folder):
+    for filename in sorted(os.listdir(dat_folder)):
+        if filename.endswith('.trace.jsonl'):
+            spans = parse_trace_file(os.path.join(dat_folder, filename))
+            if spans:
+                summarize_spans(filename[:-len('.trace.jsonl')], spans)
+
 # Main execution
+# python3 parse.py [trace.jsonl ...]
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # traces given on the command line, e.g. from TRACE=... ./server.sh
+        for filepath in sys.argv[1:]:
+            summarize_spans(os.path.basename(filepath), parse_trace_file(filepath))
+        sys.exit(0)
     dat_folder = './dat'  # Replace with your actual dat folder path
     process_logs(dat_folder)
+    process_traces(dat_folder)
@@ -0,0 +1,433 @@
+import os
+import re
+import sys
+import json
+import math
+import socket
+import sqlite3
+import hashlib
+import argparse
+import platform
+import subprocess
+
+from parse import parse_log_file, parse_trace_file
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.join(BENCH_PATH, "..", "..")
+
+# the phases of app.py --time_it and the circom log parser
+sys.path.insert(0, os.path.join(BENCH_PATH, "..", "scripts"))
+sys.path.insert(0, os.path.join(REPO_PATH, "circuits", "bench"))
+from summarize import ACME_INITIATION, DNS_PROPAGATION, ACME_VERIFICATION
+from tochart import extract_info
+
+# Results store of every benchmark, with regression checks against a baseline
+#
+#   python3 results.py ingest dat                     (bench.sh logs and traces, app.py .dat files, circom logs)
+#   python3 results.py baseline                       (the runs of this commit on this host become the baseline)
+#   python3 results.py check                          (exit 1 if a metric got significantly worse)
+#   python3 results.py summary [--metric PATTERN]
+#
+# each ingested file is a run, tagged with the host and the git commit, and
+# holds samples of metrics, all of them lower is better:
+#   trace/<mode>/<stage>        seconds of a stage of bench.sh or server.sh (and total, peak_rss in bytes)
+#   bench/<mode>/real           seconds of a bench.sh iteration, from the bash time lines
+#   acme/<event>                seconds of an app.py --time_it event, and acme/initiation, propagation, verification
+#   circuit/<name>/constraints  non-linear constraints of a circuit, from the log of circuits/bench/count.sh
+# prev_result.txt, the per-stage means kept by hand before, goes in as trace/<mode>/<stage>
+#
+# a metric is summarized by its median and a distribution-free confidence
+# interval of the median (order statistics); it regressed when the interval of
+# the new runs lies above the baseline's and the median grew by more than
+# --threshold. with fewer than 6 samples a 95% interval does not exist and the
+# interval is the whole range of the samples
+
+DEFAULT_DB = os.path.join(BENCH_PATH, "dat", "results.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    path TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    label TEXT,
+    host TEXT NOT NULL,
+    host_info TEXT,
+    git_commit TEXT NOT NULL,
+    dirty INTEGER NOT NULL,
+    time REAL NOT NULL,
+    UNIQUE (sha256, host, git_commit)
+);
+CREATE TABLE IF NOT EXISTS samples (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    metric TEXT NOT NULL,
+    value REAL NOT NULL,
+    unit TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_metric ON samples (metric);
+CREATE TABLE IF NOT EXISTS baselines (
+    name TEXT NOT NULL,
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    PRIMARY KEY (name, run_id)
+);
+"""
+
+# stage names of prev_result.txt, as bench.sh traces them
+PREV_STAGES = {"Get Pub Key": "pubkey", "Hash Pub Key": "hash", "Build Input": "input",
+               "Generate Witness": "witness", "Prove": "prove", "Verify": "verify",
+               "Compress Proof": "compress", "CSR Generation": "csr", "Total": "total"}
+# e.g. "100 iterations dove-ecdsa-ecdsa-man.log:", where dove is the host
+PREV_HEADER = re.compile(r"^\d+ iterations (?:(?P<host>[\w.]+)-)?(?P<mode>(?:rsa|ecdsa)-(?:rsa|ecdsa)(?:-man)?)\.log:$")
+
+
+def host_info():
+    info = {"hostname": socket.gethostname(), "platform": platform.platform(),
+            "python": platform.python_version(), "cpus": os.cpu_count()}
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    info["cpu"] = line.split(":", 1)[1].strip()
+                    break
+        with open("/proc/meminfo", "r") as f:
+            info["memory_gb"] = round(int(f.readline().split()[1]) / (1 << 20), 1)
+    except (OSError, IndexError, ValueError):
+        pass
+    return info
+
+
+# (commit, whether the tree has uncommitted changes), or ("unknown", 0) outside of git
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "-C", REPO_PATH, "rev-parse", "HEAD"], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+        status = subprocess.run(["git", "-C", REPO_PATH, "status", "--porcelain", "--untracked-files=no"],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+        return commit, int(bool(status.strip()))
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", 0
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Functions to read each kind of result file as (metric, value, unit) samples
+
+def trace_samples(path):
+    samples = []
+    totals = {}
+    for span in parse_trace_file(path):
+        if span.get("code", 0) != 0:
+            continue
+        mode = span.get("mode") or os.path.basename(path)[:-len(".trace.jsonl")]
+        samples.append((f"trace/{mode}/{span['stage']}", span["wall"], "s"))
+        total = totals.setdefault((mode, span.get("run", "")), {"wall": 0, "peak_rss": 0})
+        total["wall"] += span["wall"]
+        total["peak_rss"] = max(total["peak_rss"], span.get("peak_rss", 0))
+    for (mode, _), total in totals.items():
+        samples.append((f"trace/{mode}/total", total["wall"], "s"))
+        samples.append((f"trace/{mode}/peak_rss", total["peak_rss"], "B"))
+    return samples
+
+
+def bench_log_samples(path):
+    mode = os.path.basename(path).split(".")[0]
+    return [(f"bench/{mode}/real", seconds, "s") for seconds in parse_log_file(path)]
+
+
+# "<event> took <seconds> seconds", after the line naming the order
+DAT_LINE = re.compile(r"^(\S+) took (\S+) seconds$")
+
+
+def dat_samples(path):
+    with open(path, "r", errors="replace") as f:
+        matches = [DAT_LINE.match(line.strip()) for line in f]
+    # other .dat files, e.g. the KSK material of a data folder, have no events
+    times = {m.group(1): float(m.group(2)) for m in matches if m}
+    samples = [(f"acme/{event}", seconds, "s") for event, seconds in times.items()]
+    for phase, events in (("initiation", ACME_INITIATION), ("propagation", DNS_PROPAGATION),
+                          ("verification", ACME_VERIFICATION)):
+        if any(e in times for e in events):
+            samples.append((f"acme/{phase}", sum(times.get(e, 0) for e in events), "s"))
+    return samples
+
+
+def circom_samples(text):
+    return [(f"circuit/{name}/constraints", count, "constraints") for name, count in extract_info(text).items()]
+
+
+# samples and the host named in the file, if any
+def prev_samples(text):
+    samples = []
+    host = None
+    mode = None
+    for line in text.splitlines():
+        match = PREV_HEADER.match(line.strip())
+        if match:
+            mode = match.group("mode")
+            host = match.group("host") or host
+        elif mode and ":" in line:
+            stage, value = line.rsplit(":", 1)
+            if stage.strip() in PREV_STAGES:
+                samples.append((f"trace/{mode}/{PREV_STAGES[stage.strip()]}", float(value.strip().rstrip("s")), "s"))
+    return samples, host
+
+
+# (source, samples, host named in the file or None) of a result file, or None if it holds no results
+def read_results(path):
+    if path.endswith(".trace.jsonl"):
+        return "trace", trace_samples(path), None
+    if path.endswith(".dat"):
+        samples = dat_samples(path)
+        return ("acme", samples, None) if samples else None
+    if not path.endswith((".log", ".txt")):
+        return None
+    with open(path, "r", errors="replace") as f:
+        text = f.read()
+    if "non-linear constraints" in text:
+        return "circom", circom_samples(text), None
+    if any(PREV_HEADER.match(line.strip()) for line in text.splitlines()):
+        samples, host = prev_samples(text)
+        return "prev", samples, host
+    if re.search(r"^real\s", text, re.MULTILINE):
+        return "bench", bench_log_samples(path), None
+    return None
+
+
+class ResultsStore:
+    def __init__(self, path=DEFAULT_DB):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(SCHEMA)
+
+    # store the results of a file as one run, return its number of samples
+    # (None if the file was stored before for this host and commit)
+    def ingest(self, path, host, info, commit, dirty, label=None):
+        results = read_results(path)
+        if results is None:
+            return 0
+        source, samples, file_host = results
+        host = file_host or host
+        try:
+            with self.db:
+                cur = self.db.execute(
+                    "INSERT INTO runs (source, path, sha256, label, host, host_info, git_commit, dirty, time) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (source, os.path.abspath(path), file_sha256(path), label, host, json.dumps(info), commit, dirty,
+                     os.path.getmtime(path)))
+                self.db.executemany("INSERT INTO samples (run_id, metric, value, unit) VALUES (?, ?, ?, ?)",
+                                    [(cur.lastrowid, metric, value, unit) for metric, value, unit in samples])
+        except sqlite3.IntegrityError:
+            return None
+        return len(samples)
+
+    # ids of the runs matching every given filter
+    def runs(self, commit=None, host=None, label=None):
+        query = "SELECT id FROM runs WHERE 1"
+        params = []
+        for column, value in (("git_commit", commit), ("host", host), ("label", label)):
+            if value is not None:
+                if column == "git_commit":
+                    # a prefix of the commit is enough
+                    query += " AND git_commit LIKE ?"
+                    value += "%"
+                else:
+                    query += f" AND {column} = ?"
+                params.append(value)
+        return [row[0] for row in self.db.execute(query, params)]
+
+    def baseline_runs(self, name):
+        return [row[0] for row in self.db.execute("SELECT run_id FROM baselines WHERE name = ?", (name,))]
+
+    def set_baseline(self, name, run_ids):
+        with self.db:
+            self.db.execute("DELETE FROM baselines WHERE name = ?", (name,))
+            self.db.executemany("INSERT INTO baselines (name, run_id) VALUES (?, ?)", [(name, i) for i in run_ids])
+
+    def hosts(self, run_ids):
+        return sorted({row[0] for row in self.query_runs("SELECT DISTINCT host FROM runs WHERE id IN ({})", run_ids)})
+
+    # {metric: ([values], unit)} of some runs
+    def samples(self, run_ids, pattern=None):
+        metrics = {}
+        for metric, value, unit in self.query_runs("SELECT metric, value, unit FROM samples WHERE run_id IN ({})", run_ids):
+            if pattern is None or re.search(pattern, metric):
+                metrics.setdefault(metric, ([], unit))[0].append(value)
+        return metrics
+
+    def query_runs(self, query, run_ids):
+        rows = []
+        # SQLite limits the number of parameters of a statement
+        for i in range(0, len(run_ids), 500):
+            chunk = run_ids[i:i + 500]
+            rows += self.db.execute(query.format(",".join("?" * len(chunk))), chunk).fetchall()
+        return rows
+
+    def close(self):
+        self.db.close()
+
+
+def median(values):
+    x = sorted(values)
+    n = len(x)
+    return x[n // 2] if n % 2 else (x[n // 2 - 1] + x[n // 2]) / 2
+
+
+# confidence interval of the median: the k-th smallest and largest samples,
+# with k the largest count for which P(Binomial(n, 1/2) < k) stays within (1 - confidence) / 2
+def median_ci(values, confidence=0.95):
+    x = sorted(values)
+    n = len(x)
+    tail = (1 - confidence) / 2
+    cdf = 0
+    k = 0
+    while k < n:
+        p = math.comb(n, k) / 2 ** n
+        if cdf + p > tail:
+            break
+        cdf += p
+        k += 1
+    if k == 0:
+        return x[0], x[-1]
+    return x[k - 1], x[n - k]
+
+
+# "regression", "improvement" or "same" of new samples against baseline samples
+def compare(base, new, confidence=0.95, threshold=0.05):
+    base_low, base_high = median_ci(base, confidence)
+    new_low, new_high = median_ci(new, confidence)
+    base_median = median(base)
+    new_median = median(new)
+    if new_low > base_high and new_median > base_median * (1 + threshold):
+        return "regression"
+    if new_high < base_low and new_median < base_median * (1 - threshold):
+        return "improvement"
+    return "same"
+
+
+def format_value(value, unit):
+    if unit == "B":
+        return f"{value / (1 << 20):.1f} MB"
+    if unit == "s":
+        return f"{value:.3f} s"
+    return f"{value:.0f}"
+
+
+def print_summary(metrics, confidence):
+    print(f"{'metric':<40} {'n':>5} {'median':>14} {'CI low':>14} {'CI high':>14}")
+    for metric in sorted(metrics):
+        values, unit = metrics[metric]
+        low, high = median_ci(values, confidence)
+        print(f"{metric:<40} {len(values):>5} {format_value(median(values), unit):>14} "
+              f"{format_value(low, unit):>14} {format_value(high, unit):>14}")
+
+
+# print every metric of the new runs against the baseline, return the regressed ones
+def check(base_metrics, new_metrics, confidence, threshold):
+    regressions = []
+    print(f"{'metric':<40} {'base':>14} {'new':>14} {'change':>8}  result")
+    for metric in sorted(set(base_metrics) | set(new_metrics)):
+        if metric not in base_metrics:
+            values, unit = new_metrics[metric]
+            print(f"{metric:<40} {'-':>14} {format_value(median(values), unit):>14} {'':>8}  not in the baseline")
+            continue
+        if metric not in new_metrics:
+            values, unit = base_metrics[metric]
+            print(f"{metric:<40} {format_value(median(values), unit):>14} {'-':>14} {'':>8}  not measured")
+            continue
+        base, unit = base_metrics[metric]
+        new = new_metrics[metric][0]
+        result = compare(base, new, confidence, threshold)
+        change = (median(new) / median(base) - 1) * 100 if median(base) else 0
+        print(f"{metric:<40} {format_value(median(base), unit):>14} {format_value(median(new), unit):>14} "
+              f"{change:>+7.1f}%  {result}")
+        if result == "regression":
+            regressions.append(metric)
+    return regressions
+
+
+def expand(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files += [os.path.join(root, name) for name in sorted(names)]
+        else:
+            files.append(path)
+    return files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Store benchmark results and check them against a baseline")
+    parser.add_argument("--db", default=DEFAULT_DB, help="results database (default: %(default)s)")
+    parser.add_argument("--confidence", type=float, default=0.95, help="confidence of the median intervals (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest = commands.add_parser("ingest", help="store result files (folders are searched)")
+    ingest.add_argument("paths", nargs="+", help="bench.sh .log/.trace.jsonl, app.py .dat, circom logs or prev_result.txt")
+    ingest.add_argument("--label", help="label of the runs, e.g. the version being tried")
+    for name, text in (("summary", "median and confidence interval of each metric"),
+                       ("baseline", "make runs the baseline"),
+                       ("check", "compare runs with the baseline, exit 1 on a regression")):
+        cmd = commands.add_parser(name, help=text)
+        cmd.add_argument("--label", help="only the runs with this label")
+        cmd.add_argument("--metric", help="only the metrics matching this regular expression")
+        if name in ("baseline", "check"):
+            cmd.add_argument("--name", default="default", help="name of the baseline (default: %(default)s)")
+        if name == "check":
+            cmd.add_argument("--threshold", type=float, default=0.05,
+                             help="smallest relative growth of the median that counts as a regression (default: %(default)s)")
+    for cmd in commands.choices.values():
+        cmd.add_argument("--commit", help="commit of the runs (default: the current commit)")
+        cmd.add_argument("--host", help="host of the runs (default: this host)")
+    args = parser.parse_args()
+
+    commit, dirty = git_commit()
+    commit = args.commit or commit
+    host = args.host or socket.gethostname()
+    try:
+        store = ResultsStore(args.db)
+        if args.command == "ingest":
+            info = host_info()
+            for path in expand(args.paths):
+                count = store.ingest(path, host, info, commit, dirty, args.label)
+                if count is None:
+                    print(f"Skipping {path}, stored before")
+                elif count:
+                    print(f"Stored {count} samples of {path}")
+            sys.exit(0)
+        # the label alone picks runs of any commit and host, e.g. the ones of prev_result.txt
+        run_ids = store.runs(None if args.label and not args.commit else commit,
+                             None if args.label and not args.host else host, args.label)
+        if args.command == "summary":
+            if not run_ids:
+                raise ValueError(f"no runs of {commit[:12]} on {host}")
+            print_summary(store.samples(run_ids, args.metric), args.confidence)
+        elif args.command == "baseline":
+            if not run_ids:
+                raise ValueError(f"no runs of {commit[:12]} on {host}")
+            store.set_baseline(args.name, run_ids)
+            print(f"Baseline {args.name} is {len(run_ids)} runs of {', '.join(store.hosts(run_ids))}")
+        else:
+            base_ids = store.baseline_runs(args.name)
+            if not base_ids:
+                raise ValueError(f"no baseline {args.name}, set one with: results.py baseline")
+            if not run_ids:
+                raise ValueError(f"no runs of {commit[:12]} on {host}")
+            if store.hosts(base_ids) != store.hosts(run_ids):
+                print(f"Note: the baseline ran on {', '.join(store.hosts(base_ids))}, "
+                      f"these runs on {', '.join(store.hosts(run_ids))}")
+            regressions = check(store.samples(base_ids, args.metric), store.samples(run_ids, args.metric),
+                                args.confidence, args.threshold)
+            if regressions:
+                print(f"{len(regressions)} metrics regressed: {', '.join(regressions)}")
+                sys.exit(1)
+            print("No regressions")
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print("Error:", e, file=sys.stderr)
+        sys.exit(1)
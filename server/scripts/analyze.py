@@ -1,53 +1,32 @@
 import sys
 import os
-import dns.query
+import json
+import argparse
+import zipfile
 import dns.dnssec
+import dns.name
+import dns.rrset
+import dns.zone
+import dns.rdtypes.ANY.RRSIG
+import dns.rdtypes.ANY.TXT
+import dns.rdataclass
+import dns.rdatatype
+
+# the chain fetch, transport, cache and chain container are shared with sscripts/fetchmin.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "sscripts"))
+import dnstransport
+import dnscache
+import dnschain
+import chainpack
+
+# how queries reach the resolver
+fetcher = dnschain.Fetcher()
 
 # Analyze how much padding we need for a TXT record
 
-def domain_to_wire(domain):
-  """Convert a domain name to DNS wire format."""
-  # dns.name.Name.to_wire() for RFC compliant 
-  # https://dnspython.readthedocs.io/en/latest/_modules/dns/name.html#Name.to_wire
-
-  # if just a dot, return null byte
-  if domain == '.':
-    return b'\x00'
-
-  # Remove the trailing dot if it's present
-  if domain.endswith('.'):
-    domain = domain[:-1]
-  
-  # Split the domain into labels and prepend each label with its length
-  labels = domain.split('.')
-  wire_format = b''.join(
-    bytes([len(label)]) + label.encode('ascii') for label in labels
-  )
-  
-  # Append a null byte to indicate the end of the domain name
-  wire_format += b'\x00'
-  # print(wire_format) 
-  return wire_format
-
-# make a DNS query for a domain and record type
-# return the rrset + rrsig
+# the TXT rrset + rrsig of a domain, None if it has no TXT records
 def make_request(domain, record_type):
-  # get properly formatted domain name and make DNS query
-  name = dns.name.from_text(domain)
-  request = dns.message.make_query(name, record_type, want_dnssec=True)
-  response = dns.query.udp(request, "8.8.8.8")
-  # ensure correct number/format of answers
-  if len(response.answer) == 0:
-      # no existing txt record
-      return None
-  if len(response.answer) < 2 or (response.answer[1].rdtype != dns.rdatatype.RRSIG):
-    print(domain, "does not have an RRSIG record")
-    exit(1)
-  elif len(response.answer[1]) > 2:
-    print(domain, "has too many RRSIG records")
-    exit(1)
-  # return the rrset + rrsig
-  return {"rrset": response.answer[0], "rrsig": response.answer[1][0]}
+  return fetcher.lookup(domain, record_type, allow_empty=True)
 
 def analyze_txt(domain):
   txt = make_request(domain, "TXT")
@@ -55,27 +34,145 @@ def analyze_txt(domain):
       #print('no existing TXT records')
     print('=' * (64 - calc_header(domain) % 64), end='')
     return
-  rrset_dat = dns.dnssec._make_rrsig_signature_data(txt["rrset"], txt["rrsig"])
+  rrset_dat = dnschain.signature_data(txt)
   #print('existing TXT records rrset', len(rrset_dat))
   print('=' * (64 - len(rrset_dat) % 64), end='')
 
 # hard coded, see fetch.py
 def calc_header(name):
-  return 29 + 2 * len(domain_to_wire(name))
+  return 29 + 2 * len(dnschain.wire_fmt(name))
+
+# padding for a TXT rrset whose signed data is length bytes long,
+# or for a domain without TXT records if length is None
+def padding(domain, length):
+  if length is None:
+    return 64 - calc_header(domain) % 64
+  return 64 - length % 64
+
+# length of the signed data of a TXT rrset that isn't signed yet
+# the RRSIG fields have a fixed size, so a placeholder RRSIG gives the same length
+def unsigned_rrset_len(rrset):
+  name = rrset.name
+  rrsig = dns.rdtypes.ANY.RRSIG.RRSIG(dns.rdataclass.IN, dns.rdatatype.RRSIG, dns.rdatatype.TXT,
+                                      dns.dnssec.Algorithm.ECDSAP256SHA256, len(name) - 1, rrset.ttl,
+                                      0, 0, 0, name, b'')
+  return len(dns.dnssec._make_rrsig_signature_data(rrset, rrsig))
+
+# the sources below return the signed data length of the TXT rrset of a domain,
+# None if the domain has no TXT records
+
+def live_len(domain):
+  txt = make_request(domain, "TXT")
+  if not txt:
+    return None
+  return len(dnschain.signature_data(txt))
+
+# from the record cache of fetchmin.py, without touching the network
+def cache_len(cache, domain):
+  response = cache.get(domain, "TXT")
+  if response is None:
+    raise KeyError(domain + " TXT is not in the cache")
+  txt = dnschain.check_response(domain, "TXT", response, allow_empty=True)
+  if not txt:
+    return None
+  return len(dnschain.signature_data(txt))
+
+# from the TXT-REC.dat written by fetchmin.py, in a data folder,
+# a batch archive or a chain container
+def archive_len(path, domain):
+  name = domain + "-TXT-REC.dat"
+  if os.path.isdir(path):
+    if not os.path.exists(os.path.join(path, name)):
+      raise KeyError(name + " not found in " + path)
+    return os.path.getsize(os.path.join(path, name))
+  if zipfile.is_zipfile(path):
+    with zipfile.ZipFile(path) as z:
+      return z.getinfo(name).file_size
+  with chainpack.ChainFile(path) as chain:
+    return chain.index[name][1]
+
+# from a zone file, before the zone is signed
+def zone_len(zone, domain):
+  rdataset = zone.get_rdataset(domain, "TXT")
+  if rdataset is None:
+    return None
+  return unsigned_rrset_len(dns.rrset.from_rdata_list(domain, rdataset.ttl, list(rdataset)))
+
+# a TXT record holding text as is, split in character-strings of at most 255 bytes
+def txt_rdata(text):
+  raw = text.encode("utf-8")
+  chunks = [raw[i:i + 255] for i in range(0, len(raw), 255)] or [b""]
+  return dns.rdtypes.ANY.TXT.TXT(dns.rdataclass.IN, dns.rdatatype.TXT, chunks)
+
+# for a proposed set of TXT strings
+def proposed_len(domain, texts, ttl):
+  if not texts:
+    return None
+  rrset = dns.rrset.from_rdata_list(dns.name.from_text(domain), ttl, [txt_rdata(t) for t in texts])
+  return unsigned_rrset_len(rrset)
 
 # we get the byte length of current txt rrset len
 if __name__ == '__main__':
-  # if no arg provided print usage
-  if len(sys.argv) == 1 or len(sys.argv) > 3:
-    print("Usage:", sys.argv[0] ,"<domain>")
-    print("Ex:", sys.argv[0] ,"proton.me")
-    sys.exit(1)
-  # otherwise get domain and record type from args
-  domain = sys.argv[1]
+  parser = argparse.ArgumentParser(description="Padding needed for the TXT records of NOPE-managed domains", epilog="Ex: " + sys.argv[0] + " proton.me")
+  parser.add_argument("domains", nargs="*", help="domains to analyze")
+  parser.add_argument("-f", "--domain-file", help="file with one domain per line")
+  source = parser.add_mutually_exclusive_group()
+  source.add_argument("--cache", nargs="?", const=dnscache.DEFAULT_PATH, help="use the fetchmin record cache (default file: %(const)s)")
+  source.add_argument("--archive", help="use a data folder, batch archive or chain container from fetchmin")
+  source.add_argument("--zone", help="use a zone file (unsigned records are fine)")
+  source.add_argument("--propose", action="append", metavar="TXT", help="predict for this TXT string (repeat for several records)")
+  parser.add_argument("--resolver", default="8.8.8.8", help="resolver for live queries, host or host:port (default: %(default)s)")
+  parser.add_argument("--ttl", type=int, default=300, help="TTL of the proposed records (default: %(default)s)")
+  parser.add_argument("--json", action="store_true", help="print a JSON object with one entry per domain")
+  args = parser.parse_args()
+  fetcher = dnschain.Fetcher(dnstransport.Transport(*dnstransport.parse_resolver(args.resolver)))
+  domains = list(args.domains)
+  if args.domain_file:
+    with open(args.domain_file, "r") as f:
+      domains += [line.strip() for line in f if line.strip() and not line.startswith("#")]
+  if not domains:
+    parser.error("no domains given")
   # if domain doesn't end in a period, add it
-  if domain[-1] != ".":
-    domain += "."
-  analyze_txt(domain)
+  domains = [d if d[-1] == "." else d + "." for d in domains]
+
+  # old behaviour: one live domain, print the padding itself
+  if len(domains) == 1 and not args.json and not (args.cache or args.archive or args.zone or args.propose):
+    try:
+      analyze_txt(domains[0])
+    except dnschain.ChainError as e:
+      print(e)
+      sys.exit(1)
+    sys.exit(0)
+
+  if args.cache:
+    # TXT records are only in the cache if fetchmin.py ran with --cache-leaves
+    cache = dnscache.RecordCache(args.cache, leaves=True)
+    lookup, kind = lambda d: cache_len(cache, d), "cache"
+  elif args.archive:
+    lookup, kind = lambda d: archive_len(args.archive, d), "archive"
+  elif args.zone:
+    zone = dns.zone.from_file(args.zone, relativize=False)
+    lookup, kind = lambda d: zone_len(zone, d), "zone"
+  elif args.propose:
+    lookup, kind = lambda d: proposed_len(d, args.propose, args.ttl), "proposed"
+  else:
+    lookup, kind = live_len, "live"
+
+  results = {}
+  for domain in domains:
+    try:
+      length = lookup(domain)
+    except (KeyError, ValueError, dnschain.ChainError) as e:
+      results[domain] = {"source": kind, "error": str(e).strip("'\"")}
+      continue
+    results[domain] = {"source": kind, "rrset_len": length, "padding": padding(domain, length)}
+  if args.json:
+    print(json.dumps(results, indent=1))
+  else:
+    for domain, result in results.items():
+      print(domain, result.get("padding", result.get("error")))
+  if any("error" in result for result in results.values()):
+    sys.exit(1)
 
 # dove=[43 char]
 # 48
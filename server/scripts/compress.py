@@ -3,11 +3,28 @@
 # usage: python compress.py <proof_file> <circuit_type> <domain_name>
 
 # circuit_type: [TLD uses ECDSA] | [SLD uses ECDSA] | [is mangaged]
+#
+# to compress many proofs in one process:
+#   python compress.py batch <jobs.jsonl | ->
+#   python compress.py batch <circuit_type> <proof_file> <domain_name> [<proof_file> <domain_name> ...]
+# each line of jobs.jsonl is {"proof": <proof file or proof object>, "type": <circuit_type>, "domain": <domain_name>}
+# and one JSON line per proof is printed, with the SAN names or an error
+#
+# to compare batch throughput with one process per proof:
+#   python compress.py bench <proof_file> [iterations]
 
 import sys
 import os
 import time
 import json
+import subprocess
+
+# gmpy2 is used for the field arithmetic if it is installed,
+# its modular exponentiation is a few times faster than pow on 256 bit numbers
+try:
+  import gmpy2
+except ImportError:
+  gmpy2 = None
 
 top = 2 ** 256 - 1
 p = 21888242871839275222246405745257275088696311157297823662689037894645226208583
@@ -19,32 +36,45 @@ constant_1_2 = 0x183227397098d014dc2822db40c0ac2ecbc0b548b438e5469e10460b6c3e7ea
 constant_27_82 = 0x2b149d40ceb8aaae81be18991be06ac3b5b4c5e559dbefa33267e6dc24a138e5
 constant_3_82 = 0x2fcd3ac2a640a154eb23960892a85a68f031ca0c8344b23a577dcf1052b9e775
 
+# use gmpy2 (if installed) or plain Python integers, return the backend name
+def set_backend(fast = True):
+  global powmod, mpz, inverse
+  if fast and gmpy2 is not None:
+    powmod, mpz = gmpy2.powmod, gmpy2.mpz
+    inverse = lambda x: gmpy2.invert(x, p)
+    return "gmpy2"
+  powmod, mpz = pow, int
+  inverse = lambda x: pow(x, -1, p)
+  return "int"
+
+set_backend()
+
 def Fsqrt(x):
-  return pow(x, (p + 1) // 4, p)
+  return powmod(x, p_e_sqrt, p)
 
 def F2sqrt(a0, a1, h):
-  d = Fsqrt(pow(a0, 2, p) + pow(a1, 2, p))
+  d = Fsqrt(a0 * a0 + a1 * a1)
   if h:
     d = p - d
   x0 = Fsqrt(((a0 + d) * constant_1_2) % p)
-  x1 = (a1 * pow(2 * x0, -1, p)) % p
+  x1 = (a1 * inverse(2 * x0)) % p
   return x0, x1
 
-def L1(x, y):
-  ty = Fsqrt(pow(x, 3, p) + 3)
+# the square root based compression, kept as the reference for L1 and L2
+def L1_sqrt(x, y):
+  ty = Fsqrt(powmod(x, 3, p) + 3)
   if y == ty:
     return x
   elif y == p - ty:
     return top - x
   else:
-    print("Error: Error compressing G1 point")
-    exit(1)
+    raise ValueError("Error compressing G1 point")
 
 # based on https://github.com/recmo/evm-groth16/blob/main/src/Verifier.sol
-def L2(x0, x1, y0, y1):
+def L2_sqrt(x0, x1, y0, y1):
   n3ab = (-3 * x0 * x1) % p
-  a3 = pow(x0, 3, p)
-  b3 = pow(x1, 3, p)
+  a3 = powmod(x0, 3, p)
+  b3 = powmod(x1, 3, p)
   tx0 = (constant_27_82 + a3 + n3ab * x1) % p
   tx1 = p - ((constant_3_82 + b3 + n3ab * x0) % p)
   ty0, ty1 = F2sqrt(tx0, tx1, False)
@@ -58,8 +88,51 @@ def L2(x0, x1, y0, y1):
   elif y0 == p - ny0:
     return top - x0, top - x1
   else:
-    print("Error: Error compressing G2 point")
-    exit(1)  
+    raise ValueError("Error compressing G2 point")
+
+# Legendre symbol of a mod p (Jacobi symbol algorithm, much cheaper than Euler's criterion)
+def legendre(a):
+  if gmpy2 is not None and powmod is not pow:
+    return gmpy2.jacobi(a, p)
+  a %= p
+  n = p
+  result = 1
+  while a:
+    while not a & 1:
+      a >>= 1
+      if n & 7 in (3, 5):
+        result = -result
+    a, n = n, a
+    if a & 3 == 3 and n & 3 == 3:
+      result = -result
+    a %= n
+  return result if n == 1 else 0
+
+# Fsqrt(y * y) is y ** ((p + 1) / 2) = y * legendre(y), so instead of taking
+# square roots to find which root y is, check that y is a root at all
+# and whether it is a square, same results as L1_sqrt and L2_sqrt
+def L1(x, y):
+  if y >= p or (y * y - powmod(x, 3, p) - 3) % p != 0:
+    raise ValueError("Error compressing G1 point")
+  if legendre(y) != -1:
+    return x
+  return top - x
+
+def L2(x0, x1, y0, y1):
+  n3ab = (-3 * x0 * x1) % p
+  a3 = powmod(x0, 3, p)
+  b3 = powmod(x1, 3, p)
+  tx0 = (constant_27_82 + a3 + n3ab * x1) % p
+  tx1 = p - ((constant_3_82 + b3 + n3ab * x0) % p)
+  # F2sqrt takes y0 as a root of (tx0 + d) / 2, or of (tx0 - d) / 2 when h is set
+  d = Fsqrt(tx0 * tx0 + tx1 * tx1)
+  y0_sq = (y0 * y0) % p
+  if y0 < p and y0_sq == ((tx0 + d) * constant_1_2) % p:
+    return (x0 if legendre(y0) != -1 else top - x0), x1
+  elif y0 < p and y0_sq == ((tx0 + p - d) * constant_1_2) % p:
+    return (x0 if legendre(y0) != -1 else top - x0), top - x1
+  else:
+    raise ValueError("Error compressing G2 point")
 
 # convert 128 byte integer to URI safe string
 def bits1024_to_URI(x):
@@ -76,35 +149,143 @@ def bits1024_to_URI(x):
   result[3] += alphabet[checksum]
   return result
 
+alphabet = "0123456789abcdefghijklmnopqrstuvwxyz-"
+# 37 ** 12 < 2 ** 63, so each chunk is a machine-sized integer
+chunk_digits = 12
+chunk_base = len(alphabet) ** chunk_digits
+
+# same as bits1024_to_URI, but with one big-int divmod per 12 digits
+# instead of one per digit
+def bits1024_to_URI_chunked(x):
+  digits = []
+  while len(digits) < 197:
+    x, chunk = divmod(x, chunk_base)
+    chunk = int(chunk)
+    for _ in range(chunk_digits):
+      chunk, tmp = divmod(chunk, 37)
+      digits.append(tmp)
+  digits = digits[:197]
+  checksum = sum(digits) % 37
+  s = "".join([alphabet[d] for d in digits])
+  # digit i goes to part (i + 2) // 50
+  return [s[:48], s[48:98], s[98:148], s[148:] + alphabet[checksum]]
+
 # if domain name doesn't start with a dot then add it
 def fmt_domain(domain_name):
   if domain_name[0] != ".":
     return "." + domain_name
   return domain_name
 
-def compress_proof(proof_file, circuit_type, domain_name):
-  with open(proof_file, 'r') as f:
-    proof = json.load(f)
-  pi_a = L1(int(proof['pi_a'][0]), int(proof['pi_a'][1]))
-  pi_b0, pi_b1 = L2(int(proof['pi_b'][0][0]), int(proof['pi_b'][0][1]),
-                    int(proof['pi_b'][1][0]), int(proof['pi_b'][1][1]))
-  pi_c = L1(int(proof['pi_c'][0]), int(proof['pi_c'][1]))
+# compress a proof (as loaded from the prover's proof.json) to URI safe strings
+# reference uses the square root based compression and per digit conversion
+def compress(proof, reference = False):
+  g1, g2 = (L1_sqrt, L2_sqrt) if reference else (L1, L2)
+  pi_a = g1(mpz(proof['pi_a'][0]), mpz(proof['pi_a'][1]))
+  pi_b0, pi_b1 = g2(mpz(proof['pi_b'][0][0]), mpz(proof['pi_b'][0][1]),
+                    mpz(proof['pi_b'][1][0]), mpz(proof['pi_b'][1][1]))
+  pi_c = g1(mpz(proof['pi_c'][0]), mpz(proof['pi_c'][1]))
   # convert compressed_proof to URI safe string
-  compressed_proof = bits1024_to_URI(pi_a + (pi_b0 << 256) + (pi_b1 << 512) + (pi_c << 768))
+  x = pi_a + (pi_b0 << 256) + (pi_b1 << 512) + (pi_c << 768)
+  return bits1024_to_URI(int(x)) if reference else bits1024_to_URI_chunked(x)
+
+# the SAN names for a compressed proof
+def san_names(compressed_proof, circuit_type, domain_name):
+  if circuit_type < 0 or circuit_type > 7:
+    raise ValueError("Circuit type must be a 3 bit number")
   domain = fmt_domain(domain_name)
   # if the length of the domain name is <= 29, format as single domain
   if len(domain) <= 29:
-    print("n0pe." + "0" + str(circuit_type) + compressed_proof[0] + "." + compressed_proof[1] + "." + compressed_proof[2] + "." + compressed_proof[3] + domain)
-  else:
-    print("n0pe." + "0" + str(circuit_type) + compressed_proof[0] + "." + compressed_proof[1] + domain)
-    print("n1pe." + compressed_proof[2] + "." + compressed_proof[3] + domain)
-  #print(compressed_proof_URI)
+    return ["n0pe." + "0" + str(circuit_type) + compressed_proof[0] + "." + compressed_proof[1] + "." + compressed_proof[2] + "." + compressed_proof[3] + domain]
+  return ["n0pe." + "0" + str(circuit_type) + compressed_proof[0] + "." + compressed_proof[1] + domain,
+          "n1pe." + compressed_proof[2] + "." + compressed_proof[3] + domain]
+
+def compress_proof(proof_file, circuit_type, domain_name):
+  with open(proof_file, 'r') as f:
+    proof = json.load(f)
+  for name in san_names(compress(proof), circuit_type, domain_name):
+    print(name)
+
+# compress every job, a dict with "proof" (file name or proof object), "type" and "domain"
+# yield one result per job with the SAN names, or the error that job failed with
+def compress_batch(jobs):
+  for job in jobs:
+    result = {"domain": job.get("domain"), "type": job.get("type")}
+    if isinstance(job.get("proof"), str):
+      result["proof"] = job["proof"]
+    try:
+      result["type"] = int(job["type"])
+      proof = job["proof"]
+      if isinstance(proof, str):
+        with open(proof, 'r') as f:
+          proof = json.load(f)
+      result["san"] = san_names(compress(proof), result["type"], job["domain"])
+    except (OSError, KeyError, TypeError, ValueError) as e:
+      result["error"] = str(e)
+    yield result
+
+def read_jobs(path):
+  f = sys.stdin if path == "-" else open(path, 'r')
+  try:
+    for line in f:
+      if line.strip():
+        yield json.loads(line)
+  finally:
+    if f is not sys.stdin:
+      f.close()
+
+# proofs per second for one process per proof (the server.sh path),
+# the reference code in process, and batch mode
+def bench(proof_file, iterations):
+  with open(proof_file, 'r') as f:
+    proof_text = f.read()
+  rows = []
+  runs = min(iterations, 20)
+  start = time.perf_counter()
+  for _ in range(runs):
+    subprocess.run([sys.executable, os.path.abspath(__file__), proof_file, "0", "nope-tools.org"], check=True, stdout=subprocess.DEVNULL)
+  rows.append(("process per proof", runs, time.perf_counter() - start))
+  set_backend(False)
+  start = time.perf_counter()
+  for _ in range(iterations):
+    expected = san_names(compress(json.loads(proof_text), reference=True), 0, "nope-tools.org")
+  rows.append(("in process, sqrt + bits1024_to_URI", iterations, time.perf_counter() - start))
+  backend = set_backend(True)
+  jobs = [{"proof": json.loads(proof_text), "type": 0, "domain": "nope-tools.org"} for _ in range(iterations)]
+  start = time.perf_counter()
+  for result in compress_batch(jobs):
+    if result.get("san") != expected:
+      raise ValueError(result.get("error", "batch and reference results differ"))
+  rows.append(("batch, " + backend + " + legendre + chunked base-37", iterations, time.perf_counter() - start))
+  print('\t'.join(['path', 'proofs', 'proofs/s', 'ms/proof']))
+  for label, n, secs in rows:
+    print('\t'.join([label, str(n), '{0:.1f}'.format(n / secs), '{0:.3f}'.format(1000 * secs / n)]))
+
+def usage():
+  print("Usage: python compress.py <proof_file> <circuit_type> <domain_name>")
+  print("       python compress.py batch <jobs.jsonl | ->")
+  print("       python compress.py batch <circuit_type> <proof_file> <domain_name> [<proof_file> <domain_name> ...]")
+  print("       python compress.py bench <proof_file> [iterations]")
+  print("circuit_type is a 3 bit number representing the circuit type")
+  sys.exit(1)
 
 if __name__ == '__main__':
+  if len(sys.argv) >= 3 and sys.argv[1] == "batch":
+    if len(sys.argv) == 3:
+      jobs = read_jobs(sys.argv[2])
+    elif len(sys.argv) % 2 == 1:
+      jobs = [{"proof": f, "type": sys.argv[2], "domain": d} for f, d in zip(sys.argv[3::2], sys.argv[4::2])]
+    else:
+      usage()
+    failed = 0
+    for result in compress_batch(jobs):
+      failed += "error" in result
+      print(json.dumps(result), flush=True)
+    sys.exit(1 if failed else 0)
+  if len(sys.argv) in (3, 4) and sys.argv[1] == "bench":
+    bench(sys.argv[2], int(sys.argv[3]) if len(sys.argv) == 4 else 200)
+    sys.exit(0)
   if len(sys.argv) != 4:
-    print("Usage: python compress.py <proof_file> <circuit_type> <domain_name>")
-    print("circuit_type is a 3 bit number representing the circuit type")
-    sys.exit(1)
+    usage()
   proof_file = sys.argv[1]
   circuit_type = int(sys.argv[2])
   domain_name = sys.argv[3]
@@ -114,4 +295,8 @@ if __name__ == '__main__':
   if circuit_type < 0 or circuit_type > 7:
     print("Error: Circuit type must be a 3 bit number")
     sys.exit(1)
-  compress_proof(proof_file, circuit_type, domain_name)
+  try:
+    compress_proof(proof_file, circuit_type, domain_name)
+  except ValueError as e:
+    print("Error:", e)
+    sys.exit(1)
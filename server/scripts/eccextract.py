@@ -1,54 +1,30 @@
 # python3 script to extract the constant from a bind private key 
+# (server.sh uses keymat.py, which writes it to a per-domain file instead)
 
 import sys
-import os
-import re
-import base64
-import struct
-# ecc imports
-from ecpy.curves import Curve, Point
-from ecpy.keys import ECPublicKey
+import keymat
 
 def usage():
-  print("Usage: " + sys.argv[0] + " <keyfile>")
+  print("Usage: " + sys.argv[0] + " <keyfile> [output]")
   print("Ex. " + sys.argv[0] + " Kexample.com.+013+00000.private")
-  print("Output is is raw bytes, placed in tmp.dat")
+  print("Output is is raw bytes, placed in tmp.dat unless given")
   sys.exit(1)
 
-# extract PrivateKey from keyfile
-# decode base64 strings so everything is an integer
-def parse_bind_keyfile(keyfile):
-  with open(keyfile, 'r') as f:
-    for line in f:
-      if line.startswith("PrivateKey:"):
-        return base64.b64decode(line.split()[1])
-  # error if we didn't find the private key
-  print("Error: private key not found in " + keyfile)
-  sys.exit(1)
-
-def extract(keyfile):
-  key = parse_bind_keyfile(keyfile)
-  # debug print private key as big integer
-  k = int.from_bytes(key, byteorder='big')
-  print(k, len(key))
+def extract(keyfile, output = "tmp.dat"):
+  key = keymat.ecdsa_dlog(keymat.parse_bind_keyfile(keyfile))
   # debug print kG (NIST P-256), for checking that public key matches
-  #print(Curve.get_curve_names())
-  curve = Curve.get_curve('NIST-P256')
-  #print(curve)
-  generator = curve.generator
-  kG = k * generator
-  print(kG.x)
-  print(kG.y)
-
+  x, y = keymat.ecdsa_public_point(key)
+  print(x)
+  print(y)
   # first 32 bytes
-  with open("tmp.dat", 'wb') as f:
-    # write key
-    f.write(bytearray(32 - len(key)))
+  with open(output, 'wb') as f:
     f.write(key)
 
-
 if __name__ == "__main__":
-  if len(sys.argv) != 2:
+  if len(sys.argv) not in (2, 3):
     usage()
-  keyfile = sys.argv[1]
-  extract(keyfile)
\ No newline at end of file
+  try:
+    extract(*sys.argv[1:])
+  except ValueError as e:
+    print("Error:", e)
+    sys.exit(1)
@@ -1,51 +1,26 @@
 # python3 script to extract the factors from a bind private key
+# (server.sh uses keymat.py, which writes them to a per-domain file instead)
 
 import sys
-import os
-import re
-import base64
-import struct
+import keymat
 
 def usage():
-  print("Usage: " + sys.argv[0] + " <keyfile>")
-  print("Ex. " + sys.argv[0] + " Kexample.com.+013+00000.private")
-  print("Output is is raw bytes, placed in tmp.dat")
+  print("Usage: " + sys.argv[0] + " <keyfile> [output]")
+  print("Ex. " + sys.argv[0] + " Kexample.com.+008+00000.private")
+  print("Output is is raw bytes, placed in tmp.dat unless given")
   sys.exit(1)
 
-# extract modulus, public exponent, private exponent, prime1, prime2, exponent1, etc. from keyfile
-# decode base64 strings so everything is an integer
-def parse_bind_keyfile(keyfile):
-  key = {}
-  with open(keyfile, 'r') as f:
-    for line in f:
-      if line.startswith("Modulus:"):
-        key['modulus'] = base64.b64decode(line.split()[1])
-      elif line.startswith("Prime1:"):
-        key['prime1'] = base64.b64decode(line.split()[1])
-      elif line.startswith("Prime2:"):
-        key['prime2'] = base64.b64decode(line.split()[1])
-  return key
-
-def extract(keyfile):
-  key = parse_bind_keyfile(keyfile)
-  # debug print primes and modulus as big integers
-  p = int.from_bytes(key['prime1'], byteorder='big')
-  q = int.from_bytes(key['prime2'], byteorder='big')
-  m = int.from_bytes(key['modulus'], byteorder='big')
-  print(p * q - m, len(key['prime1']), len(key['prime2']), len(key['modulus']))
+def extract(keyfile, output = "tmp.dat"):
+  factors = keymat.rsa_factors(keymat.parse_bind_keyfile(keyfile))
   # first 128 bytes are the first prime and the next 128 bytes are the second prime
-  # primes are padded with 0x00 bytes to reach this length
-  with open("tmp.dat", 'wb') as f:
-    # pad first prime
-    f.write(bytearray(128 - len(key['prime1'])))
-    f.write(key['prime1'])
-    # pad second prime
-    f.write(bytearray(128 - len(key['prime2'])))
-    f.write(key['prime2'])
-
+  with open(output, 'wb') as f:
+    f.write(factors)
 
 if __name__ == "__main__":
-  if len(sys.argv) != 2:
+  if len(sys.argv) not in (2, 3):
     usage()
-  keyfile = sys.argv[1]
-  extract(keyfile)
\ No newline at end of file
+  try:
+    extract(*sys.argv[1:])
+  except ValueError as e:
+    print("Error:", e)
+    sys.exit(1)
@@ -0,0 +1,239 @@
+import sys
+import os
+import json
+import base64
+import hashlib
+import argparse
+import tempfile
+
+# key material for server.sh, in one process
+#
+# - the factors (RSA) or discrete log (ECDSA) of a BIND private KSK, written to
+#   [domain].-DNSKEY-KSK-factors.dat or [domain].-DNSKEY-KSK-dlog.dat in the data folder
+#   (what extract.py and eccextract.py write to tmp.dat)
+# - the SPKI digest of a TLS key, taken straight from the private key
+#   (what openssl pkey -pubout followed by hash_pub.py prints), RSA or ECDSA P-256
+#
+# results are cached by the hash of the key file, the cache only holds
+# digests and hashes, never key material
+
+# default location of the cache file
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "nope", "keymat.json")
+
+# length of each prime in the factors file and of the dlog file
+PRIME_LEN = 128
+DLOG_LEN = 32
+
+def file_hash(path):
+  with open(path, "rb") as f:
+    return hashlib.sha256(f.read()).hexdigest()
+
+# the fields of a BIND private key file, values still base64 encoded
+def parse_bind_keyfile(keyfile):
+  fields = {}
+  with open(keyfile, "r") as f:
+    for line in f:
+      name, sep, value = line.partition(":")
+      if sep:
+        fields[name.strip()] = value.strip()
+  return fields
+
+def bind_algorithm(fields):
+  if "Algorithm" not in fields:
+    raise ValueError("no Algorithm in BIND key file")
+  return int(fields["Algorithm"].split()[0])
+
+def bind_int(fields, name):
+  if name not in fields:
+    raise ValueError("no " + name + " in BIND key file")
+  return base64.b64decode(fields[name])
+
+# first 128 bytes are the first prime and the next 128 bytes are the second prime
+# primes are padded with 0x00 bytes to reach this length
+def rsa_factors(fields):
+  prime1 = bind_int(fields, "Prime1")
+  prime2 = bind_int(fields, "Prime2")
+  modulus = int.from_bytes(bind_int(fields, "Modulus"), byteorder="big")
+  if int.from_bytes(prime1, byteorder="big") * int.from_bytes(prime2, byteorder="big") != modulus:
+    raise ValueError("Prime1 * Prime2 is not the Modulus")
+  if len(prime1) > PRIME_LEN or len(prime2) > PRIME_LEN:
+    raise ValueError("RSA primes longer than " + str(PRIME_LEN) + " bytes are not supported")
+  return bytes(PRIME_LEN - len(prime1)) + prime1 + bytes(PRIME_LEN - len(prime2)) + prime2
+
+# the private key, padded to 32 bytes
+def ecdsa_dlog(fields):
+  key = bind_int(fields, "PrivateKey")
+  if len(key) > DLOG_LEN:
+    raise ValueError("ECDSA private key longer than " + str(DLOG_LEN) + " bytes")
+  return bytes(DLOG_LEN - len(key)) + key
+
+# the public point of an ECDSA P-256 private key, for checking it against the DNSKEY
+def ecdsa_public_point(dlog):
+  from cryptography.hazmat.primitives.asymmetric import ec
+  numbers = ec.derive_private_key(int.from_bytes(dlog, byteorder="big"), ec.SECP256R1()).public_key().public_numbers()
+  return numbers.x, numbers.y
+
+# return ("factors", bytes) for an RSA KSK or ("dlog", bytes) for an ECDSA P-256 KSK
+def bind_material(keyfile):
+  fields = parse_bind_keyfile(keyfile)
+  alg = bind_algorithm(fields)
+  if alg == 8:
+    return "factors", rsa_factors(fields)
+  if alg == 13:
+    return "dlog", ecdsa_dlog(fields)
+  raise ValueError("unsupported KSK algorithm " + str(alg))
+
+def material_path(data_path, domain, kind):
+  if domain[-1] != ".":
+    domain += "."
+  return os.path.join(data_path, domain + "-DNSKEY-KSK-" + kind + ".dat")
+
+# digest of a DER SubjectPublicKeyInfo, as the extension's subjectPublicKeyInfoDigest
+# the last character of the base64 encoding is always =, and left out
+def spki_digest_der(der):
+  return base64.b64encode(hashlib.sha256(der).digest()).decode()[:-1]
+
+# SPKI digest of a PEM private or public key (RSA or EC)
+def spki_digest(key_path):
+  from cryptography.hazmat.primitives import serialization
+  with open(key_path, "rb") as f:
+    pem = f.read()
+  if b"PRIVATE KEY" in pem:
+    public_key = serialization.load_pem_private_key(pem, password=None).public_key()
+  else:
+    public_key = serialization.load_pem_public_key(pem)
+  return spki_digest_der(public_key.public_bytes(
+    encoding=serialization.Encoding.DER,
+    format=serialization.PublicFormat.SubjectPublicKeyInfo
+  ))
+
+# write a new TLS key of a keypool.py kind, rsa2048 (what server.sh does with
+# openssl genrsa) or p256
+# the key appears whole or not at all: FileExistsError if key_path exists,
+# e.g. written by another job for the same domain in the meantime
+def generate_tls_key(key_path, kind = "rsa2048"):
+  from cryptography.hazmat.primitives import serialization
+  from keypool import generate_key
+  key = generate_key(kind)
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(key_path) or ".", prefix=os.path.basename(key_path) + ".", suffix=".tmp")
+  try:
+    with open(fd, "wb") as f:
+      f.write(key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+      ))
+    os.link(tmp, key_path)
+  finally:
+    os.unlink(tmp)
+
+class KeyCache:
+  def __init__(self, path = DEFAULT_PATH):
+    self.path = path
+    self.hits = 0
+    self.misses = 0
+    self.entries = {}
+    # a cache that can't be read (cut short, edited by hand) only costs its entries
+    try:
+      with open(path, "r") as f:
+        entries = json.load(f)
+      if isinstance(entries, dict):
+        self.entries = entries
+    except (OSError, ValueError):
+      pass
+
+  def get(self, key_hash):
+    entry = self.entries.get(key_hash)
+    if entry is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return entry
+
+  def put(self, key_hash, entry):
+    self.entries[key_hash] = entry
+
+  def save(self):
+    folder = os.path.dirname(self.path)
+    if folder and not os.path.exists(folder):
+      os.makedirs(folder)
+    # a temporary file of its own, as concurrent jobs save the same cache
+    fd, tmp = tempfile.mkstemp(dir=folder or ".", prefix=os.path.basename(self.path) + ".", suffix=".tmp")
+    try:
+      with open(fd, "w") as f:
+        json.dump(self.entries, f)
+      os.replace(tmp, self.path)
+    except BaseException:
+      os.unlink(tmp)
+      raise
+
+  def stats(self):
+    return "key cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses, " + str(len(self.entries)) + " entries"
+
+# SPKI digest of a TLS key, from the cache if the key file was seen before
+def tls_digest(key_path, cache = None):
+  key_hash = file_hash(key_path)
+  entry = cache.get(key_hash) if cache else None
+  if entry is None or "digest" not in entry:
+    entry = {"digest": spki_digest(key_path)}
+    if cache:
+      cache.put(key_hash, entry)
+  return entry["digest"]
+
+# write the factors or dlog file of a BIND KSK for domain into data_path
+# nothing is parsed or written if the same key already produced the file there
+# return the path of the file
+def write_bind_material(keyfile, data_path, domain, cache = None):
+  key_hash = file_hash(keyfile)
+  entry = cache.get(key_hash) if cache else None
+  if entry is not None and "kind" in entry:
+    path = material_path(data_path, domain, entry["kind"])
+    if os.path.exists(path) and file_hash(path) == entry["output"]:
+      return path
+  kind, data = bind_material(keyfile)
+  path = material_path(data_path, domain, kind)
+  if not os.path.exists(data_path):
+    os.makedirs(data_path)
+  # per domain, so concurrent jobs don't overwrite each other's output
+  tmp = path + "." + str(os.getpid()) + ".tmp"
+  with open(tmp, "wb") as f:
+    f.write(data)
+  os.replace(tmp, path)
+  if cache:
+    cache.put(key_hash, {"kind": kind, "output": hashlib.sha256(data).hexdigest()})
+  return path
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Key material for server.sh: SPKI digests of TLS keys and KSK factors/dlog files")
+  parser.add_argument("--cache", default=DEFAULT_PATH, help="cache file (default: %(default)s)")
+  parser.add_argument("--no-cache", action="store_true", help="don't read or write the cache")
+  commands = parser.add_subparsers(dest="command", required=True)
+  digest = commands.add_parser("digest", help="print the SPKI digest of a TLS key (PEM, private or public)")
+  digest.add_argument("key", help="TLS key file")
+  digest.add_argument("--ksk", help="also write the factors/dlog file of this BIND private key")
+  digest.add_argument("--data", help="data folder for --ksk")
+  digest.add_argument("--domain", help="domain of --ksk")
+  bind = commands.add_parser("bind", help="write the factors/dlog file of a BIND private key")
+  bind.add_argument("keyfile", help="BIND private key, e.g. Kexample.com.+013+00000.private")
+  bind.add_argument("data", help="data folder to write to")
+  bind.add_argument("domain", help="domain the key belongs to")
+  args = parser.parse_args()
+  cache = None if args.no_cache else KeyCache(args.cache)
+  try:
+    if args.command == "digest":
+      if args.ksk:
+        if not args.data or not args.domain:
+          parser.error("--ksk needs --data and --domain")
+        # stdout is the digest only, so that it can be captured
+        print("Writing", write_bind_material(args.ksk, args.data, args.domain, cache), file=sys.stderr)
+      print(tls_digest(args.key, cache))
+    else:
+      print("Writing", write_bind_material(args.keyfile, args.data, args.domain, cache))
+  except (OSError, ValueError) as e:
+    print("Error:", e, file=sys.stderr)
+    sys.exit(1)
+  if cache:
+    try:
+      cache.save()
+    except OSError as e:
+      print("Could not save the key cache:", e, file=sys.stderr)
@@ -0,0 +1,281 @@
+import sys
+import os
+import time
+import fcntl
+import secrets
+import argparse
+import subprocess
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+# pool of TLS keys generated ahead of time
+#
+# app.py and server.sh used to generate a 2048-bit RSA key when the domain had
+# none, inside key_csr_gen; they now claim one from this pool and the pool is
+# refilled in the background once it runs below its low-water mark
+#
+# keys are stored as <dir>/<kind>/ready/<id>.enc, the PEM that is handed out
+# (the format of openssl genrsa) encrypted with AES-GCM under a key derived (scrypt, salt in <dir>/salt) from
+# the passphrase of --passphrase-file or $NOPE_KEYPOOL_PASSPHRASE. the
+# derivation runs once per process and nothing is parsed, so taking a key out
+# costs microseconds rather than the ~70 ms of loading a passphrase-protected
+# PEM (key derivation and RSA key check) each time
+#
+# the passphrase is the operator's: the pool is not used until the file exists
+# (mode 0600) or the variable is set. it protects the keys waiting in the pool,
+# e.g. in backups of the cache folder; anyone who can read the passphrase file
+# can decrypt them, and a claimed key is written out in the clear like before
+#
+# claiming a key moves it to claimed/ and hands out the decrypted key. it
+# leaves the pool once a certificate is issued for it (consume); release only
+# puts back a key that never left the process that claimed it. app.py keeps a
+# claimed key in memory until then, server.sh writes it out and consumes it once
+# app.py succeeded (a key written out stays claimed if the order fails)
+#
+#   python3 scripts/keypool.py claim <key out>          (writes the key out and prints its id, or - if the pool was empty)
+#   python3 scripts/keypool.py consume <id> | release <id>
+#   python3 scripts/keypool.py refill [--target N] | ls
+#   python3 scripts/keypool.py bench [--iterations N]   (key and CSR generation time and sizes of each kind)
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "nope", "keys")
+DEFAULT_PASSPHRASE_FILE = os.path.join(os.path.expanduser("~"), ".config", "nope", "keypool.pass")
+
+# TLS key types; an ECDSA P-256 key makes the SPKI of the certificate about 200
+# bytes smaller and its signature by a Let's Encrypt ECDSA intermediate too
+KINDS = ("rsa2048", "p256")
+DEFAULT_KIND = "rsa2048"
+
+# claiming a key below LOW_WATER ready keys starts a refill up to HIGH_WATER
+LOW_WATER = 4
+HIGH_WATER = 16
+
+# scrypt cost of deriving the pool's encryption key from the passphrase
+SCRYPT_N = 1 << 14
+
+def generate_key(kind):
+  if kind == "rsa2048":
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+  if kind == "p256":
+    return ec.generate_private_key(ec.SECP256R1(), backend=default_backend())
+  raise ValueError("unknown key kind " + kind)
+
+# the format openssl genrsa (or openssl ecparam -genkey) and app.py wrote before the pool
+def key_pem(key):
+  return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                           serialization.NoEncryption())
+
+# the passphrase from the environment, else from its file (- for stdin)
+def load_passphrase(path = DEFAULT_PASSPHRASE_FILE):
+  if os.environ.get("NOPE_KEYPOOL_PASSPHRASE"):
+    return os.environ["NOPE_KEYPOOL_PASSPHRASE"].encode()
+  if path == "-":
+    passphrase = sys.stdin.readline().strip()
+  else:
+    if not os.path.exists(path):
+      raise ValueError("no key pool passphrase, set $NOPE_KEYPOOL_PASSPHRASE or create " + path +
+                       " (e.g. head -c 32 /dev/urandom | base64 > " + path + "; chmod 600 " + path + ")")
+    if os.stat(path).st_mode & 0o077:
+      raise ValueError(path + " is readable by other users, chmod 600 it")
+    with open(path, "r") as f:
+      passphrase = f.read().strip()
+  if not passphrase:
+    raise ValueError("the key pool passphrase is empty")
+  return passphrase.encode()
+
+class KeyPool:
+  def __init__(self, path = DEFAULT_PATH, kind = DEFAULT_KIND, passphrase = None, low_water = LOW_WATER, high_water = HIGH_WATER):
+    self.path = path
+    self.kind = kind
+    self.passphrase = passphrase if passphrase is not None else load_passphrase()
+    self.low_water = low_water
+    self.high_water = high_water
+    self.ready_path = os.path.join(path, kind, "ready")
+    self.claimed_path = os.path.join(path, kind, "claimed")
+    os.makedirs(self.ready_path, exist_ok=True)
+    os.makedirs(self.claimed_path, exist_ok=True)
+    self.aead = AESGCM(Scrypt(self.salt(), 32, SCRYPT_N, 8, 1, backend=default_backend()).derive(self.passphrase))
+
+  def salt(self):
+    path = os.path.join(self.path, "salt")
+    try:
+      fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+      with os.fdopen(fd, "wb") as f:
+        f.write(os.urandom(16))
+    except FileExistsError:
+      pass
+    with open(path, "rb") as f:
+      return f.read()
+
+  def ready(self):
+    # oldest first; keys claimed meanwhile by other threads or processes are left out
+    times = {}
+    for name in os.listdir(self.ready_path):
+      if name.endswith(".enc"):
+        try:
+          times[name] = os.path.getmtime(os.path.join(self.ready_path, name))
+        except FileNotFoundError:
+          pass
+    return sorted(times, key=times.get)
+
+  def claimed(self):
+    return sorted(name for name in os.listdir(self.claimed_path) if name.endswith(".enc"))
+
+  def add(self, key):
+    key_id = secrets.token_hex(8)
+    nonce = os.urandom(12)
+    # the id is authenticated too, so keys cannot be swapped between files
+    blob = nonce + self.aead.encrypt(nonce, key_pem(key), key_id.encode())
+    # a reader only ever sees complete keys
+    tmp = os.path.join(self.path, self.kind, key_id + ".tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+      f.write(blob)
+    os.rename(tmp, os.path.join(self.ready_path, key_id + ".enc"))
+    return key_id
+
+  def decrypt(self, path):
+    key_id = os.path.basename(path)[:-len(".enc")]
+    with open(path, "rb") as f:
+      blob = f.read()
+    return self.aead.decrypt(blob[:12], blob[12:], key_id.encode())
+
+  # (id, decrypted PEM) of the oldest ready key, or (None, new PEM) if the pool is empty
+  def claim(self):
+    # counting the key about to be taken
+    self.refill_in_background(taking = 1)
+    for name in self.ready():
+      claimed = os.path.join(self.claimed_path, name)
+      try:
+        # another process may claim the same key, only one rename succeeds
+        os.rename(os.path.join(self.ready_path, name), claimed)
+      except FileNotFoundError:
+        continue
+      os.utime(claimed)
+      try:
+        return name[:-len(".enc")], self.decrypt(claimed)
+      except InvalidTag:
+        # wrong passphrase, leave the key to whoever has the right one
+        os.rename(claimed, os.path.join(self.ready_path, name))
+        raise ValueError("could not decrypt the keys of " + self.ready_path + ", wrong passphrase?")
+    return None, key_pem(generate_key(self.kind))
+
+  def consume(self, key_id):
+    os.remove(os.path.join(self.claimed_path, key_id + ".enc"))
+
+  def release(self, key_id):
+    os.rename(os.path.join(self.claimed_path, key_id + ".enc"), os.path.join(self.ready_path, key_id + ".enc"))
+
+  # generate keys until target are ready, return how many were added
+  # (0 if another refill holds the lock)
+  def refill(self, target = None):
+    target = self.high_water if target is None else target
+    with open(os.path.join(self.path, self.kind, "refill.lock"), "w") as lock:
+      try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        return 0
+      added = 0
+      while len(self.ready()) < target:
+        self.add(generate_key(self.kind))
+        added += 1
+      return added
+
+  def refill_in_background(self, taking = 0):
+    if len(self.ready()) - taking >= self.low_water:
+      return
+    # a process of its own, at low priority, that outlives the caller; the
+    # passphrase goes through a pipe, not its command line or environment
+    try:
+      proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--dir", self.path, "--kind", self.kind,
+                               "--passphrase-file", "-", "refill", "--target", str(self.high_water)],
+                              stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              start_new_session=True, preexec_fn=lambda: os.nice(10))
+      with proc.stdin:
+        proc.stdin.write(self.passphrase + b"\n")
+    except OSError:
+      # the key is claimed anyway, the next claim or a refill tries again
+      pass
+
+  def stats(self):
+    return {"kind": self.kind, "ready": len(self.ready()), "claimed": len(self.claimed()),
+            "low_water": self.low_water, "high_water": self.high_water}
+
+# the time to generate a key and sign a CSR with it, and the sizes that end up
+# in the CSR and certificate, for every kind
+def bench(iterations, domain):
+  from cryptography import x509
+  from cryptography.hazmat.primitives import hashes
+  from cryptography.x509.oid import NameOID
+  print("kind      keygen ms  csr ms  SPKI B  signature B  CSR B  key PEM B")
+  for kind in KINDS:
+    keygen = csr_time = 0
+    for _ in range(iterations):
+      start = time.perf_counter()
+      key = generate_key(kind)
+      keygen += time.perf_counter() - start
+      start = time.perf_counter()
+      # what openssl req in server.sh and make_csr in app.py build
+      csr = x509.CertificateSigningRequestBuilder().subject_name(
+        x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, domain)])
+      ).add_extension(x509.SubjectAlternativeName([x509.DNSName(domain)]), critical=False).sign(key, hashes.SHA256(), default_backend())
+      csr_time += time.perf_counter() - start
+    spki = key.public_key().public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+    print(f"{kind:<9} {1000 * keygen / iterations:9.2f} {1000 * csr_time / iterations:7.2f} {len(spki):7d} "
+          f"{len(csr.signature):12d} {len(csr.public_bytes(serialization.Encoding.DER)):6d} {len(key_pem(key)):10d}")
+  # the subscriber certificate carries the SPKI, its signature is the issuing intermediate's
+  # (ECDSA P-384 for Let's Encrypt's E intermediates, RSA 2048 for the R ones), see extension/bench/decomp/cert.py
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Pool of pre-generated, encrypted TLS keys")
+  parser.add_argument("--dir", default=DEFAULT_PATH, help="pool folder (default: %(default)s)")
+  parser.add_argument("--kind", default=DEFAULT_KIND, choices=KINDS, help="key type (default: %(default)s)")
+  parser.add_argument("--passphrase-file", default=DEFAULT_PASSPHRASE_FILE,
+                      help="file (mode 0600, - for stdin) with the passphrase of the stored keys, unless $NOPE_KEYPOOL_PASSPHRASE is set (default: %(default)s)")
+  parser.add_argument("--low-water", type=int, default=LOW_WATER, help="refill below this many ready keys (default: %(default)s)")
+  parser.add_argument("--high-water", type=int, default=HIGH_WATER, help="refill up to this many ready keys (default: %(default)s)")
+  commands = parser.add_subparsers(dest="command", required=True)
+  claim = commands.add_parser("claim", help="write a decrypted key to a file, take it out of the pool and print its id")
+  claim.add_argument("out", help="key file to write")
+  for name, text in (("consume", "remove a claimed key, its certificate was issued"),
+                     ("release", "put back a claimed key that was never written out")):
+    cmd = commands.add_parser(name, help=text)
+    cmd.add_argument("id", help="id printed by claim")
+  refill = commands.add_parser("refill", help="generate keys until the pool is full")
+  refill.add_argument("--target", type=int, help="ready keys to reach (default: --high-water)")
+  commands.add_parser("ls", help="count the ready and claimed keys")
+  bench_cmd = commands.add_parser("bench", help="compare key and CSR generation time and sizes of the key types")
+  bench_cmd.add_argument("--iterations", type=int, default=20, help="keys of each type (default: %(default)s)")
+  bench_cmd.add_argument("--domain", default="nope-tools.org", help="CN and SAN of the CSRs (default: %(default)s)")
+  args = parser.parse_args()
+
+  if args.command == "bench":
+    bench(args.iterations, args.domain)
+    sys.exit(0)
+
+  try:
+    pool = KeyPool(args.dir, args.kind, load_passphrase(args.passphrase_file), args.low_water, args.high_water)
+    if args.command == "claim":
+      key_id, pem = pool.claim()
+      fd = os.open(args.out, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+      with os.fdopen(fd, "wb") as f:
+        f.write(pem)
+      # consume it once its certificate is issued; it is on disk, so never release it
+      print(key_id or "-")
+    elif args.command == "consume":
+      pool.consume(args.id)
+    elif args.command == "release":
+      pool.release(args.id)
+    elif args.command == "refill":
+      start = time.time()
+      added = pool.refill(args.target)
+      print("Added", added, "keys in", round(time.time() - start, 2), "seconds")
+    else:
+      print(pool.stats())
+  except (OSError, ValueError) as e:
+    print("Error:", e, file=sys.stderr)
+    sys.exit(1)
@@ -0,0 +1,216 @@
+import sys
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+# content-addressed cache of proofs
+#
+# a proof only depends on the circuit mode and the prover input, which
+# make_input.js builds from the DNSSEC chain bytes, the TLS public key digest,
+# the CA org and the timestamp that makeDigest adds, so the key is a hash of
+# the mode and the canonical JSON of the input. the timestamp only changes
+# every 2^24 ms (about 4.6 hours), so a cached proof is found again within
+# that window for an unchanged key and chain
+#
+# entries are folders <key[:2]>/<key> with proof.json, public.json and meta.json
+# (mode, domain, SAN names, size, times), and the least recently used entries
+# are evicted once the cache is larger than its size bound
+#
+#   python3 scripts/proofcache.py get <mode> <input.json> <proof.json> <public.json>
+#   python3 scripts/proofcache.py put <mode> <input.json> <proof.json> <public.json> [--type T --domain D]
+#   python3 scripts/proofcache.py ls | show <key> | prune [--max-size MB] [--older-than DAYS]
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "nope", "proofs")
+
+# default size bound, in bytes
+DEFAULT_MAX_SIZE = 256 << 20
+
+def proof_key(mode, prover_input):
+  canonical = json.dumps(prover_input, sort_keys=True, separators=(",", ":"))
+  return hashlib.sha256(mode.encode() + b"\n" + canonical.encode()).hexdigest()
+
+def folder_size(path):
+  return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+# whether an entry has all its files
+def complete(path):
+  return all(os.path.isfile(os.path.join(path, name)) for name in ("proof.json", "public.json", "meta.json"))
+
+class ProofCache:
+  def __init__(self, path = DEFAULT_PATH, max_size = DEFAULT_MAX_SIZE):
+    self.path = path
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def entry_path(self, key):
+    return os.path.join(self.path, key[:2], key)
+
+  # return {"proof", "public", "meta"} for a key, or None
+  def get(self, key):
+    path = self.entry_path(key)
+    try:
+      with open(os.path.join(path, "proof.json"), "r") as f:
+        proof = json.load(f)
+      with open(os.path.join(path, "public.json"), "r") as f:
+        public = json.load(f)
+      with open(os.path.join(path, "meta.json"), "r") as f:
+        meta = json.load(f)
+    except (OSError, ValueError):
+      self.misses += 1
+      return None
+    self.hits += 1
+    # the mtime of meta.json is the last use, for LRU eviction
+    os.utime(os.path.join(path, "meta.json"))
+    return {"proof": proof, "public": public, "meta": meta}
+
+  def put(self, key, proof, public, meta = None):
+    meta = dict(meta or {}, key=key, created=time.time())
+    if not os.path.exists(self.path):
+      os.makedirs(self.path)
+    # build the entry next to the cache and move it in place, so readers never see half an entry
+    tmp = tempfile.mkdtemp(prefix=".put-", dir=self.path)
+    try:
+      with open(os.path.join(tmp, "proof.json"), "w") as f:
+        json.dump(proof, f)
+      with open(os.path.join(tmp, "public.json"), "w") as f:
+        json.dump(public, f)
+      meta["size"] = folder_size(tmp)
+      with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(meta, f)
+      path = self.entry_path(key)
+      # entries are content addressed: a complete one, from another job
+      # with the same input, is as good as this one and stays
+      if os.path.exists(path) and not complete(path):
+        shutil.rmtree(path, ignore_errors=True)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      try:
+        os.rename(tmp, path)
+      except OSError:
+        # the entry exists, or another job moved its own in place first
+        if not os.path.isdir(path):
+          raise
+    finally:
+      shutil.rmtree(tmp, ignore_errors=True)
+    self.prune()
+    return path
+
+  # meta of every entry, with "used" set to its last use, least recently used first
+  def entries(self):
+    entries = []
+    if not os.path.exists(self.path):
+      return entries
+    for prefix in os.listdir(self.path):
+      folder = os.path.join(self.path, prefix)
+      if prefix.startswith(".") or not os.path.isdir(folder):
+        continue
+      for key in os.listdir(folder):
+        meta_path = os.path.join(folder, key, "meta.json")
+        try:
+          with open(meta_path, "r") as f:
+            meta = json.load(f)
+          meta["used"] = os.path.getmtime(meta_path)
+        except (OSError, ValueError):
+          # unreadable entries go first
+          meta = {"key": key, "used": 0, "size": 0}
+        entries.append(meta)
+    return sorted(entries, key=lambda meta: meta["used"])
+
+  def remove(self, key):
+    shutil.rmtree(self.entry_path(key), ignore_errors=True)
+    self.evictions += 1
+
+  # evict entries unused for older_than seconds, then the least recently
+  # used ones until the cache fits in max_size
+  # return the keys evicted
+  def prune(self, max_size = None, older_than = None):
+    if max_size is None:
+      max_size = self.max_size
+    entries = self.entries()
+    total = sum(meta.get("size", 0) for meta in entries)
+    evicted = []
+    now = time.time()
+    for meta in entries:
+      if total <= max_size and (older_than is None or now - meta["used"] < older_than):
+        continue
+      self.remove(meta["key"])
+      total -= meta.get("size", 0)
+      evicted.append(meta["key"])
+    return evicted
+
+  def stats(self):
+    return "proof cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses, " + str(self.evictions) + " evictions"
+
+# the SAN names of a proof, see compress.py
+def san_for(proof, circuit_type, domain):
+  import compress
+  return compress.san_names(compress.compress(proof), circuit_type, domain)
+
+def load_json(path):
+  with open(path, "r") as f:
+    return json.load(f)
+
+def write_json(path, value):
+  with open(path, "w") as f:
+    json.dump(value, f)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Content-addressed cache of NOPE proofs")
+  parser.add_argument("--dir", default=DEFAULT_PATH, help="cache folder (default: %(default)s)")
+  parser.add_argument("--max-size", type=float, default=DEFAULT_MAX_SIZE >> 20, help="size bound in MB (default: %(default)s)")
+  commands = parser.add_subparsers(dest="command", required=True)
+  get = commands.add_parser("get", help="copy out the cached proof for an input, exit 1 on a miss")
+  put = commands.add_parser("put", help="store the proof for an input")
+  for cmd in (get, put):
+    cmd.add_argument("mode", help="circuit mode, e.g. rsa-ecdsa-man")
+    cmd.add_argument("input", help="prover input from make_input.js")
+    cmd.add_argument("proof", help="proof.json")
+    cmd.add_argument("public", help="public.json")
+  put.add_argument("--type", type=int, help="circuit type, to store the SAN names too")
+  put.add_argument("--domain", help="domain, to store the SAN names too")
+  commands.add_parser("ls", help="list the entries, least recently used first")
+  show = commands.add_parser("show", help="print the metadata of an entry")
+  show.add_argument("key", help="key or unique key prefix")
+  prune = commands.add_parser("prune", help="evict entries")
+  prune.add_argument("--older-than", type=float, help="evict entries unused for this many days")
+  args = parser.parse_args()
+  cache = ProofCache(args.dir, int(args.max_size * (1 << 20)))
+
+  if args.command == "get":
+    entry = cache.get(proof_key(args.mode, load_json(args.input)))
+    if entry is None:
+      sys.exit(1)
+    write_json(args.proof, entry["proof"])
+    write_json(args.public, entry["public"])
+  elif args.command == "put":
+    meta = {"mode": args.mode}
+    proof = load_json(args.proof)
+    if args.domain is not None and args.type is not None:
+      meta.update(domain=args.domain, type=args.type, san=san_for(proof, args.type, args.domain))
+    try:
+      print(cache.put(proof_key(args.mode, load_json(args.input)), proof, load_json(args.public), meta))
+    except OSError as e:
+      print("Error: could not store the proof:", e, file=sys.stderr)
+      sys.exit(1)
+  elif args.command == "ls":
+    entries = cache.entries()
+    print('\t'.join(['key', 'mode', 'domain', 'bytes', 'last used']))
+    for meta in entries:
+      print('\t'.join([meta["key"][:16], meta.get("mode", "?"), meta.get("domain", "-"), str(meta.get("size", 0)),
+                       time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(meta["used"]))]))
+    print(len(entries), "entries,", sum(meta.get("size", 0) for meta in entries), "bytes")
+  elif args.command == "show":
+    matches = [meta for meta in cache.entries() if meta["key"].startswith(args.key)]
+    if len(matches) != 1:
+      print("Error:", len(matches), "entries match", args.key)
+      sys.exit(1)
+    print(json.dumps(matches[0], indent=1))
+  else:
+    older_than = args.older_than * 86400 if args.older_than is not None else None
+    evicted = cache.prune(older_than=older_than)
+    print("Evicted", len(evicted), "entries")
@@ -0,0 +1,252 @@
+import sys
+import os
+import json
+import mmap
+import time
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+
+# long running prover service
+#
+# every server.sh run starts the witness generator and zkutil prove from cold,
+# reading the multi-hundred-MB .r1cs and .params files of the circuit again.
+# this daemon memory maps the artifacts of every built mode once and touches
+# every page, so they stay in the page cache, then takes jobs over a Unix socket:
+#
+#   python3 scripts/prover.py serve --socket /tmp/nope-prover.sock &
+#   python3 scripts/prover.py prove --socket /tmp/nope-prover.sock --mode rsa-rsa \
+#     --input bin/rsa-rsa_input.json --proof proof.json --public public.json
+#
+# the protocol is one JSON object per line each way:
+#   {"mode": "rsa-rsa", "input": {...}}  ->  {"proof": {...}, "public": [...], "timings": {...}}
+#   {"status": true}                     ->  {"modes": {mode: bytes mapped}, "done": ..., "failed": ...}
+# and {"error": "..."} if the job failed
+#
+# each job runs in its own temporary folder, so jobs never share files
+
+MODES = [tld + "-" + sld + man for tld in ("rsa", "ecdsa") for sld in ("rsa", "ecdsa") for man in ("", "-man")]
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "nope-prover.sock")
+
+class ProverError(Exception):
+  pass
+
+# the files a mode needs, kept mapped while the daemon runs
+class Artifacts:
+  def __init__(self, bin_path, mode):
+    self.mode = mode
+    self.r1cs = os.path.join(bin_path, mode + ".r1cs")
+    self.params = os.path.join(bin_path, mode + ".params")
+    self.witness = os.path.join(bin_path, mode + "_cpp", mode)
+    self.paths = [self.r1cs, self.params, self.witness, self.witness + ".dat"]
+    self.maps = []
+    self.mtimes = None
+
+  def available(self):
+    return all(os.path.exists(path) for path in self.paths)
+
+  # map every file and read one byte per page, return the bytes mapped
+  def load(self):
+    self.close()
+    self.mtimes = [os.path.getmtime(path) for path in self.paths]
+    size = 0
+    for path in self.paths:
+      with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+          continue
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      if hasattr(m, "madvise"):
+        m.madvise(mmap.MADV_WILLNEED)
+      for pos in range(0, len(m), mmap.PAGESIZE):
+        m[pos]
+      self.maps.append(m)
+      size += len(m)
+    return size
+
+  # reload if the circuit was rebuilt since it was loaded
+  def stale(self):
+    return self.mtimes != [os.path.getmtime(path) for path in self.paths]
+
+  def size(self):
+    return sum(len(m) for m in self.maps)
+
+  def close(self):
+    for m in self.maps:
+      m.close()
+    self.maps = []
+
+class Prover:
+  def __init__(self, bin_path, modes = MODES, jobs = 1, zkutil = "zkutil"):
+    self.bin_path = bin_path
+    self.zkutil = zkutil
+    self.artifacts = {}
+    self.jobs = jobs
+    # made by serve(), in the event loop it runs in
+    self.sem = None
+    self.done = 0
+    self.failed = 0
+    for mode in modes:
+      artifacts = Artifacts(bin_path, mode)
+      if artifacts.available():
+        self.artifacts[mode] = artifacts
+
+  def load(self):
+    for mode, artifacts in self.artifacts.items():
+      start = time.perf_counter()
+      size = artifacts.load()
+      print("Loaded", mode, str(size // (1 << 20)) + " MB in", '{0:.1f}'.format(time.perf_counter() - start), "s", flush=True)
+
+  async def run(self, *cmd):
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    output, _ = await proc.communicate()
+    if proc.returncode != 0:
+      raise ProverError(os.path.basename(cmd[0]) + " failed (" + str(proc.returncode) + "): " + output.decode(errors="replace")[-2000:].strip())
+
+  # generate the witness and the proof for a prover input
+  # return the proof, the public signals and how long each step took
+  async def prove(self, mode, prover_input):
+    if mode not in self.artifacts:
+      raise ProverError("mode " + mode + " is not built in " + self.bin_path)
+    artifacts = self.artifacts[mode]
+    async with self.sem:
+      if artifacts.stale():
+        artifacts.load()
+      workspace = tempfile.mkdtemp(prefix="nope-prove-")
+      try:
+        timings = {}
+        input_path = os.path.join(workspace, "input.json")
+        with open(input_path, "w") as f:
+          json.dump(prover_input, f)
+        start = time.perf_counter()
+        await self.run(artifacts.witness, input_path, os.path.join(workspace, "witness.wtns"))
+        timings["witness"] = time.perf_counter() - start
+        start = time.perf_counter()
+        await self.run(self.zkutil, "prove", "-c", artifacts.r1cs, "-p", artifacts.params,
+                       "-r", os.path.join(workspace, "proof.json"), "-o", os.path.join(workspace, "public.json"),
+                       "-w", os.path.join(workspace, "witness.wtns"))
+        timings["prove"] = time.perf_counter() - start
+        with open(os.path.join(workspace, "proof.json"), "r") as f:
+          proof = json.load(f)
+        with open(os.path.join(workspace, "public.json"), "r") as f:
+          public = json.load(f)
+      finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+    return {"proof": proof, "public": public, "timings": timings}
+
+  def status(self):
+    return {"modes": {mode: a.size() for mode, a in self.artifacts.items()}, "done": self.done, "failed": self.failed}
+
+  async def handle(self, reader, writer):
+    try:
+      while True:
+        line = await reader.readline()
+        if not line:
+          break
+        try:
+          request = json.loads(line)
+          if not isinstance(request, dict):
+            raise ValueError("request is not a JSON object")
+          if request.get("status"):
+            response = self.status()
+          else:
+            response = await self.prove(request["mode"], request["input"])
+            self.done += 1
+        except (ProverError, OSError, ValueError, KeyError, TypeError) as e:
+          self.failed += 1
+          response = {"error": str(e)}
+        writer.write(json.dumps(response).encode() + b"\n")
+        await writer.drain()
+    except ConnectionError:
+      pass
+    finally:
+      writer.close()
+
+# whether a daemon answers on the socket
+def alive(path):
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+    try:
+      sock.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+      return False
+  return True
+
+async def serve(prover, path):
+  if os.path.exists(path):
+    if alive(path):
+      raise ProverError("a prover is already serving on " + path)
+    # left behind by a daemon that did not exit cleanly
+    os.unlink(path)
+  prover.sem = asyncio.Semaphore(prover.jobs)
+  # prover inputs are larger than the default line limit of 64 KB
+  server = await asyncio.start_unix_server(prover.handle, path, limit=1 << 26)
+  print("Serving", ", ".join(prover.artifacts) or "no modes", "on", path, flush=True)
+  try:
+    await asyncio.Event().wait()
+  finally:
+    server.close()
+    os.unlink(path)
+
+# send one request to the daemon and wait for the answer
+def submit(path, request, timeout = None):
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+    sock.settimeout(timeout)
+    sock.connect(path)
+    sock.sendall(json.dumps(request).encode() + b"\n")
+    with sock.makefile("rb") as f:
+      line = f.readline()
+  if not line:
+    raise ProverError("prover closed the connection")
+  response = json.loads(line)
+  if "error" in response:
+    raise ProverError(response["error"])
+  return response
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Prover daemon keeping the circuit artifacts in memory")
+  parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix socket of the daemon (default: %(default)s)")
+  commands = parser.add_subparsers(dest="command", required=True)
+  serve_cmd = commands.add_parser("serve", help="run the daemon")
+  serve_cmd.add_argument("--bin", default="bin", help="folder with the built circuits (default: %(default)s)")
+  serve_cmd.add_argument("--modes", nargs="+", default=MODES, choices=MODES, help="modes to load (default: every built mode)")
+  serve_cmd.add_argument("--jobs", type=int, default=1, help="proofs generated at once (default: %(default)s)")
+  serve_cmd.add_argument("--zkutil", default="zkutil", help="zkutil binary (default: %(default)s)")
+  prove_cmd = commands.add_parser("prove", help="prove one input with a running daemon")
+  prove_cmd.add_argument("--mode", required=True, choices=MODES)
+  prove_cmd.add_argument("--input", required=True, help="prover input, from make_input.js")
+  prove_cmd.add_argument("--proof", required=True, help="where to write the proof")
+  prove_cmd.add_argument("--public", required=True, help="where to write the public signals")
+  commands.add_parser("status", help="print what a running daemon has loaded")
+  args = parser.parse_args()
+
+  if args.command == "serve":
+    if os.path.exists(args.socket) and alive(args.socket):
+      print("Error: a prover is already serving on", args.socket)
+      sys.exit(1)
+    prover = Prover(args.bin, args.modes, args.jobs, args.zkutil)
+    prover.load()
+    try:
+      asyncio.run(serve(prover, args.socket))
+    except KeyboardInterrupt:
+      pass
+    except ProverError as e:
+      print("Error:", e)
+      sys.exit(1)
+    sys.exit(0)
+  try:
+    if args.command == "status":
+      print(json.dumps(submit(args.socket, {"status": True}), indent=1))
+      sys.exit(0)
+    with open(args.input, "r") as f:
+      prover_input = json.load(f)
+    response = submit(args.socket, {"mode": args.mode, "input": prover_input})
+  except (OSError, ProverError) as e:
+    print("Error:", e)
+    sys.exit(1)
+  with open(args.proof, "w") as f:
+    json.dump(response["proof"], f)
+  with open(args.public, "w") as f:
+    json.dump(response["public"], f)
+  print("witness", '{0:.2f}'.format(response["timings"]["witness"]), "s, prove", '{0:.2f}'.format(response["timings"]["prove"]), "s")
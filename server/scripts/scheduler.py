@@ -0,0 +1,412 @@
+import sys
+import os
+import json
+import time
+import shutil
+import struct
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import concurrent.futures
+
+import keymat
+import keypool
+import compress
+import proofcache
+from prover import MODES, Artifacts
+
+# the proving RAM model, see circuits/bench/tochart.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "circuits", "bench"))
+from tochart import estimate_ram
+
+# the chain digest server.sh keeps next to the last proof, see sscripts/chaindiff.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "sscripts"))
+import chaindiff
+
+# prove many domains in parallel without running out of memory
+#
+#   python3 scripts/scheduler.py jobs.txt --status status.jsonl
+#
+# (run from server/) where jobs.txt has one job per line, as server.sh takes them:
+#   <domain> <TLD algorithm = 8/13> <SLD algorithm = 8/13> <managed=0/1> [data path] [TLS key]
+# the data path defaults to data, the key to bin/<domain>.key (generated if missing, of --key-type)
+#
+# a job is only started when the memory it is expected to need fits:
+# the expected peak RSS of a mode starts as estimate_ram() of its constraint
+# count and becomes the largest peak seen once a job of that mode finished,
+# and the sum of what running jobs may still allocate plus the new job has to
+# fit in MemAvailable, less --headroom. one job is always allowed to run.
+#
+# each job writes bin/<domain>-<mode>_{input,proof,public}.json (as server.sh does)
+# and its SAN names go to the status file, one JSON line per state change
+#
+# proofs are looked up in and added to the proof cache (scripts/proofcache.py),
+# so a job whose prover input was proven before skips the witness and prove steps
+
+GB = 1 << 30
+
+# observed peaks are padded by this much before being used as a reservation
+MARGIN = 1.1
+
+def mode_of(tld_alg, sld_alg, man):
+  mode = ("rsa" if tld_alg == 8 else "ecdsa") + "-" + ("rsa" if sld_alg == 8 else "ecdsa")
+  return mode + "-man" if man else mode
+
+# same as TYPE in server.sh
+def circuit_type(tld_alg, sld_alg, man):
+  return (tld_alg == 13) * 4 + (sld_alg == 13) * 2 + (1 if man else 0)
+
+class Job:
+  def __init__(self, domain, tld_alg, sld_alg, man, data_path = "data", key = None):
+    self.domain = domain
+    self.tld_alg = tld_alg
+    self.sld_alg = sld_alg
+    self.man = man
+    self.data_path = data_path
+    self.key = key
+    self.mode = mode_of(tld_alg, sld_alg, man)
+    self.status = "queued"
+    self.step = None
+    self.error = None
+    self.san = None
+    # the proof came from the proof cache
+    self.cached = False
+    self.timings = {}
+    self.peak_rss = 0
+    # bytes reserved for this job while it runs, and the process it is running
+    self.reserved = 0
+    self.pid = None
+    self.started = None
+
+  def record(self):
+    record = {"time": time.time(), "domain": self.domain, "mode": self.mode, "status": self.status}
+    if self.step:
+      record["step"] = self.step
+    if self.status in ("done", "failed"):
+      record["timings"] = self.timings
+      record["peak_rss"] = self.peak_rss
+    if self.cached:
+      record["cached"] = True
+    if self.san:
+      record["san"] = self.san
+    if self.error:
+      record["error"] = self.error
+    return record
+
+# read jobs, one per line, # starts a comment
+def read_jobs(path):
+  jobs = []
+  with open(path, "r") as f:
+    for number, line in enumerate(f, 1):
+      fields = line.split("#")[0].split()
+      if not fields:
+        continue
+      if len(fields) < 4 or fields[1] not in ("8", "13") or fields[2] not in ("8", "13") or fields[3] not in ("0", "1"):
+        raise ValueError(path + ":" + str(number) + ": expected <domain> <8/13> <8/13> <0/1> [data path] [key]")
+      jobs.append(Job(fields[0], int(fields[1]), int(fields[2]), fields[3] == "1", *fields[4:6]))
+  return jobs
+
+# number of constraints in the header of an .r1cs file
+def r1cs_constraints(path):
+  with open(path, "rb") as f:
+    magic, _, sections = struct.unpack("<4sII", f.read(12))
+    if magic != b"r1cs":
+      raise ValueError(path + " is not an r1cs file")
+    for _ in range(sections):
+      kind, size = struct.unpack("<IQ", f.read(12))
+      if kind != 1:
+        f.seek(size, 1)
+        continue
+      field_size = struct.unpack("<I", f.read(4))[0]
+      # prime, wires, public outputs, public inputs, private inputs, labels
+      f.seek(field_size + 16 + 8, 1)
+      return struct.unpack("<I", f.read(4))[0]
+  raise ValueError(path + " has no header section")
+
+def mem_available():
+  with open("/proc/meminfo", "r") as f:
+    for line in f:
+      if line.startswith("MemAvailable:"):
+        return int(line.split()[1]) * 1024
+  raise OSError("MemAvailable not in /proc/meminfo")
+
+# resident memory of a running process, 0 once it is gone
+def proc_rss(pid):
+  try:
+    with open("/proc/" + str(pid) + "/status", "r") as f:
+      for line in f:
+        if line.startswith("VmRSS:"):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+  return 0
+
+# run a command to completion, return its exit code, peak RSS in bytes and output
+# started(pid) is called once it is running
+def run_step(cmd, started, env = None):
+  proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+  started(proc.pid)
+  output = proc.stdout.read()
+  _, status, usage = os.wait4(proc.pid, 0)
+  # os.waitstatus_to_exitcode needs python 3.9, the Docker image has 3.8
+  proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+  proc.stdout.close()
+  return proc.returncode, usage.ru_maxrss * 1024, output.decode(errors="replace")
+
+class Scheduler:
+  def __init__(self, bin_path = "bin", scripts_path = None, max_jobs = None, headroom = GB, status_path = None, zkutil = "zkutil", report = 30, cache = None, key_type = keypool.DEFAULT_KIND):
+    self.bin_path = bin_path
+    self.key_type = key_type
+    self.cache = cache
+    self.scripts_path = scripts_path or os.path.dirname(os.path.abspath(__file__))
+    self.max_jobs = max_jobs or os.cpu_count()
+    self.headroom = headroom
+    self.status_path = status_path
+    self.zkutil = zkutil
+    self.report_every = report
+    self.predicted = {}
+    self.observed = {}
+    self.artifacts = {}
+    self.running = set()
+    self.finished = []
+    self.queue = []
+    # running job tasks, and the futures submit() waits on, by job
+    self.tasks = {}
+    self.waiters = {}
+    self.draining = None
+    self.start = None
+    self.pool = concurrent.futures.ThreadPoolExecutor(self.max_jobs)
+    self.env = dict(os.environ, NODE_OPTIONS="--max-old-space-size=8192")
+
+  # expected peak RSS of a job of this mode, in bytes
+  def need(self, mode):
+    if mode in self.observed:
+      return int(self.observed[mode] * MARGIN)
+    if mode not in self.predicted:
+      self.predicted[mode] = int(estimate_ram(r1cs_constraints(os.path.join(self.bin_path, mode + ".r1cs"))) * 1e9)
+    return self.predicted[mode]
+
+  # what running jobs may still allocate on top of what they use now
+  # a job between its steps (or not started yet) has no process to measure,
+  # its next step may still take all of what it reserved
+  def outstanding(self):
+    return sum(max(0, job.reserved - proc_rss(job.pid)) if job.pid else job.reserved for job in self.running)
+
+  def admit(self, job):
+    if not self.running:
+      return True
+    if len(self.running) >= self.max_jobs:
+      return False
+    return self.need(job.mode) + self.outstanding() + self.headroom <= mem_available()
+
+  def log(self, job):
+    if self.status_path:
+      with open(self.status_path, "a") as f:
+        f.write(json.dumps(job.record()) + "\n")
+
+  def set_status(self, job, status, step = None):
+    job.status = status
+    job.step = step
+    self.log(job)
+
+  async def step(self, job, name, cmd):
+    self.set_status(job, "running", name)
+    def started(pid):
+      job.pid = pid
+    start = time.perf_counter()
+    code, rss, output = await asyncio.get_running_loop().run_in_executor(self.pool, run_step, cmd, started, self.env)
+    job.timings[name] = time.perf_counter() - start
+    job.peak_rss = max(job.peak_rss, rss)
+    job.pid = None
+    if code != 0:
+      raise RuntimeError(name + " failed (" + str(code) + "): " + output[-2000:].strip())
+
+  async def run_job(self, job, workspace):
+    prefix = os.path.join(self.bin_path, job.domain + "-" + job.mode)
+    start = time.perf_counter()
+    key_path = job.key or os.path.join(self.bin_path, job.domain + ".key")
+    if not os.path.exists(key_path):
+      try:
+        keymat.generate_tls_key(key_path, self.key_type)
+      except FileExistsError:
+        # another job for the same domain made it first, use that one
+        pass
+    digest = keymat.tls_digest(key_path)
+    job.timings["digest"] = time.perf_counter() - start
+    await self.step(job, "input", ["node", os.path.join(self.scripts_path, "make_input.js"), "-d", job.domain,
+                                   "-t", str(job.tld_alg), "-s", str(job.sld_alg), "-m", "1" if job.man else "0",
+                                   "-g", digest, "-p", job.data_path, "-o", workspace])
+    input_path = os.path.join(workspace, job.domain + ("-man" if job.man else "") + "_input.json")
+    chain_path = chaindiff.digest_path(input_path)
+    if os.path.isdir(job.data_path):
+      chaindiff.write_digest(job.data_path, job.domain, chain_path)
+    proof_path = os.path.join(workspace, "proof.json")
+    public_path = os.path.join(workspace, "public.json")
+    circuit = circuit_type(job.tld_alg, job.sld_alg, job.man)
+    entry = None
+    if self.cache:
+      with open(input_path, "r") as f:
+        cache_key = proofcache.proof_key(job.mode, json.load(f))
+      entry = self.cache.get(cache_key)
+    if entry is not None:
+      job.cached = True
+      proofcache.write_json(proof_path, entry["proof"])
+      proofcache.write_json(public_path, entry["public"])
+      job.san = entry["meta"].get("san") or compress.san_names(compress.compress(entry["proof"]), circuit, job.domain)
+    else:
+      witness = os.path.join(workspace, job.mode + ".wtns")
+      await self.step(job, "witness", [os.path.join(self.bin_path, job.mode + "_cpp", job.mode), input_path, witness])
+      await self.step(job, "prove", [self.zkutil, "prove", "-c", os.path.join(self.bin_path, job.mode + ".r1cs"),
+                                     "-p", os.path.join(self.bin_path, job.mode + ".params"),
+                                     "-r", proof_path, "-o", public_path, "-w", witness])
+      start = time.perf_counter()
+      proof = proofcache.load_json(proof_path)
+      job.san = compress.san_names(compress.compress(proof), circuit, job.domain)
+      job.timings["compress"] = time.perf_counter() - start
+      if self.cache:
+        try:
+          self.cache.put(cache_key, proof, proofcache.load_json(public_path),
+                         {"mode": job.mode, "domain": job.domain, "type": circuit, "san": job.san})
+        except OSError as e:
+          # the proof is made, only the next job with the same input misses it
+          print(job.domain + ":", "could not add the proof to the proof cache:", e, flush=True)
+    shutil.copy(input_path, prefix + "_input.json")
+    shutil.copy(proof_path, prefix + "_proof.json")
+    shutil.copy(public_path, prefix + "_public.json")
+    if os.path.exists(chain_path):
+      shutil.copy(chain_path, prefix + "_chain.sha256")
+    elif os.path.exists(prefix + "_chain.sha256"):
+      os.unlink(prefix + "_chain.sha256")
+
+  async def run_one(self, job):
+    job.started = time.perf_counter()
+    workspace = tempfile.mkdtemp(prefix="nope-job-")
+    try:
+      await self.run_job(job, workspace)
+      # a cached job never proved, so its peak says nothing about the mode
+      if not job.cached:
+        self.observed[job.mode] = max(self.observed.get(job.mode, 0), job.peak_rss)
+      self.set_status(job, "done")
+    except Exception as e:
+      # whatever goes wrong with one job (e.g. a TypeError for an encrypted
+      # key) fails that job only, not the others running with it
+      job.error = str(e) or type(e).__name__
+      self.set_status(job, "failed", job.step)
+    finally:
+      shutil.rmtree(workspace, ignore_errors=True)
+      job.timings["total"] = time.perf_counter() - job.started
+
+  def report(self, queued, start):
+    done = sum(1 for job in self.finished if job.status == "done")
+    elapsed = time.perf_counter() - start
+    print("[" + '{0:.0f}'.format(elapsed) + " s]", done, "done,", len(self.finished) - done, "failed,",
+          len(self.running), "running,", queued, "queued,", '{0:.2f}'.format(60 * done / elapsed) if elapsed else "0", "proofs/min,",
+          '{0:.1f}'.format(mem_available() / GB), "GB available,", '{0:.1f}'.format(self.outstanding() / GB), "GB outstanding", flush=True)
+
+  # check that the mode of every job is built, and queue the jobs
+  def enqueue(self, jobs):
+    for job in jobs:
+      if job.mode not in self.artifacts:
+        artifacts = Artifacts(self.bin_path, job.mode)
+        if not artifacts.available():
+          raise ValueError("mode " + job.mode + " is not built in " + self.bin_path)
+        # keep the artifacts of every mode in the queue in the page cache
+        artifacts.load()
+        self.artifacts[job.mode] = artifacts
+    for job in jobs:
+      self.queue.append(job)
+      self.log(job)
+
+  # start queued jobs in order while they fit, until nothing is queued or running
+  # jobs queued while this runs are started by it too
+  async def drain(self):
+    # the rates of report() are over every job this scheduler finished
+    if self.start is None:
+      self.start = time.perf_counter()
+    start = self.start
+    last_report = time.perf_counter()
+    while self.queue or self.tasks:
+      while self.queue and self.admit(self.queue[0]):
+        job = self.queue.pop(0)
+        job.reserved = self.need(job.mode)
+        self.running.add(job)
+        self.tasks[asyncio.ensure_future(self.run_one(job))] = job
+      finished, _ = await asyncio.wait(self.tasks, timeout=1, return_when=asyncio.FIRST_COMPLETED)
+      for task in finished:
+        job = self.tasks.pop(task)
+        self.running.discard(job)
+        self.finished.append(job)
+        waiter = self.waiters.pop(job, None)
+        if waiter is not None and not waiter.done():
+          waiter.set_result(job)
+      if time.perf_counter() - last_report >= self.report_every:
+        self.report(len(self.queue), start)
+        last_report = time.perf_counter()
+    self.report(0, start)
+
+  # queue jobs next to the ones already queued or running and wait for them,
+  # for a scheduler that lives longer than one batch (scripts/watch.py)
+  # so that every job goes through the same memory admission
+  async def submit(self, jobs):
+    loop = asyncio.get_running_loop()
+    waiters = [self.waiters.setdefault(job, loop.create_future()) for job in jobs]
+    try:
+      self.enqueue(jobs)
+    except ValueError:
+      for job in jobs:
+        self.waiters.pop(job, None)
+      raise
+    if self.draining is None or self.draining.done():
+      self.draining = asyncio.ensure_future(self.drain())
+    await asyncio.wait(waiters)
+    return jobs
+
+  def close(self):
+    for artifacts in self.artifacts.values():
+      artifacts.close()
+    self.artifacts = {}
+    self.pool.shutdown()
+
+  async def run(self, jobs):
+    self.enqueue(jobs)
+    await self.drain()
+    self.close()
+    return self.finished
+
+  def summary(self):
+    print('\t'.join(['mode', 'done', 'failed', 'mean s', 'peak RSS GB', 'predicted GB']))
+    for mode in MODES:
+      jobs = [job for job in self.finished if job.mode == mode]
+      if not jobs:
+        continue
+      done = [job for job in jobs if job.status == "done"]
+      mean = sum(job.timings["total"] for job in done) / len(done) if done else 0
+      print('\t'.join([mode, str(len(done)), str(len(jobs) - len(done)), '{0:.1f}'.format(mean),
+                       '{0:.2f}'.format(self.observed.get(mode, 0) / GB), '{0:.2f}'.format(self.predicted.get(mode, 0) / GB)]))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Prove many domains in parallel within the available memory", epilog="Ex: " + sys.argv[0] + " jobs.txt --status status.jsonl")
+  parser.add_argument("jobs", help="job file, one '<domain> <8/13> <8/13> <0/1> [data path] [key]' per line")
+  parser.add_argument("--bin", default="bin", help="folder with the built circuits (default: %(default)s)")
+  parser.add_argument("--max-jobs", type=int, default=None, help="jobs running at once at most (default: number of CPUs)")
+  parser.add_argument("--headroom", type=float, default=1, help="GB of memory to always leave free (default: %(default)s)")
+  parser.add_argument("--status", help="append one JSON line per job state change to this file")
+  parser.add_argument("--zkutil", default="zkutil", help="zkutil binary (default: %(default)s)")
+  parser.add_argument("--report", type=float, default=30, help="seconds between progress lines (default: %(default)s)")
+  parser.add_argument("--proof-cache", default=proofcache.DEFAULT_PATH, help="proof cache folder (default: %(default)s)")
+  parser.add_argument("--no-proof-cache", action="store_true", help="always prove, don't read or write the proof cache")
+  parser.add_argument("--key-type", default=keypool.DEFAULT_KIND, choices=keypool.KINDS, help="type of the TLS keys generated for jobs without one (default: %(default)s)")
+  args = parser.parse_args()
+  try:
+    jobs = read_jobs(args.jobs)
+    cache = None if args.no_proof_cache else proofcache.ProofCache(args.proof_cache)
+    scheduler = Scheduler(args.bin, None, args.max_jobs, int(args.headroom * GB), args.status, args.zkutil, args.report, cache, args.key_type)
+    asyncio.run(scheduler.run(jobs))
+  except (OSError, ValueError) as e:
+    print("Error:", e)
+    sys.exit(1)
+  scheduler.summary()
+  if cache:
+    print(cache.stats())
+  sys.exit(0 if all(job.status == "done" for job in jobs) else 1)
@@ -34,16 +34,23 @@ def find_dat_files(directory):
                 dat_files.append(os.path.join(root, file))
     return dat_files
 
+# Events of app.py --time_it in each phase of the figure
+# (other events, e.g. the parts of a phase, are left out)
+ACME_INITIATION = ['key_csr_gen', 'acme_connect', 'acc_regr', 'order_req']
+DNS_PROPAGATION = ['dns_prop']
+ACME_VERIFICATION = ['ans_chal', 'order_comp']
+
 def parse_dat_file(file_path):
     with open(file_path, 'r') as file:
         lines = file.readlines()
         # The first line is metadata, so we skip it.
-        numbers = [float(line.split()[-2]) for line in lines[1:]]
-        
+        # The others are "<event> took <seconds> seconds"
+        times = {line.split()[0]: float(line.split()[-2]) for line in lines[1:] if line.strip()}
+
         # Categorize and sum the times
-        acme_initiation = sum(numbers[:3])  # Sum the first three
-        dns_propagation = numbers[3]        # Fourth one
-        acme_verification = sum(numbers[4:]) # Sum the fifth and sixth
+        acme_initiation = sum(times.get(e, 0) for e in ACME_INITIATION)
+        dns_propagation = sum(times.get(e, 0) for e in DNS_PROPAGATION)
+        acme_verification = sum(times.get(e, 0) for e in ACME_VERIFICATION)
 
     return acme_initiation, dns_propagation, acme_verification
 
@@ -0,0 +1,76 @@
+import sys
+import os
+import json
+import time
+import subprocess
+
+# per-stage spans of the proof-and-CSR pipeline
+#
+#   python3 scripts/trace.py <trace.jsonl> <stage> [key=value ...] -- <command> [args ...]
+#
+# runs the command (stdin/stdout/stderr are passed through, so it can be used
+# inside $(...)), exits with its exit code and appends one JSON line to the trace:
+#   {"time": ..., "stage": "prove", "wall": s, "cpu": s, "user": s, "sys": s, "peak_rss": bytes, "code": 0, key: value ...}
+# cpu time and peak RSS come from the rusage of the command, which includes
+# the processes it waited for
+#
+# server.sh and bench.sh trace each stage through span() in scripts/trace.sh,
+# bench/parse.py aggregates the spans into per-stage percentiles
+
+def run(cmd):
+  start = time.perf_counter()
+  proc = subprocess.Popen(cmd)
+  _, status, usage = os.wait4(proc.pid, 0)
+  # same exit code as a shell gives, 128 + signal if the command was killed
+  code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+  # keep Popen from waiting on the reaped process again
+  proc.returncode = code
+  return code, {
+    "wall": time.perf_counter() - start,
+    "cpu": usage.ru_utime + usage.ru_stime,
+    "user": usage.ru_utime,
+    "sys": usage.ru_stime,
+    # kilobytes on Linux
+    "peak_rss": usage.ru_maxrss * 1024,
+    "code": code,
+  }
+
+def record(path, stage, span, attrs = None):
+  line = dict({"time": time.time(), "stage": stage}, **(attrs or {}))
+  line.update(span)
+  # one write per line, so that concurrent runs can share a trace file
+  with open(path, "a") as f:
+    f.write(json.dumps(line) + "\n")
+
+# read the spans of one or more trace files
+def read_spans(paths):
+  spans = []
+  for path in paths:
+    with open(path, "r") as f:
+      for line in f:
+        if line.strip():
+          spans.append(json.loads(line))
+  return spans
+
+def parse_attrs(args):
+  attrs = {}
+  for arg in args:
+    key, sep, value = arg.partition("=")
+    if not sep:
+      raise ValueError("expected key=value, got " + arg)
+    attrs[key] = value
+  return attrs
+
+if __name__ == "__main__":
+  if "--" not in sys.argv or sys.argv.index("--") < 3 or sys.argv.index("--") == len(sys.argv) - 1:
+    print("Usage: python3 " + sys.argv[0] + " <trace.jsonl> <stage> [key=value ...] -- <command> [args ...]")
+    sys.exit(2)
+  split = sys.argv.index("--")
+  try:
+    attrs = parse_attrs(sys.argv[3:split])
+    code, span = run(sys.argv[split + 1:])
+  except (OSError, ValueError) as e:
+    print("Error:", e, file=sys.stderr)
+    sys.exit(127)
+  record(sys.argv[1], sys.argv[2], span, attrs)
+  sys.exit(code)
@@ -0,0 +1,17 @@
+#!/bin/bash
+
+# stage tracing for server.sh and bench.sh, sourced by both (after SCRIPT_PATH is set)
+#
+# span STAGE COMMAND [ARGS ...]
+# runs the command; when TRACE is set, scripts/trace.py also appends the wall
+# time, CPU time and peak RSS of the command to the JSONL file TRACE, tagged
+# with the stage, MODE and TRACE_RUN (one id per run of the pipeline)
+span () {
+    local STAGE=$1
+    shift
+    if [ -n "$TRACE" ]; then
+        python3 $SCRIPT_PATH/trace.py $TRACE $STAGE run=$TRACE_RUN mode=$MODE -- "$@"
+    else
+        "$@"
+    fi
+}
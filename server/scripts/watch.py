@@ -0,0 +1,198 @@
+import sys
+import os
+import json
+import time
+import asyncio
+import argparse
+
+import proofcache
+import scheduler
+
+# the chain fetch and chain comparison are shared with sscripts/fetchmin.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "sscripts"))
+import dnstransport
+import dnschain
+import chaindiff
+
+# fetch and prove again before a domain's proof goes stale
+#
+#   python3 scripts/watch.py jobs.txt --status watch.jsonl
+#
+# (run from server/) with the job file of scripts/scheduler.py. every --interval
+# seconds, the chains of all domains are queried at once (records shared between
+# domains are queried once) and compared with the chain in each domain's data folder:
+#   - a changed key (ZSK/KSK rollover, new DS) or changed TXT records,
+#   - RRSIGs in the data folder expiring within --lead, once the zone has
+#     published new ones,
+#   - or no chain in the data folder yet
+# write the live chain to the data folder (as fetchmin.py does) and prove the
+# domain again in the background with scripts/scheduler.py, so the proof is in
+# bin/ and in the proof cache before anyone asks for a certificate
+#
+# the proofs of every poll are queued on one scheduler, which starts them only
+# while they fit in memory; the files of the data folder are replaced at once,
+# so a proof reading the parent zones of its chain never sees half a file
+#
+# the proof also binds the ~4.6 hour (2^24 ms) makeDigest timestamp window it is
+# made in, and the proof cache key includes it: a proof made here only saves an
+# issuance from proving within that same window. the watcher does not prove on a
+# window-aligned schedule, what it guarantees is that the data folder and the
+# last proof never lag behind DNS
+
+DAY = 86400
+
+def fqdn(domain):
+  return domain if domain[-1] == "." else domain + "."
+
+def format_time(seconds):
+  return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(seconds)) if seconds else "-"
+
+class Watcher:
+  def __init__(self, jobs, fetcher, lead = 2 * DAY, prover = None, status_path = None, dry_run = False, query_jobs = 32):
+    self.jobs = list(jobs)
+    self.fetcher = fetcher
+    self.lead = lead
+    # one scheduler for every proof started, so they all share its memory admission
+    self.scheduler = prover or scheduler.Scheduler()
+    self.status_path = status_path
+    self.dry_run = dry_run
+    self.query_jobs = query_jobs
+    # domains with a proof running, not checked again until it is done
+    self.proving = set()
+    self.tasks = set()
+
+  def log(self, record):
+    record = dict({"time": time.time()}, **record)
+    if self.status_path:
+      with open(self.status_path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+  # why the proof of a job has to be made again, or None
+  # along with what was seen, for the log
+  def check(self, job, chain, now):
+    domain = fqdn(job.domain)
+    previous = chaindiff.snapshot(job.data_path, domain)
+    current = chaindiff.group_files(chain.files, domain)
+    expires = chaindiff.expiration(previous)
+    live_expires = chaindiff.expiration(current)
+    info = {"expires": expires, "live_expires": live_expires}
+    # "new" if some file of the chain is not in the data folder yet
+    info["status"] = chaindiff.compare(domain, previous, current)["status"]
+    if info["status"] in ("key_changed", "record_changed", "new"):
+      return info["status"], info
+    if expires is not None and expires - now < self.lead:
+      # fetching again only helps once the zone has signed the records again
+      if live_expires is not None and live_expires > expires:
+        return "expiring", info
+      info["waiting"] = "RRSIGs expire soon, the zone has not signed the records again yet"
+    return None, info
+
+  # write the live chain where the job's proof is made from
+  def update_data(self, job, chain):
+    domain = fqdn(job.domain)
+    previous = chaindiff.snapshot(job.data_path, domain)
+    chain.write(job.data_path)
+    chaindiff.write_report(job.data_path, chaindiff.compare(domain, previous, chaindiff.group_files(chain.files, domain)))
+
+  # query the chains of every domain not being proven and start proving the ones that need it
+  async def poll(self):
+    jobs = [job for job in self.jobs if job.domain not in self.proving]
+    if not jobs:
+      return []
+    chains, errors = await self.fetcher.fetch_many([fqdn(job.domain) for job in jobs], self.query_jobs)
+    now = time.time()
+    # every chain is checked before any is written, as chains share the files of their parent zones
+    stale = []
+    for job in jobs:
+      domain = fqdn(job.domain)
+      if domain in errors:
+        print(job.domain + ":", "fetch failed,", errors[domain], flush=True)
+        self.log({"domain": job.domain, "event": "check", "error": str(errors[domain])})
+        continue
+      chain = chains[domain]
+      reason, info = self.check(job, chain, now)
+      print(job.domain + ":", info["status"] + ",", "RRSIGs expire", format_time(info["expires"]),
+            "(live " + format_time(info["live_expires"]) + ")", "-> " + reason if reason else "", info.get("waiting", ""), flush=True)
+      self.log(dict({"domain": job.domain, "event": "check", "reason": reason}, **info))
+      if reason is not None and not self.dry_run:
+        stale.append((job, chain))
+    refresh = []
+    for job, chain in stale:
+      self.update_data(job, chain)
+      # a rollover to another algorithm changes the circuit
+      refresh.append(scheduler.Job(job.domain, chain.algs.get("tld", job.tld_alg), chain.algs.get("sld", job.sld_alg),
+                                   job.man, job.data_path, job.key))
+    if refresh:
+      task = asyncio.ensure_future(self.prove(refresh))
+      self.tasks.add(task)
+      task.add_done_callback(self.tasks.discard)
+    return refresh
+
+  async def prove(self, jobs):
+    domains = [job.domain for job in jobs]
+    self.proving.update(domains)
+    print("Proving", ", ".join(domains), "in the background", flush=True)
+    try:
+      await self.scheduler.submit(jobs)
+    except (OSError, ValueError) as e:
+      print("Error:", e, flush=True)
+      for job in jobs:
+        job.status = "failed"
+        job.error = job.error or str(e)
+    finally:
+      self.proving.difference_update(domains)
+    for job in jobs:
+      print(job.domain + ":", "proof", job.status, "(" + job.error + ")" if job.error else "", flush=True)
+      self.log({"domain": job.domain, "event": "proof", "mode": job.mode, "status": job.status, "error": job.error, "san": job.san})
+
+  async def run(self, interval, once = False):
+    while True:
+      try:
+        await self.poll()
+      except dnschain.ChainError as e:
+        print("Error:", e, flush=True)
+      if once:
+        break
+      await asyncio.sleep(interval)
+    # let the proofs started by the last poll finish
+    if self.tasks:
+      await asyncio.wait(self.tasks)
+    self.scheduler.close()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Fetch and prove domains again when their DNSSEC keys change or RRSIGs are about to expire",
+                                   epilog="A proof also binds the ~4.6 hour (2^24 ms) timestamp window of makeDigest it was made in,\n"
+                                          "so a certificate issued in a later window is proven again: the watcher keeps the data\n"
+                                          "folder and the last proof current with DNS, it does not prove again every window.\n\n"
+                                          "Ex: " + sys.argv[0] + " jobs.txt --status watch.jsonl",
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("jobs", help="job file of scripts/scheduler.py, one '<domain> <8/13> <8/13> <0/1> [data path] [key]' per line")
+  parser.add_argument("--interval", type=float, default=3600, help="seconds between checks (default: %(default)s)")
+  parser.add_argument("--lead", type=float, default=2, help="days before RRSIG expiry to fetch and prove again (default: %(default)s)")
+  parser.add_argument("--once", action="store_true", help="check once, wait for the proofs it started and exit")
+  parser.add_argument("--dry-run", action="store_true", help="only report what would be proven again")
+  parser.add_argument("--status", help="append one JSON line per check and proof to this file")
+  parser.add_argument("--resolver", default="8.8.8.8", help="resolver to query, host or host:port (default: %(default)s)")
+  parser.add_argument("--tcp", action="store_true", help="send every query over one pipelined TCP connection")
+  parser.add_argument("--query-jobs", type=int, default=32, help="queries in flight at once (default: %(default)s)")
+  parser.add_argument("--bin", default="bin", help="folder with the built circuits (default: %(default)s)")
+  parser.add_argument("--max-jobs", type=int, default=None, help="proofs running at once at most (default: number of CPUs)")
+  parser.add_argument("--headroom", type=float, default=1, help="GB of memory to always leave free (default: %(default)s)")
+  parser.add_argument("--zkutil", default="zkutil", help="zkutil binary (default: %(default)s)")
+  parser.add_argument("--proof-cache", default=proofcache.DEFAULT_PATH, help="proof cache folder (default: %(default)s)")
+  parser.add_argument("--no-proof-cache", action="store_true", help="don't add the proofs to the proof cache")
+  args = parser.parse_args()
+  try:
+    jobs = scheduler.read_jobs(args.jobs)
+  except (OSError, ValueError) as e:
+    print("Error:", e)
+    sys.exit(1)
+  transport = dnstransport.Transport(*dnstransport.parse_resolver(args.resolver), use_tcp=args.tcp)
+  cache = None if args.no_proof_cache else proofcache.ProofCache(args.proof_cache)
+  prover = scheduler.Scheduler(args.bin, None, args.max_jobs, int(args.headroom * scheduler.GB), args.status, args.zkutil, 3600, cache)
+  watcher = Watcher(jobs, dnschain.Fetcher(transport), int(args.lead * DAY), prover, args.status, args.dry_run, args.query_jobs)
+  try:
+    asyncio.run(watcher.run(args.interval, args.once))
+  except KeyboardInterrupt:
+    pass
+  print(transport.stats())
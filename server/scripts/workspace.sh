@@ -0,0 +1,43 @@
+#!/bin/bash
+
+# per-job scratch folders for server.sh and bench.sh, sourced by both
+#
+# every intermediate file of a job (prover input, witness, proof, CSR) goes to
+# its own folder, so jobs of the same mode can run at once. the folder is on
+# tmpfs (/dev/shm) when there is one, which keeps the large .wtns files off the disk.
+# set WORKSPACE_ROOT to put workspaces somewhere else (e.g. if the witness
+# does not fit in memory), and KEEP_WORKSPACE=1 to keep them for debugging
+
+# create a workspace and print its path
+make_workspace () {
+    local ROOT="$WORKSPACE_ROOT"
+    if [ -z "$ROOT" ]; then
+        if [ -d /dev/shm ] && [ -w /dev/shm ]; then
+            ROOT=/dev/shm
+        else
+            ROOT="${TMPDIR:-/tmp}"
+        fi
+    fi
+    mkdir -p "$ROOT"
+    mktemp -d "$ROOT/nope-job-XXXXXX"
+}
+
+remove_workspace () {
+    if [ -n "$1" ] && [ "$KEEP_WORKSPACE" != "1" ]; then
+        rm -rf "$1"
+    elif [ -n "$1" ]; then
+        echo "Workspace kept in $1"
+    fi
+}
+
+# copy files from the workspace to their final place
+# promote SRC DST [SRC DST ...]
+# each file is copied next to its destination and renamed over it,
+# so readers never see a partly written file
+promote () {
+    while [ $# -ge 2 ]; do
+        cp "$1" "$2.$$.tmp"
+        mv -f "$2.$$.tmp" "$2"
+        shift 2
+    done
+}
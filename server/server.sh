@@ -4,13 +4,19 @@ set -exo pipefail
 
 SRC_PATH="./bin"
 SCRIPT_PATH="./scripts"
+SSCRIPT_PATH="../sscripts"
 FILEEXTS=(".r1cs" ".params" "-vk.json")
 
+source $SCRIPT_PATH/workspace.sh
+source $SCRIPT_PATH/trace.sh
+
 # To run this script, DNSSEC data must be fetched using 
 # sscripts/fetchmin.py (this goes to a data folder by default).
-# Also, the corresponding bind KSK must be parsed and placed under the same folder.
-# Parse ECDSA keys with scripts/eccextract.py and rename the output to domain.-DNSKEY-KSK-dlog.dat
-# Parse RSA keys with extract.py and rename the output to domain.-DNSKEY-KSK-factors.dat
+# Also, the corresponding bind KSK must be parsed and placed under the same folder:
+# set KSK_FILE to the bind private key (e.g. Kexample.com.+013+00000.private) and
+# scripts/keymat.py writes domain.-DNSKEY-KSK-dlog.dat or domain.-DNSKEY-KSK-factors.dat there,
+# or parse ECDSA keys with scripts/eccextract.py and rename the output to domain.-DNSKEY-KSK-dlog.dat
+# and RSA keys with extract.py and rename the output to domain.-DNSKEY-KSK-factors.dat
 # The corresponding circuits and keys also need to be compiled and exported. (To make sure of this, run `./build.sh` then `./export.sh`) 
 
 # Usage function
@@ -20,9 +26,16 @@ usage() {
     echo "  TLDALG  : Top-level domain algorithm (must be 8 or 13)"
     echo "  SLDALG  : Second-level domain algorithm (must be 8 or 13)"
     echo "  MAN     : Manager flag (must be 0 or 1)"
-    echo "  DATA_PATH : Path to the data file (must exist)"
+    echo "  DATA_PATH : Path to the data folder or chain container (must exist)"
     echo "  EMAIL   : Domain admin's email"
     echo "  KEY     : Optional TLS key file path (must exist if provided)"
+    echo "Set KSK_FILE to a bind private KSK to write its factors/dlog file to DATA_PATH first"
+    echo "Set PROVER_SOCKET to the socket of a running scripts/prover.py daemon to prove with it"
+    echo "Set TRACE to a file to append the time, CPU time and peak memory of each stage to it (see bench/parse.py)"
+    echo "Intermediate files go to a per-job workspace on /dev/shm, set WORKSPACE_ROOT to change it"
+    echo "Set PROOF_CACHE to the proof cache folder to use (default ~/.cache/nope/proofs), or to 0 to always prove"
+    echo "Set KEY_TYPE to p256 for a new ECDSA P-256 KEY instead of RSA 2048 (rsa2048, the default)"
+    echo "Set KEY_POOL to the TLS key pool folder to take a new KEY from (default ~/.cache/nope/keys), or to 0 to generate it"
     exit 1
 }
 
@@ -59,9 +72,22 @@ if [[ "$MAN" != "0" && "$MAN" != "1" ]]; then
     exit 1
 fi
 
-# Check if DATA_PATH is an existing directory
-if [ ! -d "$DATA_PATH" ]; then
-    echo "Error: The directory path provided in DATA_PATH does not exist."
+# Check if DATA_PATH is an existing directory or chain container (sscripts/chainpack.py)
+if [ ! -d "$DATA_PATH" ] && [ ! -f "$DATA_PATH" ]; then
+    echo "Error: The path provided in DATA_PATH does not exist."
+    exit 1
+fi
+
+# the KSK material can only be added to a data folder
+if [ -n "$KSK_FILE" ] && { [ ! -f "$KSK_FILE" ] || [ ! -d "$DATA_PATH" ]; }; then
+    echo "Error: KSK_FILE must exist and DATA_PATH must be a folder."
+    exit 1
+fi
+
+# type of a new TLS key, see KINDS in scripts/keypool.py
+KEY_TYPE=${KEY_TYPE:-rsa2048}
+if [[ "$KEY_TYPE" != "rsa2048" && "$KEY_TYPE" != "p256" ]]; then
+    echo "Error: Unsupported KEY_TYPE. Must be rsa2048 or p256."
     exit 1
 fi
 
@@ -75,8 +101,23 @@ else
     KEY="$SRC_PATH/$DOMAIN.key"
     # reuse previous key if exists
     if [ ! -f "$KEY" ]; then
-        echo "Generate new TLS key to $KEY"
-        openssl genrsa -out $KEY 2048 
+        # the pool needs its passphrase (see scripts/keypool.py), else the key is generated here
+        if [ "$KEY_POOL" != "0" ] && \
+           python3 $SCRIPT_PATH/keypool.py ${KEY_POOL:+--dir $KEY_POOL} --kind $KEY_TYPE claim $KEY > $KEY.pool; then
+            echo "Took new TLS key from the key pool to $KEY"
+            # the id of the pooled key, consumed once its certificate is issued (- if the pool was empty)
+            if [ "$(cat $KEY.pool)" == "-" ]; then
+                rm -f $KEY.pool
+            fi
+        else
+            rm -f $KEY.pool
+            echo "Generate new TLS key to $KEY"
+            if [ "$KEY_TYPE" == "p256" ]; then
+                openssl ecparam -name prime256v1 -genkey -noout -out $KEY
+            else
+                openssl genrsa -out $KEY 2048
+            fi
+        fi
     fi
 fi
 
@@ -100,29 +141,105 @@ check_files () {
 }
 
 prove () {
+    # every intermediate file goes to this job's own workspace, see scripts/workspace.sh
+    WORK=$(make_workspace)
+    trap 'remove_workspace $WORK' EXIT
+    echo "Workspace $WORK"
+
     echo "Get public key digest"
-    openssl rsa -in $KEY -pubout -out $SRC_PATH/${DOMAIN}.pub 
-    PUB_DIGEST=$(python3 $SCRIPT_PATH/hash_pub.py $SRC_PATH/${DOMAIN}.pub)
+    if [ -n "$KSK_FILE" ]; then
+        PUB_DIGEST=$(span digest python3 $SCRIPT_PATH/keymat.py digest $KEY --ksk $KSK_FILE --data $DATA_PATH --domain $DOMAIN)
+    else
+        PUB_DIGEST=$(span digest python3 $SCRIPT_PATH/keymat.py digest $KEY)
+    fi
 
     echo "Build prover input"
-    node $SCRIPT_PATH/make_input.js -d $DOMAIN -t $TLDALG -s $SLDALG -m $MAN -g $PUB_DIGEST -p $DATA_PATH
-    echo "Generate witness"
-    $SRC_PATH/${MODE}_cpp/$MODE $SRC_PATH/${MODE}_input.json $SRC_PATH/$MODE.wtns
-    # zkutil prove
-    zkutil prove -c $SRC_PATH/$MODE.r1cs -p $SRC_PATH/$MODE.params -r $SRC_PATH/${MODE}_proof.json -o $SRC_PATH/${MODE}_public.json -w $SRC_PATH/$MODE.wtns 
-    # Verifying
-    echo "Create CSR"
+    span input node $SCRIPT_PATH/make_input.js -d $DOMAIN -t $TLDALG -s $SLDALG -m $MAN -g $PUB_DIGEST -p $DATA_PATH -o $WORK
+    # make_input.js names the input after the domain when given a folder
+    INPUT="$WORK/${DOMAIN}$([ "$MAN" == "1" ] && echo "-man" || true)_input.json"
+    # digest of the chain the input was made from, kept next to the input in bin (see chaindiff.py)
+    CHAIN_DIGEST="${INPUT%_input.json}_chain.sha256"
+    if [ -d "$DATA_PATH" ]; then
+        python3 $SSCRIPT_PATH/chaindiff.py digest $DATA_PATH $DOMAIN $INPUT
+    fi
+    PROOF="$WORK/proof.json"
+    PUBLIC="$WORK/public.json"
+    # last proof made for this domain and mode
+    PREV="$SRC_PATH/${DOMAIN}-${MODE}"
     # calcualte circuite type
     TYPE=$(( ($TLDALG == 13 ? 1 : 0) * 4 + ($SLDALG == 13 ? 1 : 0) * 2 + ($MAN == 1 ? 1 : 0) ))
+    CACHE_ARGS=()
+    CACHED=0
+    # whether the proof was made from this input, and goes in the proof cache under it
+    PROVEN=1
+    # whether the proof replaces the last proof of this domain and mode
+    PROMOTE=1
+    if [ -n "$PROOF_CACHE" ]; then
+        CACHE_ARGS=(--dir $PROOF_CACHE)
+    fi
+    # the same prover input was proven before (same chain, key and time window)
+    if [ "$PROOF_CACHE" != "0" ] && \
+       span cache python3 $SCRIPT_PATH/proofcache.py ${CACHE_ARGS[@]} get $MODE $INPUT $PROOF $PUBLIC; then
+        echo "Use cached proof"
+        CACHED=1
+    # if the chain is the one the last proof was made from, up to new signatures,
+    # and the public inputs are the same, the last proof still holds
+    elif [ -d "$DATA_PATH" ] && [ -f "${PREV}_proof.json" ] && \
+       python3 $SSCRIPT_PATH/chaindiff.py reusable $DATA_PATH $DOMAIN $INPUT ${PREV}_input.json; then
+        echo "Reuse previous proof"
+        cp ${PREV}_proof.json $PROOF
+        cp ${PREV}_public.json $PUBLIC
+        PROVEN=0
+        PROMOTE=0
+    elif [ -n "$PROVER_SOCKET" ] && [ -S "$PROVER_SOCKET" ]; then
+        # a running scripts/prover.py daemon has the circuit artifacts loaded already
+        echo "Prove with daemon at $PROVER_SOCKET"
+        span prove python3 $SCRIPT_PATH/prover.py --socket $PROVER_SOCKET prove --mode $MODE --input $INPUT --proof $PROOF --public $PUBLIC
+    else
+        echo "Generate witness"
+        span witness $SRC_PATH/${MODE}_cpp/$MODE $INPUT $WORK/$MODE.wtns
+        # zkutil prove
+        span prove zkutil prove -c $SRC_PATH/$MODE.r1cs -p $SRC_PATH/$MODE.params -r $PROOF -o $PUBLIC -w $WORK/$MODE.wtns
+        # the witness is the largest file of the job and not needed any more
+        rm -f $WORK/$MODE.wtns
+    fi
+    if [ "$PROOF_CACHE" != "0" ] && [ "$CACHED" == "0" ] && [ "$PROVEN" == "1" ]; then
+        # the proof is made, a failed cache write only costs the next run with the same input
+        python3 $SCRIPT_PATH/proofcache.py ${CACHE_ARGS[@]} put $MODE $INPUT $PROOF $PUBLIC --type $TYPE --domain $DOMAIN || \
+            echo "Could not add the proof to the proof cache"
+    fi
+    # Verifying
+    echo "Create CSR"
     # assume there is only one SAN
-    SAN=$(python3 $SCRIPT_PATH/compress.py $SRC_PATH/${MODE}_proof.json $TYPE $DOMAIN)
-    openssl req -new -nodes -out "$SRC_PATH/$DOMAIN.csr" -key "$KEY" -subj "/CN=$DOMAIN" -addext "subjectAltName = DNS:$DOMAIN, DNS:$SAN" 
+    SAN=$(span compress python3 $SCRIPT_PATH/compress.py $PROOF $TYPE $DOMAIN)
+    span csr openssl req -new -nodes -out "$WORK/$DOMAIN.csr" -key "$KEY" -subj "/CN=$DOMAIN" -addext "subjectAltName = DNS:$DOMAIN, DNS:$SAN"
+
+    # the job succeeded, keep its results in bin
+    if [ "$PROMOTE" == "1" ]; then
+        promote $INPUT ${PREV}_input.json $PROOF ${PREV}_proof.json $PUBLIC ${PREV}_public.json
+        if [ -f "$CHAIN_DIGEST" ]; then
+            promote $CHAIN_DIGEST ${PREV}_chain.sha256
+        else
+            rm -f ${PREV}_chain.sha256
+        fi
+    fi
+    promote $WORK/$DOMAIN.csr $SRC_PATH/$DOMAIN.csr
 
     # now we run the acme server
-    python3 src/app.py -e $EMAIL -d $DOMAIN --csr $SRC_PATH/$DOMAIN.csr --domain_key $KEY
+    span acme python3 src/app.py -e $EMAIL -d $DOMAIN --csr $SRC_PATH/$DOMAIN.csr --domain_key $KEY
+
+    # the certificate is issued, the pooled key leaves the pool for good; if an earlier step
+    # failed, the key stays claimed and this domain reuses it next time
+    if [ -f "$KEY.pool" ]; then
+        python3 $SCRIPT_PATH/keypool.py ${KEY_POOL:+--dir $KEY_POOL} --kind $KEY_TYPE consume $(cat $KEY.pool) && \
+            rm -f $KEY.pool || echo "Could not take key $(cat $KEY.pool) out of the key pool"
+    fi
 }
 
 check_files $MODE
 
+# one id per run in the trace
+TRACE_RUN=${TRACE_RUN:-$DOMAIN-$$}
+
 export NODE_OPTIONS=--max-old-space-size=8192
 prove
@@ -1,13 +1,15 @@
 import argparse
+import sys
 import josepy as jose
-import OpenSSL
 import os
 import json
 import time
 import datetime
+import threading
+import concurrent.futures
 
+import requests
 from acme import challenges
-from acme import client
 from acme import crypto_util
 from acme import errors
 from acme import messages
@@ -16,18 +18,35 @@ from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import rsa
 
+import publish
+import propagation
+import session
+
+# the TLS key pool is shared with server.sh
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import keypool
+
+DIRECTORY_URL = 'https://acme-v02.api.letsencrypt.org/directory'
+
 # Parse command-line arguments
 parser = argparse.ArgumentParser(description="ACME client for DNS-01 challenge")
 parser.add_argument("-e", "--email", type=str, help="Contact email for ACME registration", required=True)
-parser.add_argument("-d", "--domain", action="append", type=str, required=True, help="Domain name(s)")
+parser.add_argument("-d", "--domain", action="append", type=str, help="Domain name(s)")
 parser.add_argument("--csr", type=str, help="Path to an existing CSR file (optional)")
 parser.add_argument("--domain_key", type=str, help="Path to an existing domain key file (optional)")
+parser.add_argument("--batch", type=str, help="File with one order per line, '<domain>[,<domain>...] [csr path] [domain key path]' "
+                    "('-' for none), issued concurrently over one account instead of -d")
+parser.add_argument("--workers", type=int, default=8, help="Orders of a batch in flight at once")
+parser.add_argument("--directory", type=str, default=DIRECTORY_URL, help="ACME directory URL")
+parser.add_argument("--acme-deadline", type=float, default=90, help="Seconds from answering the challenges to the certificate")
+parser.add_argument("--key-pool", type=str, default=keypool.DEFAULT_PATH, help="Pool of pre-generated TLS keys (scripts/keypool.py) to take new keys from")
+parser.add_argument("--no-key-pool", action="store_true", help="Generate new TLS keys instead of taking them from the pool")
+parser.add_argument("--key-type", choices=keypool.KINDS, default=keypool.DEFAULT_KIND,
+                    help="Type of new TLS keys, RSA 2048 or ECDSA P-256 (smaller certificates, near-instant key generation)")
 parser.add_argument('--time_it', action='store_true', help="Enable timing of operations")
+publish.add_arguments(parser)
+propagation.add_arguments(parser)
 args = parser.parse_args()
-if len(str(args.domain)) < 250:
-    out_name = str(args.domain)
-else:
-    out_name = str(args.domain)[:250]
 
 if not os.path.exists('./dat'):
     os.mkdir('./dat')
@@ -35,17 +54,23 @@ if not os.path.exists('./dat'):
 # default
 acc_key_path = "./dat/account_key.pem"
 regr_file_path = "./dat/account_regr.json"
-
-DIRECTORY_URL = 'https://acme-v02.api.letsencrypt.org/directory'
+directory_cache_path = "./dat/directory.json"
 
 # Account key size
 ACC_KEY_BITS = 2048
 
-# Certificate private key size
-CERT_PKEY_BITS = 2048
-
 USER_AGENT = 'python-acme-example'
 
+
+class IssueError(Exception):
+    pass
+
+
+# what can go wrong with one order, without stopping the others
+ORDER_ERRORS = (IssueError, publish.PublishError, errors.Error, messages.Error,
+                requests.RequestException, OSError, ValueError)
+
+
 # Useful methods and classes:
 def load_or_generate_acc_key(file_path):
     if file_path and os.path.exists(file_path):
@@ -77,9 +102,12 @@ def load_or_generate_acc_key(file_path):
 
     return jose.JWKRSA(key=private_key)
 
-def csr_comp(domain_name, pkey_path=None, csr_path=None):
+def csr_comp(domain_name, pkey_path=None, csr_path=None, pkey_pem=None, key_type=keypool.DEFAULT_KIND):
     """Load/Create/Dump certificate signing request."""
-    if pkey_path and os.path.exists(pkey_path):
+    if pkey_pem is not None:
+        # a key taken from the key pool
+        pass
+    elif pkey_path and os.path.exists(pkey_path):
         with open(pkey_path, 'rb') as key_file:
             pkey_pem = serialization.load_pem_private_key(
                 key_file.read(),
@@ -93,10 +121,8 @@ def csr_comp(domain_name, pkey_path=None, csr_path=None):
             encryption_algorithm=serialization.NoEncryption()
         )
     else:
-        # Create private key.
-        pkey = OpenSSL.crypto.PKey()
-        pkey.generate_key(OpenSSL.crypto.TYPE_RSA, CERT_PKEY_BITS)
-        pkey_pem = OpenSSL.crypto.dump_privatekey(OpenSSL.crypto.FILETYPE_PEM, pkey)
+        # Create private key (RSA or ECDSA P-256, see keypool.KINDS).
+        pkey_pem = keypool.key_pem(keypool.generate_key(key_type))
     if csr_path and os.path.exists(csr_path):
         with open(csr_path, 'rb') as csr_file:
             csr_pem = x509.load_pem_x509_csr(
@@ -128,62 +154,201 @@ def select_dns01_chall(orderr):
 
     if len(DNS_challenges) > 0:
         return DNS_challenges
-    raise Exception('DNS-01 challenge was not offered by the CA server.')
-
-
-def main():
-    if args.csr and not os.path.exists(args.csr):
-        print("invalid csr path") 
-        exit(1)
-    if args.domain_key and not os.path.exists(args.domain_key):
-        print("invalid domain_key path") 
-        exit(1)
-    
-    # timer start
-    timing_info = {}
-
-    def mark_time(event_name, point):
-        if args.time_it:
-            if event_name not in timing_info:
-                timing_info[event_name] = {}
-            timing_info[event_name][point] = time.perf_counter()
-    
-    mark_time('key_csr_gen', 'start')
-    pkey_pem, csr_pem = csr_comp(args.domain, args.domain_key, args.csr)
-    mark_time('key_csr_gen', 'end')
+    raise IssueError('DNS-01 challenge was not offered by the CA server.')
+
+
+def output_name(domains):
+    """Name of the output files of an order: its first domain and the number of others."""
+    name = domains[0].replace("*", "_").replace("/", "_")
+    if len(domains) > 1:
+        name += f"+{len(domains) - 1}"
+    return name[:250]
+
+
+class Timer:
+    """Start and end of each event, for --time_it and the batch summary."""
+
+    def __init__(self):
+        self.events = {}
+        # time summed over several stretches, e.g. the sleeps between polls
+        self.totals = {}
+
+    def mark(self, event_name, point):
+        self.events.setdefault(event_name, {})[point] = time.perf_counter()
+
+    def add(self, event_name, seconds):
+        self.totals[event_name] = self.totals.get(event_name, 0) + seconds
+
+    def durations(self):
+        durations = {e: t['end'] - t['start'] for e, t in self.events.items() if 'start' in t and 'end' in t}
+        durations.update(self.totals)
+        return durations
+
+    def write(self, name):
+        with open(f"./dat/{datetime.datetime.now().strftime('%Y%m%d%H%M%S')+name}.dat", "w") as f:
+            f.write(f"{name}\n")
+            for e, seconds in self.durations().items():
+                f.write(f"{e} took {seconds} seconds\n")
+
+
+class Order:
+    """One certificate: its domains, optional CSR and key, and where its outputs go."""
+
+    def __init__(self, domains, csr=None, domain_key=None):
+        self.domains = domains
+        self.csr = csr
+        self.domain_key = domain_key
+        self.name = output_name(domains)
+        self.timer = Timer()
+        self.error = None
+        self.elapsed = None
+        # the key pool and id of the key taken from it, if any, and that key and
+        # its CSR, kept in memory until the certificate is issued
+        self.key_pool = None
+        self.pool_key = None
+        self.key_pem = None
+        self.csr_pem = None
+
+    def settle_key(self, issued):
+        """Take the pooled key out of the pool once its certificate is issued, else put it back.
+
+        Until then the key never left the process, so it can go back as it is.
+        """
+        if self.pool_key is None:
+            return
+        try:
+            if issued:
+                self.key_pool.consume(self.pool_key)
+            else:
+                self.key_pool.release(self.pool_key)
+        except OSError as e:
+            print(f"Could not {'consume' if issued else 'release'} key {self.pool_key} of the key pool: {e}")
+        self.pool_key = None
+
+    def save_pooled_key(self):
+        """Write the pooled key and its CSR to ./dat once the certificate is issued."""
+        if self.pool_key is None:
+            return
+        try:
+            with open(os.open(f"./dat/{self.name}.key", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as key_file:
+                key_file.write(self.key_pem)
+            with open(f"./dat/{self.name}.csr", 'wb') as csr_file:
+                csr_file.write(self.csr_pem)
+        finally:
+            # the certificate is for this key, it must never be handed out again
+            self.settle_key(issued=True)
+
+
+class LazyKeyPool:
+    """The key pool, opened by the first order that needs a new key.
+
+    Orders with a CSR or key of their own never pay for the key derivation, and
+    without a usable pool (no passphrase, wrong passphrase) keys are generated inline.
+    """
+
+    def __init__(self, path, kind):
+        self.path = path
+        self.kind = kind
+        self.lock = threading.Lock()
+        self.pool = None
+        self.failed = False
+
+    def get(self):
+        with self.lock:
+            if self.pool is None and not self.failed:
+                try:
+                    self.pool = keypool.KeyPool(self.path, self.kind)
+                except (OSError, ValueError) as e:
+                    print(f"Not using the key pool: {e}")
+                    self.failed = True
+            return self.pool
+
+
+def read_batch(path):
+    """Orders of a --batch file."""
+    orders = []
+    with open(path, 'r') as f:
+        for number, line in enumerate(f, 1):
+            fields = line.split('#')[0].split()
+            if not fields:
+                continue
+            if len(fields) > 3:
+                raise ValueError(f"{path}:{number}: expected '<domain>[,<domain>...] [csr path] [domain key path]'")
+            csr, domain_key = [None if p == '-' else p for p in fields[1:] + ['-'] * (3 - len(fields))]
+            orders.append(Order(fields[0].split(','), csr, domain_key))
+    names = [order.name for order in orders]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"{path}: more than one order writes to ./dat/{duplicates[0]}.*")
+    return orders
+
+
+def check_paths(order):
+    if order.csr and not os.path.exists(order.csr):
+        raise IssueError(f"invalid csr path {order.csr}")
+    if order.domain_key and not os.path.exists(order.domain_key):
+        raise IssueError(f"invalid domain_key path {order.domain_key}")
+
+
+def prepare(order, key_pool=None):
+    """Load or make the key and CSR of an order, and save the new ones."""
+    order.timer.mark('key_csr_gen', 'start')
+    pkey_pem = None
+    # a new key only matters when there is no CSR to take the key of
+    if key_pool and not (order.domain_key and os.path.exists(order.domain_key)) and not (order.csr and os.path.exists(order.csr)):
+        pool = key_pool.get()
+        if pool:
+            try:
+                order.pool_key, pkey_pem = pool.claim()
+                order.key_pool = pool
+            except (OSError, ValueError) as e:
+                # the key is generated below instead
+                print(f"Not using the key pool: {e}")
+    pkey_pem, csr_pem = csr_comp(order.domains, order.domain_key, order.csr, pkey_pem, args.key_type)
+    order.timer.mark('key_csr_gen', 'end')
+
+    if order.pool_key is not None:
+        # a pooled key is only written out (see save_pooled_key) once its certificate is issued,
+        # so that an order that fails can put it back
+        order.key_pem, order.csr_pem = pkey_pem, csr_pem
+        return csr_pem
 
     # Check if a new private key was generated and needs to be saved
-    if not args.domain_key or not os.path.exists(args.domain_key):
-        pkey_path = f"./dat/{out_name}.key"  # Default path for saving the private key
+    if not order.domain_key or not os.path.exists(order.domain_key):
+        pkey_path = f"./dat/{order.name}.key"  # Default path for saving the private key
         with open(pkey_path, 'wb') as key_file:
             key_file.write(pkey_pem)
 
     # Check if a new CSR was generated and needs to be saved
-    if not args.csr or not os.path.exists(args.csr):
-        csr_path = f"./dat/{out_name}.csr"  # Default path for saving the private csr
+    if not order.csr or not os.path.exists(order.csr):
+        csr_path = f"./dat/{order.name}.csr"  # Default path for saving the private csr
         with open(csr_path, 'wb') as csr_file:
             csr_file.write(csr_pem)
+    return csr_pem
+
 
+def connect(email, timer, workers=1):
+    """ACME session of the saved account, registered first if there is none."""
     acc_key = load_or_generate_acc_key(acc_key_path)
+    acc_regr = None
     if os.path.exists(acc_key_path) and os.path.exists(regr_file_path):
         with open(regr_file_path, 'rb') as regr_file:
             acc_regr = json.load(regr_file)
-        mark_time('acme_connect', 'start')
-        net = client.ClientNetwork(acc_key, account=acc_regr, user_agent=USER_AGENT)
+        timer.mark('acme_connect', 'start')
     # connect server
     else:
-        mark_time('acc_regr', 'start')
-        net = client.ClientNetwork(acc_key, user_agent=USER_AGENT)
-    directory = client.ClientV2.get_directory(DIRECTORY_URL, net)
-    client_acme = client.ClientV2(directory, net=net)
+        timer.mark('acc_regr', 'start')
+    # the directory comes from its cache file, the connections and nonces are set up in the background
+    acme_session = session.AcmeSession(acc_key, args.directory, account=acc_regr, user_agent=USER_AGENT,
+                                       workers=workers, directory_cache=directory_cache_path)
+    client_acme = acme_session.client
 
     if not os.path.exists(regr_file_path):
         # Register account and accept TOS
-        email = (args.email)
         regr = client_acme.new_account(
             messages.NewRegistration.from_data(
                 email=email, terms_of_service_agreed=True))
-        mark_time('acc_regr', 'end')
+        timer.mark('acc_regr', 'end')
         regr_data = {
             'uri': regr.uri,  # The account URI, acting as Key ID in ACME v2
             'terms_of_service': getattr(regr, 'terms_of_service', None)
@@ -191,8 +356,14 @@ def main():
         with open(regr_file_path, 'w') as regr_file:
             json.dump(regr_data, regr_file)
     else:
-        mark_time('acme_connect', 'end')
+        timer.mark('acme_connect', 'end')
+    return acme_session
 
+
+def issue(acme_session, order, csr_pem, publisher):
+    """Run an order from new-order to its certificate, raise IssueError if it fails."""
+    client_acme = acme_session.client
+    mark_time = order.timer.mark
     mark_time('order_req', 'start')
     # Issue certificate
     orderr = client_acme.new_order(csr_pem)
@@ -202,48 +373,157 @@ def main():
     # {domain: challb, ...}
     mark_time('order_req', 'end')
     challb_responses = []
+    records = []
 
     for domain, challb in challbs.items():
         # Perform DNS-01 challenge.
         response, validation = challb.response_and_validation(client_acme.net.key)
-        dns_record_name = "_acme-challenge." + domain
-        if not dns_record_name.endswith("."):
-          dns_record_name += "."
-        print(f"Please create a DNS TXT record in your zone:")
-        print(f"{dns_record_name}\tIN\tTXT\t\"{validation}\"")
+        records.append((publish.challenge_name(domain), validation))
         challb_responses.append((challb, response))
 
-    mark_time('dns_prop', 'start')
-    # Wait for challenge status and then issue a certificate.
-    # It is possible to set a deadline time.
-    input("Press Enter after you have added the DNS record and it has propagated...")
-    mark_time('dns_prop', 'end')
-
-
-    mark_time('ans_chal', 'start')
-    for (challb, response) in challb_responses:
-        # Let the CA server know that we are ready for the challenge.
-        client_acme.answer_challenge(challb, response)
-    mark_time('ans_chal', 'end')
-
-    mark_time('order_comp', 'start')
-    try:
-        finalized_orderr = client_acme.poll_and_finalize(orderr)
-    except:
-        print("Validation failed, try again")
-        exit(1)
-    mark_time('order_comp', 'end')
+    # the records of every authorization go out in one update,
+    # and are removed once the order is done, whatever the outcome
+    with publisher:
+        mark_time('dns_prop', 'start')
+        mark_time('dns_publish', 'start')
+        try:
+            publisher.publish(records)
+        except publish.PublishError as e:
+            raise IssueError(f"Could not publish the challenge records: {e}") from e
+        mark_time('dns_publish', 'end')
+        # answer as soon as every authoritative nameserver serves the records
+        if not args.no_ns_poll:
+            mark_time('ns_poll', 'start')
+            try:
+                nameservers = [propagation.parse_server(ns) for ns in args.ns] if args.ns else None
+                propagation.wait(records, nameservers, args.ns_deadline)
+            except propagation.PropagationError as e:
+                raise IssueError(f"Challenge records did not propagate: {e}") from e
+            mark_time('ns_poll', 'end')
+        mark_time('dns_prop', 'end')
+
+        mark_time('ans_chal', 'start')
+        # Let the CA server know that we are ready for the challenges, all at once.
+        acme_session.answer(challb_responses)
+        mark_time('ans_chal', 'end')
+
+        # order_comp is split into authz_wait, finalize, cert_wait and cert_download
+        mark_time('order_comp', 'start')
+        try:
+            finalized_orderr = acme_session.finish(orderr, args.acme_deadline, order.timer)
+        except errors.ValidationError as e:
+            raise IssueError(f"Validation failed:\n{e}") from e
+        except errors.TimeoutError as e:
+            raise IssueError(f"No certificate {args.acme_deadline:g} seconds after answering the challenges") from e
+        except errors.IssuanceError as e:
+            raise IssueError(f"The CA did not issue the certificate: {e.error}") from e
+        mark_time('order_comp', 'end')
 
     fullchain_pem = finalized_orderr.fullchain_pem
-    fullchain_path = f"./dat/{out_name}.crt"  # Default path for saving the private crt
+    fullchain_path = f"./dat/{order.name}.crt"  # Default path for saving the private crt
     with open(fullchain_path, 'w') as fullchain_file:
         fullchain_file.write(fullchain_pem)
+    order.save_pooled_key()
+
+    if args.time_it:
+        order.timer.write(order.name)
+
+
+def run_order(acme_session, order, key_pool=None):
+    """Issue one order of a batch, keeping its error instead of raising it."""
+    start = time.perf_counter()
+    try:
+        check_paths(order)
+        csr_pem = prepare(order, key_pool)
+        issue(acme_session, order, csr_pem, publish.make_publisher(args, tag=order.name))
+    except ORDER_ERRORS as e:
+        order.error = str(e) or type(e).__name__
+        order.settle_key(issued=False)
+    order.elapsed = time.perf_counter() - start
+    print(f"{order.name}: {'failed, ' + order.error if order.error else 'issued'} after {order.elapsed:.2f} seconds", flush=True)
+    return order
+
+
+def summarize_batch(orders, account_timer, wall, acme_session):
+    """Print and return the aggregate timing of a batch."""
+    issued = [order for order in orders if order.error is None]
+    events = {}
+    for order in issued:
+        for e, seconds in order.timer.durations().items():
+            events.setdefault(e, []).append(seconds)
+    summary = {
+        "orders": len(orders),
+        "issued": len(issued),
+        "workers": args.workers,
+        "wall": wall,
+        # time the orders would have taken one after the other
+        "sequential": sum(order.elapsed for order in orders),
+        "account": account_timer.durations(),
+        "nonces": acme_session.stats(),
+        "events": {e: {"mean": sum(s) / len(s), "max": max(s), "total": sum(s)} for e, s in events.items()},
+        "failed": {order.name: order.error for order in orders if order.error is not None},
+    }
+    print(f"Issued {len(issued)}/{len(orders)} certificates in {wall:.2f} seconds "
+          f"({summary['sequential']:.2f} seconds of orders, {args.workers} workers)")
+    for e, stats in summary["events"].items():
+        print(f"  {e:<13} mean {stats['mean']:.2f} s, max {stats['max']:.2f} s")
+    for name, error in summary["failed"].items():
+        print(f"  {name}: {error}")
+    print("Nonces: " + ", ".join(f"{k} {v}" for k, v in summary["nonces"].items()))
+    return summary
+
+
+def batch_main():
+    """Issue every order of --batch, return the exit code."""
+    try:
+        orders = read_batch(args.batch)
+    except (OSError, ValueError) as e:
+        print(e)
+        return 1
+    if args.dns_publisher == "manual":
+        print("a batch needs --dns-publisher nsupdate or zonefile")
+        return 1
+
+    start = time.perf_counter()
+    # one account, directory and session for every order
+    account_timer = Timer()
+    key_pool = None if args.no_key_pool else LazyKeyPool(args.key_pool, args.key_type)
+    try:
+        acme_session = connect(args.email, account_timer, args.workers)
+    except ORDER_ERRORS as e:
+        print(f"Could not connect to {args.directory}: {e}")
+        return 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        list(pool.map(lambda order: run_order(acme_session, order, key_pool), orders))
+    summary = summarize_batch(orders, account_timer, time.perf_counter() - start, acme_session)
+    acme_session.close()
 
     if args.time_it:
-        with open(f"./dat/{datetime.datetime.now().strftime('%Y%m%d%H%M%S')+out_name}.dat", "w") as f:
-            f.write(f"{out_name}\n")
-            for e, t in timing_info.items():
-                f.write(f"{e} took {t['end']-t['start']} seconds\n")
+        with open(f"./dat/{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}-batch.json", "w") as f:
+            json.dump(summary, f, indent=2)
+    return 1 if summary["failed"] else 0
+
+
+def main():
+    """Issue the -d order or the --batch orders, return the exit code."""
+    if args.batch:
+        return batch_main()
+    if not args.domain:
+        print("-d/--domain or --batch is required")
+        return 1
+    order = Order(args.domain, args.csr, args.domain_key)
+    try:
+        check_paths(order)
+        publisher = publish.make_publisher(args)
+        key_pool = None if args.no_key_pool else LazyKeyPool(args.key_pool, args.key_type)
+        csr_pem = prepare(order, key_pool)
+        acme_session = connect(args.email, order.timer)
+        issue(acme_session, order, csr_pem, publisher)
+    except ORDER_ERRORS as e:
+        print(e)
+        order.settle_key(issued=False)
+        return 1
+    return 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""Wait until every authoritative nameserver serves the challenge records.
+
+Instead of a fixed wait after publishing, the zone's nameservers are found
+(or given with --ns) and all of them are queried in parallel for each
+_acme-challenge TXT value, with exponential backoff, until they all serve it
+or the deadline passes:
+
+    elapsed = propagation.wait(records, deadline=120)
+"""
+import asyncio
+import socket
+import time
+
+import dns.asyncquery
+import dns.asyncresolver
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.rdatatype
+import dns.resolver
+
+# first and largest delay between two queries to the same nameserver
+INITIAL_DELAY = 0.25
+MAX_DELAY = 4
+
+
+class PropagationError(Exception):
+    pass
+
+
+def parse_server(text, port=53):
+    """Split "host", "host:port" or "[ipv6]:port" and resolve the host to an address.
+
+    dns.query only takes addresses, so a nameserver given by name is looked up here.
+    """
+    if text.startswith("["):
+        host, _, rest = text[1:].partition("]")
+        port = int(rest[1:]) if rest else port
+    elif text.count(":") == 1:
+        host, rest = text.split(":")
+        port = int(rest)
+    else:
+        host = text
+    try:
+        return socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0][4][0], port
+    except socket.gaierror as e:
+        raise PropagationError(f"could not resolve nameserver {host}: {e}") from e
+
+
+async def find_nameservers(zone, resolver):
+    """Addresses of the authoritative nameservers of a zone."""
+    addresses = []
+    for ns in await resolver.resolve(zone, "NS"):
+        for rdtype in ("A", "AAAA"):
+            try:
+                addresses += [(rd.address, 53) for rd in await resolver.resolve(ns.target, rdtype)]
+            except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+                pass
+    if not addresses:
+        raise PropagationError(f"no nameserver addresses found for {zone}")
+    return addresses
+
+
+async def serves(server, name, value, timeout):
+    """Whether a nameserver answers name TXT with value among the records."""
+    query = dns.message.make_query(name, dns.rdatatype.TXT)
+    # ask the nameserver itself, not whatever it may recurse to
+    query.flags &= ~dns.flags.RD
+    response = await dns.asyncquery.udp(query, server[0], timeout=timeout, port=server[1])
+    if response.flags & dns.flags.TC:
+        response = await dns.asyncquery.tcp(query, server[0], timeout=timeout, port=server[1])
+    for rrset in response.answer:
+        if rrset.rdtype == dns.rdatatype.TXT:
+            for rd in rrset:
+                if b"".join(rd.strings).decode(errors="replace") == value:
+                    return True
+    return False
+
+
+async def wait_one(server, name, value, start, deadline, timeout):
+    """Poll one nameserver for one record, return the seconds until it served it."""
+    delay = INITIAL_DELAY
+    while True:
+        try:
+            if await serves(server, name, value, min(timeout, max(0.1, deadline - time.perf_counter()))):
+                return time.perf_counter() - start
+        except (OSError, dns.exception.DNSException):
+            # a lost query or a nameserver still reloading, ask again
+            pass
+        if time.perf_counter() + delay > deadline:
+            raise PropagationError(f"{server[0]}:{server[1]} did not serve {name} TXT \"{value}\" in time")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, MAX_DELAY)
+
+
+async def wait_async(records, nameservers=None, deadline=120, timeout=2, resolver=None):
+    start = time.perf_counter()
+    end = start + deadline
+    resolver = resolver or dns.asyncresolver.Resolver()
+    zones = {}
+    checks = []
+    for name, value in records:
+        servers = nameservers
+        if not servers:
+            zone = await dns.asyncresolver.zone_for_name(name, resolver=resolver)
+            if zone not in zones:
+                zones[zone] = await find_nameservers(zone, resolver)
+            servers = zones[zone]
+        checks += [(server, name, value) for server in servers]
+    results = await asyncio.gather(*(wait_one(server, name, value, start, end, timeout)
+                                     for server, name, value in checks), return_exceptions=True)
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors:
+        raise errors[0] if isinstance(errors[0], PropagationError) else PropagationError(str(errors[0]))
+    elapsed = {}
+    for (server, name, _), seconds in zip(checks, results):
+        print(f"{server[0]}:{server[1]} serves {name} after {seconds:.2f} s")
+        elapsed[name] = max(elapsed.get(name, 0), seconds)
+    return elapsed
+
+
+def wait(records, nameservers=None, deadline=120, timeout=2, resolver=None):
+    """Wait until every nameserver serves every (name, value) TXT record.
+
+    nameservers is a list of (address, port), found from each name's zone if None.
+    resolver is a dns.asyncresolver.Resolver, the system's by default.
+    Return {name: seconds until the last nameserver served it}, raise
+    PropagationError if one did not serve a record before the deadline (seconds).
+    """
+    try:
+        return asyncio.run(wait_async(records, nameservers, deadline, timeout, resolver))
+    except dns.exception.DNSException as e:
+        raise PropagationError(f"could not find the nameservers: {e}") from e
+
+
+def add_arguments(parser):
+    """The propagation options of app.py."""
+    parser.add_argument("--ns", action="append", help="Authoritative nameserver to poll, host or host:port "
+                        "(repeat for several; default: the NS records of the zone)")
+    parser.add_argument("--ns-deadline", type=float, default=120, help="Seconds to wait for every nameserver to serve the records")
+    parser.add_argument("--no-ns-poll", action="store_true", help="Answer the challenges right after publishing, without polling")
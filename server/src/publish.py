@@ -0,0 +1,262 @@
+"""Publish and remove the _acme-challenge TXT records of DNS-01 challenges.
+
+Every publisher takes all the records of an order at once, so each zone gets
+one update (one RFC 2136 message, or one zone file edit and reload), and
+removes exactly what it published in cleanup():
+
+    with make_publisher(args) as publisher:
+        publisher.publish([("_acme-challenge.example.com.", "token"), ...])
+        ...  # answer the challenges
+"""
+import abc
+import os
+import re
+import shlex
+import subprocess
+import threading
+
+import dns.exception
+import dns.name
+import dns.query
+import dns.rcode
+import dns.rdatatype
+import dns.message
+import dns.tsigkeyring
+import dns.update
+
+import propagation
+
+DEFAULT_TTL = 60
+
+
+class PublishError(Exception):
+    pass
+
+
+def challenge_name(domain):
+    """Owner name of the DNS-01 record of a domain."""
+    name = "_acme-challenge." + domain
+    if not name.endswith("."):
+        name += "."
+    return name
+
+
+class Publisher(abc.ABC):
+    """Publishes (name, value) TXT records, then removes them again."""
+
+    @abc.abstractmethod
+    def publish(self, records):
+        pass
+
+    def cleanup(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
+
+
+class ManualPublisher(Publisher):
+    """Ask the operator to add the records (the original app.py flow)."""
+
+    def publish(self, records):
+        print("Please create a DNS TXT record in your zone:")
+        for name, value in records:
+            print(f"{name}\tIN\tTXT\t\"{value}\"")
+        input("Press Enter after you have added the DNS record and it has propagated...")
+
+
+def read_tsig_keyfile(path):
+    """Keyring of a BIND key file (tsig-keygen / ddns-confgen output)."""
+    with open(path, 'r') as f:
+        text = f.read()
+    match = re.search(r'key\s+"?([^"\s{]+)"?\s*\{(.*?)\}\s*;', text, re.S)
+    if not match:
+        raise PublishError(f"no key in {path}")
+    name, body = match.groups()
+    algorithm = re.search(r'algorithm\s+"?([^";\s]+)"?\s*;', body)
+    secret = re.search(r'secret\s+"([^"]+)"\s*;', body)
+    if not secret:
+        raise PublishError(f"no secret for key {name} in {path}")
+    algorithm = algorithm.group(1) if algorithm else "hmac-sha256"
+    return dns.tsigkeyring.from_text({name: (algorithm, secret.group(1))}), dns.name.from_text(name)
+
+
+class NsupdatePublisher(Publisher):
+    """RFC 2136 dynamic update, optionally TSIG-signed, sent to the primary server.
+
+    server is an address, dns.query does not resolve names (see make_publisher).
+    """
+
+    def __init__(self, server, port=53, zone=None, keyfile=None, ttl=DEFAULT_TTL, timeout=10):
+        self.server = server
+        self.port = port
+        self.zone = zone
+        self.ttl = ttl
+        self.timeout = timeout
+        self.keyring = self.keyname = None
+        if keyfile:
+            self.keyring, self.keyname = read_tsig_keyfile(keyfile)
+        self.published = []
+
+    def find_zone(self, name):
+        """The zone a name belongs to, as the server sees it (closest enclosing SOA)."""
+        if self.zone:
+            return dns.name.from_text(self.zone)
+        name = start = dns.name.from_text(name)
+        while True:
+            response = dns.query.udp(dns.message.make_query(name, dns.rdatatype.SOA), self.server,
+                                     port=self.port, timeout=self.timeout)
+            for rrset in response.answer + response.authority:
+                if rrset.rdtype == dns.rdatatype.SOA:
+                    return rrset.name
+            if name == dns.name.root:
+                raise PublishError(f"no zone found for {start}")
+            name = name.parent()
+
+    def send(self, zone, records, delete=False):
+        update = dns.update.UpdateMessage(zone, keyring=self.keyring, keyname=self.keyname)
+        for name, value in records:
+            relative = dns.name.from_text(name).relativize(zone)
+            if delete:
+                update.delete(relative, "TXT", f'"{value}"')
+            else:
+                update.add(relative, self.ttl, "TXT", f'"{value}"')
+        response = dns.query.tcp(update, self.server, port=self.port, timeout=self.timeout)
+        if response.rcode() != dns.rcode.NOERROR:
+            raise PublishError(f"update of {zone} refused: {dns.rcode.to_text(response.rcode())}")
+
+    def by_zone(self, records):
+        zones = {}
+        for name, value in records:
+            zones.setdefault(self.find_zone(name), []).append((name, value))
+        return zones
+
+    def publish(self, records):
+        try:
+            # one update message per zone, with every record of that zone
+            for zone, zone_records in self.by_zone(records).items():
+                self.send(zone, zone_records)
+                self.published.append((zone, zone_records))
+                print(f"Published {len(zone_records)} record(s) in {zone} on {self.server}")
+        except (OSError, dns.exception.DNSException) as e:
+            raise PublishError(f"update on {self.server} failed: {e}") from e
+
+    def cleanup(self):
+        while self.published:
+            zone, zone_records = self.published.pop()
+            try:
+                self.send(zone, zone_records, delete=True)
+            except (OSError, dns.exception.DNSException, PublishError) as e:
+                print(f"Could not remove the challenge records from {zone}: {e}")
+
+
+# first number after "SOA <mname> <rname>", across lines and an opening parenthesis
+SOA_SERIAL = re.compile(r'(\sSOA\s+\S+\s+\S+\s*\(?(?:\s|;[^\n]*\n)*)(\d+)', re.S | re.I)
+
+BEGIN_MARK = "; BEGIN nope acme-challenge (managed by app.py)"
+END_MARK = "; END nope acme-challenge"
+
+# orders of a batch edit the same zone file from several threads
+ZONE_FILE_LOCK = threading.Lock()
+
+
+class ZoneFilePublisher(Publisher):
+    """Add the records to a zone file, bump its serial and reload the server.
+
+    Each order of a batch has its own tag, so its block is added and
+    removed without touching the blocks of the other orders.
+    """
+
+    def __init__(self, zone_file, reload_cmd="rndc reload", ttl=DEFAULT_TTL, tag=None):
+        self.zone_file = zone_file
+        self.reload_cmd = reload_cmd
+        self.ttl = ttl
+        self.begin = f"{BEGIN_MARK} {tag}" if tag else BEGIN_MARK
+        self.end = f"{END_MARK} {tag}" if tag else END_MARK
+        self.published = False
+
+    @staticmethod
+    def bump_serial(text):
+        match = SOA_SERIAL.search(text)
+        if not match:
+            raise PublishError("no SOA serial found in the zone file")
+        serial = (int(match.group(2)) + 1) % (1 << 32)
+        return text[:match.start(2)] + str(serial) + text[match.end(2):]
+
+    def strip_block(self, text):
+        return re.sub(re.escape(self.begin) + r'\n.*?' + re.escape(self.end) + r'(\n|$)', '', text, flags=re.S)
+
+    def write(self, text):
+        # replace the file at once, bind may reload it at any time
+        tmp = f"{self.zone_file}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, self.zone_file)
+
+    def reload(self):
+        if self.reload_cmd:
+            result = subprocess.run(shlex.split(self.reload_cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            if result.returncode != 0:
+                raise PublishError(f"{self.reload_cmd} failed: {result.stdout.decode(errors='replace').strip()}")
+
+    def publish(self, records):
+        with ZONE_FILE_LOCK:
+            try:
+                with open(self.zone_file, 'r') as f:
+                    text = self.strip_block(f.read())
+                if not text.endswith("\n"):
+                    text += "\n"
+                block = [self.begin] + [f"{name}\t{self.ttl}\tIN\tTXT\t\"{value}\"" for name, value in records] + [self.end]
+                self.write(self.bump_serial(text + "\n".join(block) + "\n"))
+            except OSError as e:
+                raise PublishError(f"could not edit {self.zone_file}: {e}") from e
+            self.published = True
+            self.reload()
+        print(f"Published {len(records)} record(s) in {self.zone_file}")
+
+    def cleanup(self):
+        if not self.published:
+            return
+        self.published = False
+        with ZONE_FILE_LOCK:
+            try:
+                with open(self.zone_file, 'r') as f:
+                    text = f.read()
+                self.write(self.bump_serial(self.strip_block(text)))
+                self.reload()
+            except (OSError, PublishError) as e:
+                print(f"Could not remove the challenge records from {self.zone_file}: {e}")
+
+
+def add_arguments(parser):
+    """The publisher options of app.py."""
+    parser.add_argument("--dns-publisher", choices=["manual", "nsupdate", "zonefile"], default="manual",
+                        help="How to publish the _acme-challenge records (default: manual)")
+    parser.add_argument("--dns-server", help="Primary nameserver for nsupdate, host or host:port")
+    parser.add_argument("--tsig-key", help="BIND key file with the TSIG key for nsupdate")
+    parser.add_argument("--zone", help="Zone to update with nsupdate (default: found from the SOA)")
+    parser.add_argument("--zone-file", help="Zone file for the zonefile publisher")
+    parser.add_argument("--reload-cmd", default="rndc reload", help="Command reloading the zone after the zone file changed")
+    parser.add_argument("--dns-ttl", type=int, default=DEFAULT_TTL, help="TTL of the challenge records")
+
+
+def make_publisher(args, tag=None):
+    """The publisher chosen on the command line; tag tells the orders of a batch apart."""
+    if args.dns_publisher == "nsupdate":
+        if not args.dns_server:
+            raise PublishError("nsupdate needs --dns-server")
+        try:
+            address, port = propagation.parse_server(args.dns_server)
+        except propagation.PropagationError as e:
+            raise PublishError(str(e)) from e
+        return NsupdatePublisher(address, port, args.zone, args.tsig_key, args.dns_ttl)
+    if args.dns_publisher == "zonefile":
+        if not args.zone_file:
+            raise PublishError("zonefile needs --zone-file")
+        return ZoneFilePublisher(args.zone_file, args.reload_cmd, args.dns_ttl, tag)
+    if tag is not None:
+        raise PublishError("a batch needs --dns-publisher nsupdate or zonefile")
+    return ManualPublisher()
@@ -0,0 +1,267 @@
+"""Long-lived ACME session: one account, a cached directory, warm connections and nonces.
+
+Every JWS request needs a fresh replay nonce; ClientNetwork fetches one with a
+HEAD to newNonce whenever it has none left, each on whatever connection the
+requests pool hands out. A session keeps a keep-alive connection for each
+worker, prefetches nonces in the background (which also opens those
+connections) and reads the directory from a file instead of fetching it again. Once the
+challenges are published, it answers them all at once and polls the order
+at the pace the CA asks for with Retry-After, under one deadline:
+
+    acme = AcmeSession(acc_key, DIRECTORY_URL, account=acc_regr, workers=8,
+                       directory_cache="./dat/directory.json")
+    orderr = acme.client.new_order(csr_pem)
+    ...  # publish the DNS-01 records
+    acme.answer(challb_responses)
+    orderr = acme.finish(orderr, deadline=90)
+"""
+import collections
+import concurrent.futures
+import email.utils
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from acme import client
+from acme import errors
+from acme import messages
+
+# the directory hardly ever changes, fetch it again after a day
+DIRECTORY_MAX_AGE = 24 * 3600
+
+# nonces older than this are dropped instead of risking a badNonce round trip
+NONCE_MAX_AGE = 60
+
+# without a Retry-After, the order is polled after POLL_FIRST seconds,
+# then POLL_GROWTH times longer each time, up to POLL_MAX
+POLL_FIRST = 0.5
+POLL_GROWTH = 1.5
+POLL_MAX = 5
+
+
+def load_directory(url, net, cache_path=None, max_age=DIRECTORY_MAX_AGE):
+    """Directory of an ACME server, from cache_path if it is recent enough."""
+    if cache_path:
+        try:
+            with open(cache_path, 'r') as f:
+                cached = json.load(f)
+            if cached["url"] == url and time.time() - cached["time"] < max_age:
+                return messages.Directory.from_json(cached["directory"])
+        except (OSError, ValueError, KeyError):
+            pass
+    directory = client.ClientV2.get_directory(url, net)
+    if cache_path:
+        tmp = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({"url": url, "time": time.time(), "directory": json.loads(directory.json_dumps())}, f)
+        os.replace(tmp, cache_path)
+    return directory
+
+
+def retry_after(response):
+    """Seconds the server asked to wait with Retry-After, or None."""
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class PooledNetwork(client.ClientNetwork):
+    """ClientNetwork with keep-alive connections for every worker and a pool of replay nonces.
+
+    Safe to share between threads: each nonce is handed out once, and the pool
+    is refilled in the background when it runs below half of nonce_target.
+    """
+
+    def __init__(self, key, account=None, user_agent='acme-python', workers=1, nonce_target=None):
+        super().__init__(key, account=account, user_agent=user_agent)
+        # the workers' requests and the nonce prefetches can all be in flight at once
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2 * max(workers, 1))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.workers = max(workers, 1)
+        self.nonce_target = nonce_target or self.workers
+        self.new_nonce_url = None
+        self.nonce_lock = threading.Lock()
+        # (nonce, time received), oldest first
+        self.nonce_pool = collections.deque()
+        self.refilling = False
+        self.counts = {"pooled": 0, "fetched": 0, "prefetched": 0, "expired": 0}
+
+    def _add_nonce(self, response):
+        # ClientNetwork decodes the nonce into its set, move it into the pool
+        with self.nonce_lock:
+            super()._add_nonce(response)
+            now = time.monotonic()
+            while self._nonces:
+                self.nonce_pool.append((self._nonces.pop(), now))
+
+    def take_nonce(self):
+        with self.nonce_lock:
+            now = time.monotonic()
+            while self.nonce_pool and now - self.nonce_pool[0][1] > NONCE_MAX_AGE:
+                self.nonce_pool.popleft()
+                self.counts["expired"] += 1
+            nonce = None
+            if self.nonce_pool:
+                # the newest one, the least likely to be expired on the server
+                nonce = self.nonce_pool.pop()[0]
+                self.counts["pooled"] += 1
+            refill = (self.new_nonce_url and not self.refilling
+                      and len(self.nonce_pool) < (self.nonce_target + 1) // 2)
+            if refill:
+                self.refilling = True
+        if refill:
+            threading.Thread(target=self.refill, daemon=True).start()
+        return nonce
+
+    def fetch_nonce(self, url):
+        if url == self.new_nonce_url:
+            response = self._check_response(self.head(url), content_type=None)
+        else:
+            response = self.head(url)
+        self._add_nonce(response)
+
+    def refill(self):
+        """Fetch nonces until the pool holds nonce_target, workers at a time."""
+        try:
+            missing = self.nonce_target - len(self.nonce_pool)
+            # one HEAD per connection, so that every connection of the pool gets opened
+            threads = [threading.Thread(target=self.prefetch_nonces, args=(missing * i // self.workers, missing * (i + 1) // self.workers))
+                       for i in range(min(self.workers, missing))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            with self.nonce_lock:
+                self.refilling = False
+
+    def prefetch_nonces(self, start, end):
+        for _ in range(start, end):
+            try:
+                self.fetch_nonce(self.new_nonce_url)
+            except (requests.RequestException, errors.Error, messages.Error):
+                # the foreground request fetches its own nonce and reports the error
+                return
+            with self.nonce_lock:
+                self.counts["prefetched"] += 1
+
+    def _get_nonce(self, url, new_nonce_url):
+        if new_nonce_url and not self.new_nonce_url:
+            self.new_nonce_url = new_nonce_url
+        while True:
+            nonce = self.take_nonce()
+            if nonce is not None:
+                return nonce
+            # the pool ran dry (or is still filling), get one the way ClientNetwork does
+            self.fetch_nonce(new_nonce_url or url)
+            with self.nonce_lock:
+                self.counts["fetched"] += 1
+
+
+class AcmeSession:
+    """ACME client of one account, kept for every order of a process."""
+
+    def __init__(self, key, directory_url, account=None, user_agent='acme-python', workers=1, directory_cache=None):
+        self.net = PooledNetwork(key, account=account, user_agent=user_agent, workers=workers)
+        self.directory = load_directory(directory_url, self.net, directory_cache)
+        self.net.new_nonce_url = self.directory['newNonce']
+        self.client = client.ClientV2(self.directory, net=self.net)
+        # open the connections and fill the nonce pool while the caller prepares its orders
+        self.warm()
+
+    def warm(self):
+        with self.net.nonce_lock:
+            if self.net.refilling:
+                return
+            self.net.refilling = True
+        threading.Thread(target=self.net.refill, daemon=True).start()
+
+    def answer(self, challb_responses):
+        """Answer the (challb, response) challenges of an order, all at once."""
+        if len(challb_responses) < 2:
+            return [self.client.answer_challenge(challb, response) for challb, response in challb_responses]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(challb_responses)) as pool:
+            return list(pool.map(lambda pair: self.client.answer_challenge(*pair), challb_responses))
+
+    def finish(self, orderr, deadline, timer=None):
+        """Poll an answered order until it is ready, finalize it and fetch its certificate.
+
+        Waits as long as the CA asks with Retry-After, else polls sooner first and
+        backs off. Raises errors.ValidationError if an authorization failed and
+        errors.TimeoutError if the certificate is not there after deadline seconds.
+        timer (with mark(event, point) and add(event, seconds)) gets authz_wait,
+        finalize, cert_wait, cert_download and the time spent sleeping, poll_sleep.
+        """
+        mark = timer.mark if timer else (lambda event, point: None)
+        end = time.monotonic() + deadline
+        interval = POLL_FIRST
+        finalized = False
+        mark('authz_wait', 'start')
+        while True:
+            response = self.client._post_as_get(orderr.uri)
+            body = messages.Order.from_json(response.json())
+            if body.status == messages.STATUS_READY and not finalized:
+                mark('authz_wait', 'end')
+                mark('finalize', 'start')
+                orderr = self.client.begin_finalization(orderr)
+                mark('finalize', 'end')
+                mark('cert_wait', 'start')
+                finalized = True
+                interval = POLL_FIRST
+                body = orderr.body
+            if body.status == messages.STATUS_INVALID:
+                if not finalized:
+                    mark('authz_wait', 'end')
+                raise self.order_error(body)
+            if body.status == messages.STATUS_VALID and body.certificate is not None:
+                if finalized:
+                    mark('cert_wait', 'end')
+                mark('cert_download', 'start')
+                fullchain_pem = self.client._post_as_get(body.certificate).text
+                mark('cert_download', 'end')
+                return orderr.update(body=body, fullchain_pem=fullchain_pem)
+
+            wait = retry_after(response)
+            if wait is None:
+                wait = interval
+                interval = min(interval * POLL_GROWTH, POLL_MAX)
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                raise errors.TimeoutError()
+            wait = min(wait, remaining)
+            if timer:
+                timer.add('poll_sleep', wait)
+            time.sleep(wait)
+
+    def order_error(self, body):
+        """Error of an invalid order: its failed authorizations if there are some."""
+        failed = []
+        for url in body.authorizations:
+            authzr = self.client._authzr_from_response(self.client._post_as_get(url), uri=url)
+            if authzr.body.status != messages.STATUS_VALID:
+                failed.append(authzr)
+        if failed:
+            return errors.ValidationError(failed)
+        if body.error is not None:
+            return errors.IssuanceError(body.error)
+        return errors.Error("the order is invalid, the CA gave no reason")
+
+    def stats(self):
+        """Where the nonces of the JWS requests came from."""
+        with self.net.nonce_lock:
+            return dict(self.net.counts, left=len(self.net.nonce_pool))
+
+    def close(self):
+        self.net.session.close()
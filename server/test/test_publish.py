@@ -0,0 +1,172 @@
+import os
+import sys
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+
+import dns.message
+import dns.name
+import dns.opcode
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+import dns.tsigkeyring
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import publish
+
+# publish.NsupdatePublisher against a local RFC 2136 UPDATE responder
+#
+#   python3 -m pytest test/test_publish.py
+#
+# (run from server/)
+
+ZONE = dns.name.from_text("example.test.")
+SECRET = "c2VjcmV0IGtleSBvZiB0aGUgdGVzdA=="
+KEYFILE = 'key "nope-test." {\n\talgorithm hmac-sha256;\n\tsecret "' + SECRET + '";\n};\n'
+
+
+class UpdateResponder:
+    """Authoritative for ZONE: answers SOA queries over UDP and applies updates sent over TCP."""
+
+    def __init__(self, keyring=None, refuse=False):
+        self.keyring = keyring
+        self.refuse = refuse
+        self.records = {}
+        self.updates = 0
+        self.soa = dns.rrset.from_text(ZONE, 300, "IN", "SOA", "ns.example.test. admin.example.test. 1 3600 600 86400 60")
+        responder = self
+
+        class TCPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                length = struct.unpack("!H", self.recv(2))[0]
+                wire = responder.answer(self.recv(length))
+                self.request.sendall(struct.pack("!H", len(wire)) + wire)
+
+            def recv(self, size):
+                data = b""
+                while len(data) < size:
+                    data += self.request.recv(size - len(data))
+                return data
+
+        class UDPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                sock.sendto(responder.answer(data), self.client_address)
+
+        self.tcp = socketserver.ThreadingTCPServer(("127.0.0.1", 0), TCPHandler)
+        self.port = self.tcp.server_address[1]
+        self.udp = socketserver.ThreadingUDPServer(("127.0.0.1", self.port), UDPHandler)
+        for server in (self.tcp, self.udp):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def answer(self, wire):
+        # a wrong TSIG signature raises here, and the publisher sees the connection close
+        request = dns.message.from_wire(wire, keyring=self.keyring)
+        response = dns.message.make_response(request)
+        if request.opcode() == dns.opcode.UPDATE:
+            self.update(request, response)
+        elif request.question[0].name.is_subdomain(ZONE):
+            if request.question[0].name == ZONE and request.question[0].rdtype == dns.rdatatype.SOA:
+                response.answer.append(self.soa)
+            else:
+                response.authority.append(self.soa)
+        else:
+            response.set_rcode(dns.rcode.REFUSED)
+        return response.to_wire()
+
+    def update(self, request, response):
+        if self.refuse or (self.keyring and not request.had_tsig) or request.zone[0].name != ZONE:
+            response.set_rcode(dns.rcode.REFUSED)
+            return
+        self.updates += 1
+        for rrset in request.update:
+            values = self.records.setdefault(rrset.name.to_text(), set())
+            for rdata in rrset:
+                value = b"".join(rdata.strings).decode()
+                if rrset.deleting == dns.rdataclass.NONE:
+                    values.discard(value)
+                else:
+                    values.add(value)
+
+    def close(self):
+        for server in (self.tcp, self.udp):
+            server.shutdown()
+            server.server_close()
+
+
+@pytest.fixture
+def responder():
+    responder = UpdateResponder()
+    yield responder
+    responder.close()
+
+
+RECORDS = [("_acme-challenge.example.test.", "token-1"), ("_acme-challenge.www.example.test.", "token-2")]
+
+
+def test_publish_and_cleanup(responder):
+    with publish.NsupdatePublisher("127.0.0.1", responder.port) as publisher:
+        publisher.publish(RECORDS)
+        # the zone was found from the SOA and both records went in one update
+        assert responder.updates == 1
+        assert responder.records == {name: {value} for name, value in RECORDS}
+    assert responder.updates == 2
+    assert responder.records == {name: set() for name, _ in RECORDS}
+
+
+def test_tsig(tmp_path):
+    keyring = dns.tsigkeyring.from_text({"nope-test.": ("hmac-sha256", SECRET)})
+    responder = UpdateResponder(keyring)
+    try:
+        keyfile = tmp_path / "nope-test.key"
+        keyfile.write_text(KEYFILE)
+        publisher = publish.NsupdatePublisher("127.0.0.1", responder.port, zone="example.test.", keyfile=str(keyfile))
+        publisher.publish(RECORDS[:1])
+        assert responder.records == {RECORDS[0][0]: {RECORDS[0][1]}}
+        # an update without the key is refused
+        with pytest.raises(publish.PublishError):
+            publish.NsupdatePublisher("127.0.0.1", responder.port, zone="example.test.").publish(RECORDS[1:])
+        publisher.cleanup()
+        assert responder.records == {RECORDS[0][0]: set()}
+    finally:
+        responder.close()
+
+
+def test_refused_update():
+    responder = UpdateResponder(refuse=True)
+    try:
+        publisher = publish.NsupdatePublisher("127.0.0.1", responder.port)
+        with pytest.raises(publish.PublishError, match="REFUSED"):
+            publisher.publish(RECORDS)
+        assert publisher.published == []
+    finally:
+        responder.close()
+
+
+def test_server_given_by_name(responder):
+    args = argparse.Namespace(dns_publisher="nsupdate", dns_server=f"localhost:{responder.port}", zone=None,
+                              tsig_key=None, dns_ttl=publish.DEFAULT_TTL)
+    publisher = publish.make_publisher(args)
+    assert publisher.server == socket.getaddrinfo("localhost", responder.port, type=socket.SOCK_DGRAM)[0][4][0]
+    if publisher.server != "127.0.0.1":
+        pytest.skip("localhost does not resolve to 127.0.0.1 first here")
+    with publisher:
+        publisher.publish(RECORDS[:1])
+        assert responder.records == {RECORDS[0][0]: {RECORDS[0][1]}}
+
+
+def test_unknown_server_name():
+    args = argparse.Namespace(dns_publisher="nsupdate", dns_server="nameserver.invalid", zone=None,
+                              tsig_key=None, dns_ttl=publish.DEFAULT_TTL)
+    with pytest.raises(publish.PublishError, match="nameserver.invalid"):
+        publish.make_publisher(args)
+
+
+def test_publisher_is_abstract():
+    with pytest.raises(TypeError):
+        publish.Publisher()
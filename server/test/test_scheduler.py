@@ -0,0 +1,65 @@
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import scheduler
+
+# memory admission of scripts/scheduler.py, with fake jobs and a fake MemAvailable
+#
+#   python3 -m pytest test/test_scheduler.py
+#
+# (run from server/)
+
+GB = scheduler.GB
+
+
+class FakeArtifacts:
+    def __init__(self, bin_path, mode):
+        pass
+
+    def available(self):
+        return True
+
+    def load(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class HeldScheduler(scheduler.Scheduler):
+    """Jobs of 30 GB each that run until released, without a process between their steps."""
+
+    def __init__(self, **kwargs):
+        super().__init__(report=3600, **kwargs)
+        self.release = None
+
+    def need(self, mode):
+        return 30 * GB
+
+    async def run_job(self, job, workspace):
+        await self.release.wait()
+
+
+def test_reservations_add_up(monkeypatch):
+    monkeypatch.setattr(scheduler, "Artifacts", FakeArtifacts)
+    monkeypatch.setattr(scheduler, "mem_available", lambda: 64 * GB)
+
+    async def main():
+        sched = HeldScheduler(max_jobs=10, headroom=GB)
+        sched.release = asyncio.Event()
+        jobs = [scheduler.Job("d" + str(i) + ".com", 8, 8, 0) for i in range(10)]
+        sched.enqueue(jobs)
+        draining = asyncio.ensure_future(sched.drain())
+        await asyncio.sleep(0.1)
+        # 30 + 30 + 1 GB of headroom fit in 64 GB, a third job does not
+        admitted = len(sched.running)
+        sched.release.set()
+        await draining
+        sched.close()
+        return admitted, jobs
+
+    admitted, jobs = asyncio.run(main())
+    assert admitted == 2
+    assert all(job.status == "done" for job in jobs)
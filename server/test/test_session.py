@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+import threading
+import collections
+import concurrent.futures
+
+import josepy as jose
+import pytest
+import requests
+from requests.structures import CaseInsensitiveDict
+from cryptography.hazmat.primitives.asymmetric import rsa
+from acme import messages
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import session
+
+# session.PooledNetwork and the directory cache against a fake ACME server
+#
+#   python3 -m pytest test/test_session.py
+#
+# (run from server/)
+
+DIRECTORY_URL = "https://acme.test/directory"
+NEW_NONCE_URL = "https://acme.test/new-nonce"
+ORDER_URL = "https://acme.test/order/1"
+
+DIRECTORY = {
+    "newNonce": NEW_NONCE_URL,
+    "newAccount": "https://acme.test/new-account",
+    "newOrder": "https://acme.test/new-order",
+}
+
+
+def make_response(url, status=200, body=None, nonce=None, content_type="application/json"):
+    response = requests.Response()
+    response.url = url
+    response.status_code = status
+    response.headers = CaseInsensitiveDict()
+    if nonce is not None:
+        response.headers["Replay-Nonce"] = nonce
+    if body is not None:
+        response._content = json.dumps(body).encode()
+        response.headers["Content-Type"] = content_type
+    else:
+        response._content = b""
+    return response
+
+
+class FakeServer:
+    """Hands out nonces, accepts each once and can answer badNonce on purpose."""
+
+    def __init__(self, bad_nonces=0):
+        self.lock = threading.Lock()
+        self.issued = set()
+        self.used = []
+        self.heads = 0
+        self.gets = 0
+        # the next this many POSTs are rejected with badNonce, as if their nonce expired
+        self.bad_nonces = bad_nonces
+
+    def nonce(self):
+        value = jose.b64.b64encode(os.urandom(16)).decode()
+        self.issued.add(value)
+        return value
+
+    def bad_nonce(self, url):
+        return make_response(url, 400, {"type": "urn:ietf:params:acme:error:badNonce", "detail": "bad nonce"},
+                             self.nonce(), "application/problem+json")
+
+    def handle(self, method, url, data=None):
+        with self.lock:
+            if method == "HEAD":
+                self.heads += 1
+                return make_response(url, 200, nonce=self.nonce())
+            if method == "GET":
+                self.gets += 1
+                return make_response(url, 200, DIRECTORY)
+            protected = json.loads(jose.b64.b64decode(json.loads(data)["protected"]))
+            nonce = protected["nonce"]
+            reused = nonce in self.used
+            self.used.append(nonce)
+            if reused or nonce not in self.issued or self.bad_nonces:
+                self.bad_nonces = max(0, self.bad_nonces - 1)
+                return self.bad_nonce(url)
+            self.issued.discard(nonce)
+            return make_response(url, 200, {"status": "pending"}, self.nonce())
+
+
+class FakeNetwork(session.PooledNetwork):
+    """PooledNetwork sending its requests to a FakeServer instead of over HTTP."""
+
+    def __init__(self, server, **kwargs):
+        key = jose.JWKRSA(key=rsa.generate_private_key(public_exponent=65537, key_size=2048))
+        super().__init__(key, **kwargs)
+        self.server = server
+
+    def _send_request(self, method, url, *args, **kwargs):
+        return self.server.handle(method, url, kwargs.get("data"))
+
+
+def test_nonces_are_used_once():
+    server = FakeServer()
+    net = FakeNetwork(server, workers=4)
+    net.new_nonce_url = NEW_NONCE_URL
+    # what AcmeSession.warm does in the background
+    net.refill()
+    assert len(net.nonce_pool) == net.nonce_target
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+        responses = list(pool.map(lambda _: net.post(ORDER_URL, messages.Order(), new_nonce_url=NEW_NONCE_URL), range(32)))
+    assert all(response.json() == {"status": "pending"} for response in responses)
+    # no nonce was sent twice, so no request needed the badNonce retry
+    assert len(server.used) == len(set(server.used)) == 32
+    assert net.counts["pooled"] > 0
+
+
+def test_bad_nonce_is_retried_with_a_fresh_nonce():
+    server = FakeServer(bad_nonces=1)
+    net = FakeNetwork(server)
+    net.new_nonce_url = NEW_NONCE_URL
+    response = net.post(ORDER_URL, messages.Order(), new_nonce_url=NEW_NONCE_URL)
+    assert response.json() == {"status": "pending"}
+    assert len(server.used) == 2 and server.used[0] != server.used[1]
+
+
+def test_bad_nonce_twice_is_an_error():
+    server = FakeServer(bad_nonces=2)
+    net = FakeNetwork(server)
+    net.new_nonce_url = NEW_NONCE_URL
+    with pytest.raises(messages.Error) as error:
+        net.post(ORDER_URL, messages.Order(), new_nonce_url=NEW_NONCE_URL)
+    assert error.value.code == "badNonce"
+
+
+def test_expired_nonces_are_not_sent():
+    server = FakeServer()
+    net = FakeNetwork(server, workers=2)
+    net.new_nonce_url = NEW_NONCE_URL
+    net.refill()
+    net.nonce_pool = collections.deque((nonce, received - session.NONCE_MAX_AGE - 1) for nonce, received in net.nonce_pool)
+    net.post(ORDER_URL, messages.Order(), new_nonce_url=NEW_NONCE_URL)
+    assert net.counts["expired"] == 2
+    assert net.counts["fetched"] == 1
+
+
+def test_directory_cache(tmp_path):
+    cache = str(tmp_path / "directory.json")
+    server = FakeServer()
+    directory = session.load_directory(DIRECTORY_URL, FakeNetwork(server), cache)
+    assert directory["newNonce"] == NEW_NONCE_URL
+    assert server.gets == 1
+    # a later run reads it from the file
+    directory = session.load_directory(DIRECTORY_URL, FakeNetwork(server), cache)
+    assert directory["newOrder"] == DIRECTORY["newOrder"]
+    assert server.gets == 1
+    # but not once it is too old, or for another server
+    session.load_directory(DIRECTORY_URL, FakeNetwork(server), cache, max_age=0)
+    assert server.gets == 2
+    session.load_directory("https://other.test/directory", FakeNetwork(server), cache)
+    assert server.gets == 3
+    # a broken cache file is fetched again and replaced
+    with open(cache, "w") as f:
+        f.write("{")
+    session.load_directory(DIRECTORY_URL, FakeNetwork(server), cache)
+    assert server.gets == 4
+    with open(cache, "r") as f:
+        assert json.load(f)["url"] == DIRECTORY_URL
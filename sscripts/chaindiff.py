@@ -0,0 +1 @@
+../circuits/test/chaindiff.py
\ No newline at end of file
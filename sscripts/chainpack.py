@@ -0,0 +1 @@
+../circuits/test/chainpack.py
\ No newline at end of file
@@ -0,0 +1 @@
+../circuits/test/dnscache.py
\ No newline at end of file
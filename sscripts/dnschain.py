@@ -0,0 +1 @@
+../circuits/test/dnschain.py
\ No newline at end of file
@@ -0,0 +1 @@
+../circuits/test/dnsreplay.py
\ No newline at end of file
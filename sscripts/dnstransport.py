@@ -0,0 +1 @@
+../circuits/test/dnstransport.py
\ No newline at end of file
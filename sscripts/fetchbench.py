@@ -0,0 +1 @@
+../circuits/test/fetchbench.py
\ No newline at end of file